@@ -2,6 +2,27 @@ import logging as log
 import snappi
 from datetime import datetime
 import time
+import asyncio
+import io
+import sys
+import threading
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+import array
+import ipaddress
+import bisect
+import socket
+import functools
+import itertools
+import operator
+import mmap
+import struct
+import os
+import hashlib
+import importlib.metadata
+import json
+import collections
+import requests.adapters
 
    
 def Test_ebgp_route_prefix():
@@ -33,28 +54,76 @@ def Test_ebgp_route_prefix():
         "rxAdvRouteV6": "::20:20:20:1",
     }
 
-    api = snappi.api(location="https://localhost:8443", verify=False)
+    api = pooled_api(location="https://localhost:8443", verify=False)
+    tracer = ApiTracer(api)
+    timeline = PhaseTimeline("lab-02_ebgp_route_prefix")
+    try:
 
-    c = ebgp_route_prefix_config(api, test_const)
-
-    api.set_config(c)
-    
-    start_protocols(api)
+        set_config_payload(api, cached_config(api, ebgp_route_prefix_config, test_const))
+        # or, for large peer and route tables:
+        # set_config_payload(api, cached_config(api, ebgp_route_prefix_bulk_config, test_const))
+        timeline.mark("set_config")
     
-    wait_for(lambda: bgp_metrics_ok(api, test_const),"correct bgp peering")
+        start_protocols(api)
+        timeline.mark("start_protocols")
+
+        cache = MetricsCache(api)
     
-    wait_for(lambda: bgp_prefixes_ok(api, test_const),"correct bgp prefixes")
+        wait_for_all(
+            [
+                (
+                    timeline.until(
+                        fail_fast(
+                            lambda: bgp_metrics_ok(cache, test_const),
+                            BgpWatch(lambda: cache.latest("bgpv4")),
+                        ),
+                        "bgp_up",
+                    ),
+                    "correct bgp peering",
+                    60,
+                    SessionEta(lambda: cache.latest("bgpv4")),
+                ),
+                (
+                    timeline.until(lambda: bgp_prefixes_ok(cache, test_const), "prefixes_learned"),
+                    "correct bgp prefixes",
+                    60,
+                ),
+            ]
+        )
     
-    # start_capture(api)
+        # start_capture(api)
     
-    start_transmit(api)
+        start_transmit(api)
+        timeline.mark("start_transmit")
+        eta = TrafficEta(
+            lambda: cache.latest("flow"), packets=test_const["pktCount"], pps=test_const["pktRate"]
+        )
     
-    wait_for(lambda: flow_metrics_ok(api, test_const), "flow metrics",2,90)
+        wait_for(
+            fail_fast(
+                lambda: flow_metrics_ok(cache, test_const),
+                FlowWatch(lambda: cache.latest("flow"), packets=test_const["pktCount"]),
+            ),
+            "flow metrics",
+            timeout_seconds=90,
+            eta=eta,
+        )
+        timeline.mark("traffic_stopped")
 
-    # stop_capture(api)
+        # stop_capture(api)
     
-    # get_capture(api, "prx", "prx.pcap")
-    # get_capture(api, "ptx", "ptx.pcap")
+        # get_captures(api)
+
+        # print_capture_analysis("prx.pcap", test_const["pktCount"])
+        # print_capture_analysis("ptx.pcap", test_const["pktCount"])
+    finally:
+        tracer.print_summary()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        trace = results_path("api-%s.trace.json" % stamp)
+        if trace is not None:
+            tracer.write_chrome_trace(trace, timeline)
+            timeline.write(results_path("%s-%s.phases.json" % (timeline.run, stamp)))
+    timeline.check()
 
 
 def ebgp_route_prefix_config(api, tc):
@@ -285,8 +354,719 @@ def ebgp_route_prefix_config(api, tc):
     # print("Config:\n%s", c)
     return c
 
-def bgp_metrics_ok(api, tc):
-    for m in get_bgpv4_metrics(api):
+def ebgp_route_prefix_bulk_config(api, tc):
+    """
+    Builds the same config as ebgp_route_prefix_config from peer and route
+    tables with bgp_bulk_devices and returns it serialized, ready for
+    set_config_payload.
+    """
+    peers = {
+        "name": ["dtx", "drx"],
+        "port": ["ptx", "prx"],
+        "mac": [tc["txMac"], tc["rxMac"]],
+        "ip": [tc["txIp"], tc["rxIp"]],
+        "gateway": [tc["txGateway"], tc["rxGateway"]],
+        "prefix": [tc["txPrefix"], tc["rxPrefix"]],
+        "as_number": [tc["txAs"], tc["rxAs"]],
+        "as_type": ["ebgp", "ebgp"],
+    }
+    routes = {
+        "name": [
+            "dtx_bgpv4_peer_rrv4",
+            "dtx_bgpv4_peer_rrv6",
+            "drx_bgpv4_peer_rrv4",
+            "drx_bgpv4_peer_rrv6",
+        ],
+        "peer": [0, 0, 1, 1],
+        "version": [4, 6, 4, 6],
+        "address": [
+            tc["txAdvRouteV4"],
+            tc["txAdvRouteV6"],
+            tc["rxAdvRouteV4"],
+            tc["rxAdvRouteV6"],
+        ],
+        "prefix": [32, 128, 32, 128],
+        "count": [tc["txRouteCount"]] * 2 + [tc["rxRouteCount"]] * 2,
+        "step": [1] * 4,
+        "next_hop": [
+            tc["txNextHopV4"],
+            tc["txNextHopV6"],
+            tc["rxNextHopV4"],
+            tc["rxNextHopV6"],
+        ],
+        "multi_exit_discriminator": [50] * 4,
+        "origin": ["egp"] * 4,
+        "community": [(1, 2)] * 4,
+        "as_path": [[1112, 1113]] * 4,
+    }
+
+    ports = [
+        {"name": "ptx", "location": "localhost:5551+localhost:50071"},
+        {"name": "prx", "location": "localhost:5552+localhost:50072"},
+    ]
+    captures = [
+        {"name": "prx_capture", "port_names": ["prx"], "format": "pcap", "overwrite": True},
+        {"name": "ptx_capture", "port_names": ["ptx"], "format": "pcap", "overwrite": True},
+    ]
+    flows = []
+    for name, tx, rx, version in [
+        ("ftx_v4", "tx", "rx", 4),
+        ("ftx_v6", "tx", "rx", 6),
+        ("frx_v4", "rx", "tx", 4),
+        ("frx_v6", "rx", "tx", 6),
+    ]:
+        ip = "ipv%d" % version
+        route = "AdvRouteV%d" % version
+        flows.append(
+            {
+                "name": name,
+                "tx_rx": {
+                    "choice": "device",
+                    "device": {
+                        "tx_names": ["d%s_bgpv4_peer_rrv%d" % (tx, version)],
+                        "rx_names": ["d%s_bgpv4_peer_rrv%d" % (rx, version)],
+                    },
+                },
+                "packet": [
+                    {
+                        "choice": "ethernet",
+                        "ethernet": {"src": {"choice": "value", "value": tc[tx + "Mac"]}},
+                    },
+                    {
+                        "choice": ip,
+                        ip: {
+                            "src": {"choice": "value", "value": tc[tx + route]},
+                            "dst": {"choice": "value", "value": tc[rx + route]},
+                        },
+                    },
+                    {
+                        "choice": "tcp",
+                        "tcp": {
+                            "src_port": {"choice": "value", "value": 5000},
+                            "dst_port": {"choice": "value", "value": 6000},
+                        },
+                    },
+                ],
+                "size": {"choice": "fixed", "fixed": tc["pktSize"]},
+                "rate": {"choice": "pps", "pps": tc["pktRate"]},
+                "duration": {"choice": "fixed_packets", "fixed_packets": {"packets": tc["pktCount"]}},
+                "metrics": {"enable": True},
+            }
+        )
+
+    return '{"ports":%s,"captures":%s,"devices":%s,"flows":%s}' % (
+        json.dumps(ports),
+        json.dumps(captures),
+        bgp_bulk_devices(peers, routes),
+        json.dumps(flows),
+    )
+
+
+# JSON templates used by bgp_bulk_devices, one per object kind, filled in with
+# % so that a route or a peer costs a single string format. String fields are
+# filled in already JSON encoded, quotes included
+BULK_DEVICE = (
+    '{"name":%(name)s,"ethernets":[{"name":%(eth_name)s,'
+    '"connection":{"choice":"port_name","port_name":%(port)s},'
+    '"mac":%(mac)s,"mtu":1500,"ipv4_addresses":[{"name":%(ip_name)s,'
+    '"address":%(ip)s,"gateway":%(gateway)s,"prefix":%(prefix)d}]}],'
+    '"bgp":{"router_id":%(ip)s,"ipv4_interfaces":[{"ipv4_name":%(ip_name)s,'
+    '"peers":[{"name":%(peer_name)s,"peer_address":%(gateway)s,'
+    '"as_type":%(as_type)s,"as_number":%(as_number)d,'
+    '"learned_information_filter":{"unicast_ipv4_prefix":true,"unicast_ipv6_prefix":true}'
+    '%(routes)s}]}]}}'
+)
+BULK_ROUTE = (
+    '{"name":%s,"next_hop_mode":"manual","next_hop_address_type":"ipv%d",'
+    '"next_hop_ipv%d_address":%s,"addresses":[{"address":%s,"prefix":%d,'
+    '"count":%d,"step":%d}]%s}'
+)
+BULK_ROUTE_ADVANCED = ',"advanced":{%s}'
+BULK_ROUTE_COMMUNITY = (
+    ',"communities":[{"type":"manual_as_number","as_number":%d,"as_custom":%d}]'
+)
+BULK_ROUTE_AS_PATH = (
+    ',"as_path":{"as_set_mode":"include_as_set",'
+    '"segments":[{"type":"as_seq","as_numbers":[%s]}]}'
+)
+
+
+def bgp_bulk_devices(peers, routes):
+    """
+    Serializes BGP devices straight to the JSON of the OTG `devices` list
+    without building any snappi objects. `peers` and `routes` are tables
+    given as dicts of equally long columns:
+
+    peers:  name, port, mac, ip, gateway, prefix, as_number, as_type
+    routes: name, peer (index into peers), version (4 or 6), address,
+            prefix, count, step, next_hop and optionally local_preference,
+            multi_exit_discriminator, origin, community ((as_number,
+            as_custom) pairs) and as_path (lists of AS numbers)
+
+    Devices, ethernets, ipv4 addresses and peers are named after the peer
+    name the same way the *_route_prefix_config builders name them, so the
+    payload deserializes to the config the snappi object path builds.
+    """
+    # what json.dumps does for a str, without its per call overhead
+    string = json.encoder.encode_basestring_ascii
+    n = len(routes["name"])
+    columns = {}
+    for col in ("local_preference", "multi_exit_discriminator", "origin", "community", "as_path"):
+        columns[col] = routes.get(col) or [None] * n
+
+    v4_routes = [[] for _ in peers["name"]]
+    v6_routes = [[] for _ in peers["name"]]
+    for i in range(n):
+        extra = ""
+        advanced = []
+        if columns["local_preference"][i] is not None:
+            advanced.append('"local_preference":%d' % columns["local_preference"][i])
+        if columns["multi_exit_discriminator"][i] is not None:
+            advanced.append('"multi_exit_discriminator":%d' % columns["multi_exit_discriminator"][i])
+        if columns["origin"][i] is not None:
+            advanced.append('"origin":%s' % string(columns["origin"][i]))
+        if advanced:
+            extra += BULK_ROUTE_ADVANCED % ",".join(advanced)
+        if columns["community"][i] is not None:
+            extra += BULK_ROUTE_COMMUNITY % columns["community"][i]
+        if columns["as_path"][i] is not None:
+            extra += BULK_ROUTE_AS_PATH % ",".join(str(a) for a in columns["as_path"][i])
+
+        version = routes["version"][i]
+        (v6_routes if version == 6 else v4_routes)[routes["peer"][i]].append(
+            BULK_ROUTE
+            % (
+                string(routes["name"][i]),
+                version,
+                version,
+                string(routes["next_hop"][i]),
+                string(routes["address"][i]),
+                routes["prefix"][i],
+                routes["count"][i],
+                routes["step"][i],
+                extra,
+            )
+        )
+
+    devices = []
+    for i in range(len(peers["name"])):
+        row = {col: values[i] for col, values in peers.items()}
+        for col in ("name", "port", "mac", "ip", "gateway", "as_type"):
+            row[col] = string(row[col])
+        # the names derived from the peer name, suffixed inside the quotes
+        row["eth_name"] = row["name"][:-1] + '_eth"'
+        row["ip_name"] = row["name"][:-1] + '_ip"'
+        row["peer_name"] = row["name"][:-1] + '_bgpv4_peer"'
+        row["routes"] = ""
+        if v4_routes[i]:
+            row["routes"] += ',"v4_routes":[%s]' % ",".join(v4_routes[i])
+        if v6_routes[i]:
+            row["routes"] += ',"v6_routes":[%s]' % ",".join(v6_routes[i])
+        devices.append(BULK_DEVICE % row)
+    return "[" + ",".join(devices) + "]"
+
+
+CONFIG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ac2-workshop", "configs")
+
+
+def cached_config(api, builder, tc, cache_dir=CONFIG_CACHE_DIR):
+    """
+    Returns the serialized config `builder(api, tc)` builds, from an on-disk
+    cache when the same config was built before. Entries are keyed by a hash
+    of `tc`, the builder name, the source of this script and the installed
+    snappi version, so editing the builders or upgrading snappi invalidates
+    them without any cleanup.
+    """
+    key = hashlib.sha256()
+    key.update(json.dumps(tc, sort_keys=True).encode())
+    key.update(builder.__name__.encode())
+    with open(os.path.abspath(__file__), "rb") as f:
+        key.update(f.read())
+    key.update(importlib.metadata.version("snappi").encode())
+    path = os.path.join(cache_dir, key.hexdigest() + ".json")
+
+    if os.path.exists(path):
+        print("%s Using cached config %s    ..." % (datetime.now(), path))
+        with open(path) as f:
+            return f.read()
+
+    c = builder(api, tc)
+    payload = c if isinstance(c, str) else c.serialize()
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename so a concurrent run never reads a partial entry
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+    return payload
+
+
+class OtgHttp(object):
+    """
+    The HTTP transport under a snappi api, for the requests the labs send
+    without snappi objects: posting serialized configs, streaming captures
+    and fetching prefix shards. `request` sends them with the api's location,
+    `verify` and timeout and raises the same errors as the snappi calls.
+
+    OtgHttp and PooledTransport are the only places that reach into snappi
+    internals: the api's `_transport`, its `_session` and
+    `_parse_response_error`, and the `send_recv` PooledTransport overrides.
+    They are trusted on the snappi releases in SNAPPI_VERSIONS and checked
+    for here on any other, before pooled_api creates a PooledTransport,
+    which fails with the installed release named rather than with an
+    AttributeError somewhere in a lab.
+    """
+
+    # [first, last) snappi releases the internals were checked against
+    SNAPPI_VERSIONS = ((1, 0), (2, 0))
+    snappi_checked = False
+
+    def __init__(self, api):
+        self.api = api
+        self.transport = api._transport
+        if not OtgHttp.snappi_checked:
+            self._check_snappi()
+            OtgHttp.snappi_checked = True
+        self.session = self.transport._session
+        self.location = self.transport.location
+
+    def _check_snappi(self):
+        version = importlib.metadata.version("snappi")
+        release = tuple(int(p) for p in version.split(".")[:2])
+        if self.SNAPPI_VERSIONS[0] <= release < self.SNAPPI_VERSIONS[1]:
+            return
+        needed = ["location", "verify", "_session", "_parse_response_error", "send_recv"]
+        missing = [a for a in needed if not hasattr(self.transport, a)]
+        if missing:
+            raise Exception(
+                "snappi %s is not supported, its HTTP transport has no %s; install snappi %s.x"
+                % (version, ", ".join(missing), self.SNAPPI_VERSIONS[0][0])
+            )
+
+    def set_transport(self, transport):
+        # replaces the transport of the api, e.g. by a PooledTransport
+        self.api._transport = transport
+        self.transport = transport
+        self.session = transport._session
+        self.location = transport.location
+
+    def request(self, method, path, headers=None, **kwargs):
+        response = self.session.request(
+            method,
+            self.location + path,
+            headers=headers or {"Content-Type": "application/json"},
+            verify=self.transport.verify,
+            timeout=getattr(self.transport, "timeout_seconds", None),
+            **kwargs
+        )
+        if not response.ok:
+            with response:
+                self.transport._parse_response_error(response.status_code, response.text)
+        return response
+
+
+class PooledTransport(snappi.snappi.HttpTransport):
+    """
+    HttpTransport tuned for polling loops: up to `pool_size` keep-alive
+    connections are reused, so TLS is negotiated once per connection rather
+    than per call, every request gives up after `timeout_seconds`, responses
+    are gzip encoded only when `compress` is set, and JSON responses are
+    decoded with json instead of yaml. The session is safe to share between
+    threads, so independent requests can run concurrently, see MetricsCache.
+    Unlike HttpTransport it sends requests with the `verify` it was created
+    with. It builds on the same HttpTransport internals as OtgHttp, so
+    create it through pooled_api, which checks them first.
+    """
+
+    # what pooled_api recognizes it by, every lab and every reload of a lab
+    # by tools/otg_worker.py has a PooledTransport class of its own
+    pooled = True
+
+    def __init__(self, pool_size=10, timeout_seconds=30, compress=False, **kwargs):
+        super(PooledTransport, self).__init__(**kwargs)
+        self.timeout_seconds = timeout_seconds
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # controllers are usually next to the script, where compressing costs
+        # more than it saves
+        self._session.headers["Accept-Encoding"] = "gzip" if compress else "identity"
+
+    def send_recv(
+        self,
+        method,
+        relative_url,
+        payload=None,
+        return_object=None,
+        headers=None,
+        request_class=None,
+    ):
+        headers = headers or {"Content-Type": "application/json"}
+        data = None
+        if isinstance(payload, bytes):
+            data = payload
+            headers["Content-Type"] = "application/octet-stream"
+        elif isinstance(payload, str):
+            if request_class is not None:
+                request_class().deserialize(payload)
+            data = payload
+        elif payload is not None:
+            data = payload.serialize()
+
+        response = self._session.request(
+            method=method,
+            url=self.location + relative_url,
+            data=data,
+            headers=headers,
+            verify=self.verify,
+            timeout=self.timeout_seconds,
+        )
+        if not response.ok:
+            self._parse_response_error(response.status_code, response.text)
+        content_type = response.headers.get("content-type", "")
+        if "application/json" in content_type:
+            if return_object is None:
+                return response.json()
+            return return_object.deserialize(response.json())
+        if "application/octet-stream" in content_type:
+            return io.BytesIO(response.content)
+        return response
+
+
+def pooled_api(location, verify=False, pool_size=10, timeout_seconds=30, compress=False):
+    """
+    `snappi.api` over a PooledTransport. An api that already has one, e.g.
+    a session handed out again by tools/otg_worker.py, is returned as is.
+    The transport keeps the location of the api `snappi.api` returns, so
+    tools that redirect `snappi.api`, such as tools/run_labs.py, redirect
+    this one as well.
+    """
+    api = snappi.api(location=location, verify=verify)
+    http = OtgHttp(api)
+    if not getattr(http.transport, "pooled", False):
+        http.set_transport(
+            PooledTransport(
+                location=http.location,
+                verify=verify,
+                pool_size=pool_size,
+                timeout_seconds=timeout_seconds,
+                compress=compress,
+            )
+        )
+    return api
+
+
+# ApiTracer and PhaseTimeline are the same in every lab script that traces
+# its runs, copied so each script still runs on its own. Change them in all
+# of them
+class ApiTracer(object):
+    """
+    Times every call of `api` listed in CALLS and every HTTP request made
+    through its session, including the ones under those calls. Each record
+    keeps its start, end, request and response size. The gap between a call
+    and the request under it is client side serialization, and the request
+    itself is controller latency plus transfer.
+
+    `print_summary()` prints per call type latency percentiles and sizes,
+    `histogram(name)` buckets one type by powers of two milliseconds and
+    `write_chrome_trace(path)` writes every record as a Chrome trace that
+    chrome://tracing or ui.perfetto.dev can open.
+    """
+
+    CALLS = [
+        "set_config",
+        "get_config",
+        "update_config",
+        "set_control_state",
+        "get_metrics",
+        "get_states",
+        "get_capture",
+    ]
+
+    def __init__(self, api):
+        self.api = api
+        self.origin = time.perf_counter()
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # an api handed out again by tools/otg_worker.py still carries the
+        # previous run's tracer, wrap what was there before it
+        untraced = api.__dict__.setdefault("_untraced", {})
+        for name in self.CALLS:
+            untraced.setdefault(name, getattr(api, name))
+            setattr(api, name, self._traced_call(name, untraced[name]))
+        session = OtgHttp(api).session
+        untraced.setdefault("request", session.request)
+        session.request = self._traced_request(untraced["request"])
+
+    def _traced_call(self, name, call):
+        def traced(*args, **kwargs):
+            record = {"cat": "api", "name": name, "request_bytes": 0, "response_bytes": 0}
+            self._local.call = record
+            record["start"] = time.perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                record["end"] = time.perf_counter()
+                self._local.call = None
+                self._add(record)
+
+        return traced
+
+    def _traced_request(self, request):
+        def traced(method, url, **kwargs):
+            path = url.split("://", 1)[-1].partition("/")[2]
+            data = kwargs.get("data")
+            record = {
+                "cat": "http",
+                "name": "%s /%s" % (method.upper(), path),
+                "request_bytes": len(data) if data is not None else 0,
+                "response_bytes": 0,
+            }
+            record["start"] = time.perf_counter()
+            try:
+                response = request(method, url, **kwargs)
+                if kwargs.get("stream"):
+                    # the body is read by the caller after this returns
+                    record["response_bytes"] = int(response.headers.get("Content-Length", 0))
+                else:
+                    record["response_bytes"] = len(response.content)
+                return response
+            finally:
+                record["end"] = time.perf_counter()
+                call = getattr(self._local, "call", None)
+                if call is not None:
+                    call["request_bytes"] += record["request_bytes"]
+                    call["response_bytes"] += record["response_bytes"]
+                self._add(record)
+
+        return traced
+
+    def _add(self, record):
+        record["tid"] = threading.get_ident()
+        with self._lock:
+            self.records.append(record)
+
+    def durations(self, name):
+        with self._lock:
+            return sorted(r["end"] - r["start"] for r in self.records if r["name"] == name)
+
+    def histogram(self, name):
+        # upper bound in ms -> count, 1, 2, 4, ...
+        buckets = {}
+        for d in self.durations(name):
+            bound = 1
+            while bound < d * 1000:
+                bound *= 2
+            buckets[bound] = buckets.get(bound, 0) + 1
+        return dict(sorted(buckets.items()))
+
+    def print_summary(self):
+        with self._lock:
+            records = list(self.records)
+        calls = {}
+        for r in records:
+            calls.setdefault((r["cat"] != "api", r["name"]), []).append(r)
+
+        tb = Table(
+            "API Calls",
+            ["Count", "p50 ms", "p90 ms", "Max ms", "Total ms", "Req KB", "Resp KB", "Call"],
+            10,
+        )
+        for (_, name), rs in sorted(calls.items()):
+            d = sorted(r["end"] - r["start"] for r in rs)
+            tb.append_row(
+                [
+                    len(d),
+                    "%.1f" % (d[len(d) // 2] * 1000),
+                    "%.1f" % (d[len(d) * 9 // 10] * 1000),
+                    "%.1f" % (d[-1] * 1000),
+                    "%.1f" % (sum(d) * 1000),
+                    "%.1f" % (sum(r["request_bytes"] for r in rs) / 1024.0),
+                    "%.1f" % (sum(r["response_bytes"] for r in rs) / 1024.0),
+                    name,
+                ]
+            )
+        tb.write(sys.stdout)
+
+    def write_chrome_trace(self, path, timeline=None):
+        """
+        `timeline`, a PhaseTimeline of the same run, adds its phases on a
+        track of their own above the calls.
+        """
+        with self._lock:
+            records = list(self.records)
+        pid = os.getpid()
+        events = []
+        if timeline is not None:
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": 0, "args": {"name": "phases"}})
+            for p in timeline.phases:
+                events.append(
+                    {
+                        "ph": "X",
+                        "cat": "phase",
+                        "name": p["name"],
+                        "pid": pid,
+                        "tid": 0,
+                        "ts": (timeline.origin + p["start"] - self.origin) * 1e6,
+                        "dur": p["seconds"] * 1e6,
+                    }
+                )
+        for tid in sorted(set(r["tid"] for r in records)):
+            for t in threading.enumerate():
+                if t.ident == tid:
+                    events.append(
+                        {"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": t.name}}
+                    )
+        for r in records:
+            events.append(
+                {
+                    "ph": "X",
+                    "cat": r["cat"],
+                    "name": r["name"],
+                    "pid": pid,
+                    "tid": r["tid"],
+                    "ts": (r["start"] - self.origin) * 1e6,
+                    "dur": (r["end"] - r["start"]) * 1e6,
+                    "args": {
+                        "request_bytes": r["request_bytes"],
+                        "response_bytes": r["response_bytes"],
+                    },
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+# baselines of PhaseTimeline.check, outside the lab directories
+PHASE_BASELINE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ac2-workshop", "phases")
+# directory the API traces, phases and metric recordings of a run are
+# written to, tools/run_labs.py sets it per test. Nothing is kept when unset
+RESULTS_DIR_ENV = "OTG_RESULTS_DIR"
+
+
+def results_path(name):
+    # `name` in the results directory, None when runs keep no files
+    results_dir = os.environ.get(RESULTS_DIR_ENV)
+    if not results_dir:
+        return None
+    os.makedirs(results_dir, exist_ok=True)
+    return os.path.join(results_dir, name)
+
+
+class PhaseTimeline(object):
+    """
+    Marks the phases of a test run, e.g. set_config, start_protocols, bgp_up.
+    `mark(name)` ends a phase that started at the previous mark. `until(func,
+    name)` wraps a wait_for predicate so that its phase ends the first time
+    the predicate holds, which times conditions polled together under
+    wait_for_all separately.
+
+    `write(path)` saves the phases as JSON and `check()` compares them
+    against the baseline run of the same script and run name saved under
+    PHASE_BASELINE_DIR, or at `path` when given. A phase that took more than
+    `tolerance` longer and at least `slack_seconds` more than there is
+    reported as regressed, and raises only with `fail`, timings of a shared
+    lab are too noisy to fail a functional test on by default. With no
+    baseline yet the run is saved as the baseline.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.started = datetime.now()
+        self.origin = time.perf_counter()
+        self.phases = []
+        self._last = self.origin
+        self._lock = threading.Lock()
+
+    def _add(self, name, start, end):
+        with self._lock:
+            self.phases.append(
+                {
+                    "name": name,
+                    "start": start - self.origin,
+                    "end": end - self.origin,
+                    "seconds": end - start,
+                }
+            )
+            self._last = max(self._last, end)
+
+    def mark(self, name):
+        self._add(name, self._last, time.perf_counter())
+
+    def until(self, func, name):
+        start = self._last
+        done = []
+
+        def predicate():
+            ok = func()
+            if ok and not done:
+                done.append(True)
+                self._add(name, start, time.perf_counter())
+            return ok
+
+        return predicate
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "run": self.run,
+                    "started": self.started.isoformat(),
+                    "phases": self.phases,
+                },
+                f,
+                indent=2,
+            )
+        return path
+
+    def check(self, path=None, tolerance=0.25, slack_seconds=0.5, fail=False):
+        if path is None:
+            script = os.path.splitext(os.path.basename(__file__))[0]
+            path = os.path.join(PHASE_BASELINE_DIR, "%s.%s.json" % (script, self.run))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.write(path)
+            print("%s No phase baseline yet, saved this run to %s" % (datetime.now(), path))
+            return
+        with open(path) as f:
+            baseline = dict((p["name"], p["seconds"]) for p in json.load(f)["phases"])
+
+        tb = Table("Phases vs %s" % path, ["Baseline s", "Run s", "Change", "Status", "Phase"])
+        regressions = []
+        for p in self.phases:
+            base = baseline.get(p["name"])
+            if base is None:
+                tb.append_row(["_", "%.3f" % p["seconds"], "_", "new", p["name"]])
+                continue
+            status = "ok"
+            if p["seconds"] > base * (1 + tolerance) and p["seconds"] - base >= slack_seconds:
+                status = "REGRESSED"
+                regressions.append(p["name"])
+            change = "_" if base == 0 else "%+.0f%%" % ((p["seconds"] / base - 1) * 100)
+            tb.append_row(["%.3f" % base, "%.3f" % p["seconds"], change, status, p["name"]])
+        tb.write(sys.stdout)
+
+        if regressions:
+            message = "Phases slower than %s: %s" % (path, ", ".join(regressions))
+            if fail:
+                raise Exception(message)
+            print("%s %s" % (datetime.now(), message))
+
+
+def set_config_payload(api, payload):
+    """
+    POSTs an already serialized config. `api.set_config` deserializes string
+    payloads into snappi objects to validate them, which is the cost the bulk
+    builders avoid, so the request goes through the api's HTTP session
+    directly.
+    """
+    OtgHttp(api).request("POST", "/config", data=payload).close()
+
+
+def bgp_metrics_ok(cache, tc):
+    for m in cache.get("bgpv4"):
         if (
             m.session_state == m.DOWN
             or m.routes_advertised != 2 * tc["txRouteCount"]
@@ -295,28 +1075,20 @@ def bgp_metrics_ok(api, tc):
             return False
     return True
 
-def bgp_prefixes_ok(api, tc):
-    prefix_count = 0
-    for m in get_bgp_prefixes(api):
-        for p in m.ipv4_unicast_prefixes:
-            for key in ["tx", "rx"]:
-                if (
-                    p.ipv4_address == tc[key + "AdvRouteV4"]
-                    and p.ipv4_next_hop == tc[key + "NextHopV4"]
-                ):
-                    prefix_count += 1
-        for p in m.ipv6_unicast_prefixes:
-            for key in ["tx", "rx"]:
-                if (
-                    p.ipv6_address == tc[key + "AdvRouteV6"]
-                    and p.ipv6_next_hop == tc[key + "NextHopV6"]
-                ):
-                    prefix_count += 1
-
-    return prefix_count == 4
-
-def flow_metrics_ok(api, tc):
-    for m in get_flow_metrics(api):
+def bgp_prefixes_ok(cache, tc):
+    # checks every route of every configured range is learned with its
+    # configured next hop, `tc` is only kept for the predicate signature
+    # shared with the other checks. Extra prefixes, e.g. ones the DUT
+    # originates itself, are reported but do not fail the check
+    diff = cache.get("bgp_prefix_diff")
+    print(
+        "%s BGP prefixes: %d missing ranges, %d extra, %d wrong next hop"
+        % (datetime.now(), len(diff["missing"]), len(diff["extra"]), len(diff["wrong_next_hop"]))
+    )
+    return not diff["missing"] and not diff["wrong_next_hop"]
+
+def flow_metrics_ok(cache, tc):
+    for m in cache.get("flow"):
         if (
             m.transmit != m.STOPPED
             or m.frames_tx != tc["pktCount"]
@@ -355,48 +1127,101 @@ def get_bgpv4_metrics(api):
     print(tb)
     return metrics
 
-def get_bgp_prefixes(api):
-    print("%s Getting BGP prefixes    ..." % datetime.now())
-    req = api.states_request()
-    req.bgp_prefixes.bgp_peer_names = []
-    bgp_prefixes = api.get_states(req).bgp_prefixes
+def bgp_peer_names(config):
+    return [
+        peer.name
+        for d in config.devices
+        for intf in list(d.bgp.ipv4_interfaces) + list(d.bgp.ipv6_interfaces)
+        for peer in intf.peers
+    ]
 
-    tb = Table(
-        "BGP Prefixes",
-        [
-            "Name",
-            "IPv4 Address",
-            "IPv4 Next Hop",
-            "IPv6 Address",
-            "IPv6 Next Hop",
-        ],
-        20,
-    )
-
-    for b in bgp_prefixes:
-        for p in b.ipv4_unicast_prefixes:
-            tb.append_row(
-                [
-                    b.bgp_peer_name,
-                    "{}/{}".format(p.ipv4_address, p.prefix_length),
-                    p.ipv4_next_hop,
-                    "",
-                    "" if p.ipv6_next_hop is None else p.ipv6_next_hop,
-                ]
+def iter_bgp_prefixes(api, peer_names=None, group_size=1, max_workers=1):
+    """
+    Yields the learned BGP prefixes one shard at a time as
+    `(peer_name, family, prefixes)`, where a shard is one peer and address
+    family and `prefixes` its decoded JSON, e.g.
+    `{"ipv4_address": ..., "prefix_length": ..., "ipv4_next_hop": ...}`.
+    Only the current shards are held, so memory is bounded by the shard size
+    rather than the whole RIB. `peer_names` defaults to every BGP peer of the
+    config.
+
+    Each states request covers `group_size` peers and one address family, and
+    up to `max_workers` of them are in flight at once over as many pooled
+    connections. Shards are yielded in peer order either way.
+
+    The requests go through the api's HTTP session since `api.get_states`
+    builds a snappi object per prefix, which takes longer than the peers
+    take to learn a large RIB.
+    """
+    if peer_names is None:
+        peer_names = bgp_peer_names(api.get_config())
+    http = OtgHttp(api)
+    if max_workers > 1:
+        adapter = http.session.get_adapter(http.location)
+        if getattr(adapter, "_pool_maxsize", 0) < max_workers:
+            http.session.mount(
+                http.location, requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
             )
-        for p in b.ipv6_unicast_prefixes:
+
+    def fetch(names, family):
+        req = api.states_request()
+        req.bgp_prefixes.bgp_peer_names = names
+        req.bgp_prefixes.prefix_filters = [family + "_unicast"]
+        response = http.request("POST", "/monitor/states", data=req.serialize())
+        states = response.json().get("bgp_prefixes", [])
+        response.close()
+        # a group comes back in whatever order the controller keeps its peers
+        order = dict((n, i) for i, n in enumerate(names))
+        states.sort(key=lambda s: order.get(s.get("bgp_peer_name"), len(names)))
+        return [
+            (s.get("bgp_peer_name", names[0]), family, s.get(family + "_unicast_prefixes", []))
+            for s in states
+        ]
+
+    shards = [
+        (peer_names[i : i + group_size], family)
+        for i in range(0, len(peer_names), group_size)
+        for family in ["ipv4", "ipv6"]
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # at most `max_workers` shards fetched ahead of the consumer
+        pending = collections.deque()
+        for shard in shards:
+            pending.append(pool.submit(fetch, *shard))
+            if len(pending) >= max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def get_bgp_prefixes(api, peer_names=None, group_size=1, max_workers=1):
+    print("%s Getting BGP prefixes    ..." % datetime.now())
+    total = 0
+    # one table per shard so only one shard's rows are held at a time
+    for name, family, prefixes in iter_bgp_prefixes(api, peer_names, group_size, max_workers):
+        if not prefixes:
+            continue
+        label = "IPv4" if family == "ipv4" else "IPv6"
+        tb = Table(
+            "BGP Prefixes %s %s" % (name, label),
+            [
+                "Name",
+                label + " Address",
+                label + " Next Hop",
+            ],
+            20,
+        )
+        for p in prefixes:
             tb.append_row(
                 [
-                    b.bgp_peer_name,
-                    "",
-                    "" if p.ipv4_next_hop is None else p.ipv4_next_hop,
-                    "{}/{}".format(p.ipv6_address, p.prefix_length),
-                    p.ipv6_next_hop,
+                    name,
+                    "{}/{}".format(p[family + "_address"], p["prefix_length"]),
+                    p.get(family + "_next_hop", ""),
                 ]
             )
+        tb.write(sys.stdout)
+        total += len(prefixes)
 
-    print(tb)
-    return bgp_prefixes
+    return total
 
 def get_flow_metrics(api):
 
@@ -476,19 +1301,666 @@ def stop_capture(api):
     cs.port.capture.set(port_names = [], state="stop")
     api.set_control_state(cs)
 
-def get_capture(api,port_name,file_name):
+def get_capture(api, port_name, file_name, compress=False, chunk_size=1 << 20):
     print('Fetching capture from port %s' % port_name)
     capture_req = api.capture_request()
     capture_req.port_name = port_name
-    pcap = api.get_capture(capture_req)
-    with open(file_name, 'wb') as out:
-        out.write(pcap.read())
+    # api.get_capture reads the whole pcap into memory, stream it to disk
+    # through the api's HTTP session instead
+    response = OtgHttp(api).request(
+        "POST", "/monitor/capture", data=capture_req.serialize(), stream=True
+    )
+    with response:
+        if compress:
+            out = gzip.open(file_name, 'wb', compresslevel=1)
+        else:
+            out = open(file_name, 'wb')
+        with out:
+            for chunk in response.iter_content(chunk_size):
+                out.write(chunk)
+    return file_name
+
+def get_captures(api, port_names=None, directory=".", compress=False, max_workers=4):
+    """
+    Fetches the captures of `port_names`, by default every port of the
+    configured captures, at most `max_workers` at a time, into
+    `<directory>/<port>.pcap` (`.pcap.gz` with `compress`). Returns the file
+    names by port name.
+    """
+    if port_names is None:
+        port_names = [p for c in api.get_config().captures for p in c.port_names]
+    suffix = ".pcap.gz" if compress else ".pcap"
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        files = dict(
+            (p, pool.submit(get_capture, api, p, os.path.join(directory, p + suffix), compress))
+            for p in port_names
+        )
+        return dict((p, f.result()) for p, f in files.items())
+
 
-def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None):
+# instrumentation the traffic engine appends to every frame of a flow with
+# metrics enabled, followed by the 4 byte PGID, sequence number and timestamp
+IXIA_SIGNATURE = bytes([0x87, 0x73, 0x67, 0x49, 0x42, 0x87, 0x11, 0x80, 0x08, 0x71, 0x18, 0x05])
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+
+
+def iter_pcap_columns(path, flows, chunk_records=65536):
+    """
+    Memory-maps the pcap at `path` and yields its records decoded into
+    columns, `chunk_records` records per chunk, so memory does not grow
+    with the capture size:
+
+    - timestamp: capture time in seconds
+    - flow: index into `flows`, a list of flow names extended in place as
+            new Ethernet/IPv4/IPv6/TCP/UDP flows are seen
+    - seq: instrumentation sequence number, -1 for frames without one
+
+    Every chunk also counts under "skipped" the records it left out: runts
+    too short for an Ethernet header and a last record cut short by the
+    end of the file. Frames cut inside their IP header count as frames of
+    their ethertype. The fields are read straight out of the map with
+    struct, without copying headers, but the loop over the records is
+    Python, a few hundred thousand records per second.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < 24:
+            raise Exception("%s is not a pcap file" % path)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:4] not in PCAP_MAGIC:
+                raise Exception("%s is not a pcap file" % path)
+            endian, resolution = PCAP_MAGIC[mm[:4]]
+            if struct.unpack_from(endian + "I", mm, 20)[0] != 1:
+                raise Exception("%s is not an Ethernet capture" % path)
+            for columns in _pcap_chunks(mm, endian, resolution, flows, chunk_records):
+                yield columns
+
+
+def _pcap_chunks(mm, endian, resolution, flows, chunk_records):
+    record = struct.Struct(endian + "IIII").unpack_from
+    ethertype_at = struct.Struct(">H").unpack_from
+    ipv4 = struct.Struct(">B8xB2xII").unpack_from
+    ipv6 = struct.Struct(">6xBx16s16s").unpack_from
+    ports = struct.Struct(">HH").unpack_from
+    seq_at = struct.Struct(">I").unpack_from
+    find = mm.find
+    index = dict((name, i) for i, name in enumerate(flows))
+    size = len(mm)
+    offset = 24
+    while offset + 16 <= size:
+        timestamps, flow_column, seqs = array.array("d"), array.array("I"), array.array("q")
+        add_timestamp, add_flow, add_seq = timestamps.append, flow_column.append, seqs.append
+        skipped = 0
+        count = 0
+        while offset + 16 <= size and count < chunk_records:
+            sec, frac, incl_len, _ = record(mm, offset)
+            p = offset + 16
+            end = p + incl_len
+            offset = end
+            if end > size or incl_len < 14:
+                skipped += 1
+                continue
+
+            ethertype = ethertype_at(mm, p + 12)[0]
+            l3 = p + 14
+            while (ethertype == 0x8100 or ethertype == 0x88A8) and l3 + 4 <= end:
+                ethertype = ethertype_at(mm, l3 + 2)[0]
+                l3 += 4
+            if ethertype == 0x0800 and l3 + 20 <= end:
+                version_ihl, proto, src, dst = ipv4(mm, l3)
+                l4 = l3 + (version_ihl & 0x0F) * 4
+            elif ethertype == 0x86DD and l3 + 40 <= end:
+                proto, src, dst = ipv6(mm, l3)
+                l4 = l3 + 40
+            else:
+                proto, src, dst, l4 = None, ethertype, None, end
+            if (proto == 6 or proto == 17) and l4 + 4 <= end:
+                sport, dport = ports(mm, l4)
+            else:
+                sport, dport = 0, 0
+
+            key = (src, dst, proto, sport, dport)
+            flow = index.get(key)
+            if flow is None:
+                flow = index[key] = len(flows)
+                flows.append(_pcap_flow_name(key))
+
+            sig = find(IXIA_SIGNATURE, l4, end)
+            add_timestamp(sec + frac * resolution)
+            add_flow(flow)
+            add_seq(seq_at(mm, sig + 16)[0] if 0 <= sig and sig + 20 <= end else -1)
+            count += 1
+        yield {"timestamp": timestamps, "flow": flow_column, "seq": seqs, "skipped": skipped}
+
+
+def _pcap_flow_name(key):
+    src, dst, proto, sport, dport = key
+    if proto is None:
+        return "ethertype 0x%04x" % src
+    name = {6: "tcp", 17: "udp"}.get(proto, "proto %d" % proto)
+    src, dst = ipaddress.ip_address(src), ipaddress.ip_address(dst)
+    if proto in (6, 17):
+        return "%s %s:%d > %s:%d" % (name, src, sport, dst, dport)
+    return "%s %s > %s" % (name, src, dst)
+
+
+def analyze_capture(path, expected_packets=None, gap_factor=10):
+    """
+    Per flow loss, duplicates, reordering and gaps of the frames received in
+    the capture at `path`. Port captures only hold received frames, so loss
+    is derived from the instrumentation sequence numbers: a flow is expected
+    to carry sequence numbers 0 up to its highest one seen, or up to
+    `expected_packets` when given. Gaps are runs of missing sequence numbers
+    bracketed by the arrival times around them or, for frames without
+    instrumentation, inter-arrival times above `gap_factor` times the mean.
+    """
+    flows = []
+    stats = []
+    skipped = 0
+    for columns in iter_pcap_columns(path, flows):
+        skipped += columns["skipped"]
+        while len(stats) < len(flows):
+            stats.append(
+                {
+                    "received": 0, "duplicates": 0, "reordered": 0, "max_seq": -1,
+                    "seen": bytearray(), "last": None, "mean": 0.0, "gaps": [],
+                }
+            )
+        for ts, flow, seq in zip(columns["timestamp"], columns["flow"], columns["seq"]):
+            s = stats[flow]
+            s["received"] += 1
+            last = s["last"]
+            s["last"] = ts
+            if seq < 0:
+                if last is not None:
+                    gap = ts - last
+                    if s["received"] > 10 and gap > gap_factor * s["mean"]:
+                        s["gaps"].append((last, ts, None))
+                    s["mean"] += (gap - s["mean"]) / (s["received"] - 1)
+                continue
+
+            seen = s["seen"]
+            if seq >> 3 >= len(seen):
+                seen.extend(bytes((seq >> 3) + 1 - len(seen)))
+            bit = 1 << (seq & 7)
+            if seen[seq >> 3] & bit:
+                s["duplicates"] += 1
+                continue
+            seen[seq >> 3] |= bit
+            if seq < s["max_seq"]:
+                s["reordered"] += 1
+            elif seq > s["max_seq"] + 1 and last is not None:
+                s["gaps"].append((last, ts, (s["max_seq"] + 1, seq)))
+            s["max_seq"] = max(s["max_seq"], seq)
+    if skipped:
+        print("%s Skipped %d runt or truncated records of %s" % (datetime.now(), skipped, path))
+
+    results = []
+    for name, s in zip(flows, stats):
+        seen = s["seen"]
+        unique = s["received"] - s["duplicates"]
+        expected = s["max_seq"] + 1 if expected_packets is None else expected_packets
+        gaps = []
+        for start, end, missing in s["gaps"]:
+            # reordered frames may have filled a gap after it was opened
+            if missing is None or any(not seen[i >> 3] & (1 << (i & 7)) for i in range(*missing)):
+                gaps.append((start, end))
+        results.append(
+            {
+                "flow": name,
+                "received": s["received"],
+                "lost": max(0, expected - unique) if seen else None,
+                "duplicates": s["duplicates"],
+                "reordered": s["reordered"],
+                "gaps": gaps,
+            }
+        )
+    return results
+
+
+def print_capture_analysis(path, expected_packets=None):
+    print("%s Analyzing capture %s    ..." % (datetime.now(), path))
+    results = analyze_capture(path, expected_packets)
+    tb = Table(
+        "Capture %s" % path,
+        ["Received", "Lost", "Duplicates", "Reordered", "Gaps", "Longest Gap", "Flow"],
+    )
+    for r in results:
+        longest = max([end - start for start, end in r["gaps"]] or [0])
+        tb.append_row(
+            [
+                r["received"],
+                "n/a" if r["lost"] is None else r["lost"],
+                r["duplicates"],
+                r["reordered"],
+                len(r["gaps"]),
+                "%.6fs" % longest,
+                r["flow"],
+            ]
+        )
+    print(tb)
+    return results
+
+
+class RouteIndex(object):
+    """
+    Expected BGP prefixes of `config`. Every configured route range is kept
+    as an integer interval of `count` network addresses `step` networks
+    apart instead of one entry per route, so a range of 1M routes costs the
+    same as a single route.
+
+    `diff(shards)` matches the learned prefixes of `iter_bgp_prefixes`
+    against the ranges shard by shard, keeping one byte per configured route
+    rather than the learned prefixes, and returns:
+    - "missing": `(first prefix, count, step)` runs of configured routes no
+      peer has learned
+    - "extra": learned prefixes outside of every configured range
+    - "wrong_next_hop": `(prefix, expected, learned)` for routes learned with
+      another next hop than the manual one configured
+    """
+
+    def __init__(self, config):
+        self.ranges = {"ipv4": [], "ipv6": []}
+        self.peer_names = bgp_peer_names(config)
+        for d in config.devices:
+            for intf in list(d.bgp.ipv4_interfaces) + list(d.bgp.ipv6_interfaces):
+                for peer in intf.peers:
+                    for family, routes in [("ipv4", peer.v4_routes), ("ipv6", peer.v6_routes)]:
+                        for r in routes:
+                            next_hop = None
+                            if r.next_hop_mode == r.MANUAL:
+                                if r.next_hop_address_type == r.IPV4:
+                                    next_hop = r.next_hop_ipv4_address
+                                else:
+                                    next_hop = r.next_hop_ipv6_address
+                                # learned next hops are reported compressed
+                                next_hop = ipaddress.ip_address(next_hop).compressed
+                            for a in r.addresses:
+                                self.add(family, a.address, a.prefix, a.count, a.step, next_hop)
+
+    def add(self, family, address, prefix, count=1, step=1, next_hop=None):
+        shift = (32 if family == "ipv4" else 128) - prefix
+        network = int(ipaddress.ip_address(address)) >> shift << shift
+        self.ranges[family].append((network, step << shift, count, prefix, next_hop))
+
+    def diff(self, shards):
+        result = {"missing": [], "extra": [], "wrong_next_hop": []}
+        # one byte per configured route, set once any peer has learned it
+        seen = dict(
+            (family, [bytearray(r[2]) for r in ranges]) for family, ranges in self.ranges.items()
+        )
+        for _, family, prefixes in shards:
+            af = socket.AF_INET if family == "ipv4" else socket.AF_INET6
+            # parse and sort with C level maps, a python loop per prefix is
+            # what makes a 1M route check take seconds
+            addresses = list(
+                map(
+                    int.from_bytes,
+                    map(
+                        functools.partial(socket.inet_pton, af),
+                        map(operator.itemgetter(family + "_address"), prefixes),
+                    ),
+                    itertools.repeat("big"),
+                )
+            )
+            lengths = list(map(operator.itemgetter("prefix_length"), prefixes))
+            # the next hop is left out of prefixes learned without one
+            next_hops = list(map(operator.methodcaller("get", family + "_next_hop"), prefixes))
+            if any(map(operator.gt, addresses, addresses[1:])):
+                order = sorted(range(len(addresses)), key=addresses.__getitem__)
+                addresses = list(map(addresses.__getitem__, order))
+                lengths = list(map(lengths.__getitem__, order))
+                next_hops = list(map(next_hops.__getitem__, order))
+            self._match(family, addresses, lengths, next_hops, seen[family], result)
+
+        for family, ranges in self.ranges.items():
+            for (start, stride, count, prefix, _), learned in zip(ranges, seen[family]):
+                step = stride >> ((32 if family == "ipv4" else 128) - prefix)
+                end = 0
+                while True:
+                    begin = learned.find(0, end)
+                    if begin < 0:
+                        break
+                    end = learned.find(1, begin)
+                    if end < 0:
+                        end = count
+                    result["missing"].append(
+                        (_prefix_str(family, start + begin * stride, prefix), end - begin, step)
+                    )
+        return result
+
+    def _match(self, family, addresses, lengths, next_hops, seen, result):
+        matched = []
+        for (start, stride, count, prefix, next_hop), learned in zip(self.ranges[family], seen):
+            last = start + (count - 1) * stride
+            lo = bisect.bisect_left(addresses, start)
+            hi = bisect.bisect_right(addresses, last, lo)
+            if lo == hi:
+                continue
+
+            first = (addresses[lo] - start) // stride
+            n = hi - lo
+            if (
+                addresses[lo:hi] == list(range(start + first * stride, start + (first + n) * stride, stride))
+                and lengths[lo:hi].count(prefix) == n
+            ):
+                # a run of consecutive routes of the range, nothing in between
+                found = range(lo, hi)
+                learned[first : first + n] = b"\x01" * n
+            else:
+                found = []
+                for i in range(lo, hi):
+                    offset, rest = divmod(addresses[i] - start, stride)
+                    if rest == 0 and lengths[i] == prefix:
+                        learned[offset] = 1
+                        found.append(i)
+            matched.append(found)
+
+            if next_hop is not None and next_hops[lo:hi].count(next_hop) != n:
+                for i in found:
+                    if next_hops[i] != next_hop:
+                        result["wrong_next_hop"].append(
+                            (_prefix_str(family, addresses[i], prefix), next_hop, next_hops[i])
+                        )
+
+        if sum(map(len, matched)) != len(addresses):
+            unmatched = set(range(len(addresses))).difference(*matched)
+            result["extra"].extend(
+                _prefix_str(family, addresses[i], lengths[i]) for i in sorted(unmatched)
+            )
+
+
+def _prefix_str(family, address, prefix):
+    if family == "ipv4":
+        address = ipaddress.IPv4Address(address)
+    else:
+        address = ipaddress.IPv6Address(address)
+    return "%s/%d" % (address, prefix)
+
+class MetricsCache(object):
+    """
+    Shares controller metrics and states between all predicates polled in the
+    same tick. `get(kind)` fetches a kind at most once per snapshot. A
+    snapshot is stamped with `timestamp` once its first fetch returned, and
+    the first `get` after it is older than `ttl_seconds` starts a new one, so
+    a fetch slower than `ttl_seconds` is still shared by the predicates
+    polled right after it.
+    """
+
+    def __init__(self, api, ttl_seconds=0.25):
+        self.api = api
+        self.ttl_seconds = ttl_seconds
+        self.timestamp = None
+        self.fetchers = {
+            "flow": get_flow_metrics,
+            "bgpv4": get_bgpv4_metrics,
+            "route_index": lambda api: RouteIndex(api.get_config()),
+            "bgp_prefix_diff": self._bgp_prefix_diff,
+        }
+        # kinds that do not change while polling, fetched once
+        self.pinned = set(["route_index"])
+        self._values = {}
+        self._lock = threading.Lock()
+        self._kind_locks = {}
+        self._latest = {}
+
+    def get(self, kind):
+        # predicates run concurrently under wait_for_all, only one of them
+        # should hit the controller for a given kind while different kinds
+        # are fetched concurrently
+        with self._lock:
+            # a snapshot still fetching has no timestamp yet and never expires
+            if self.timestamp is not None and time.monotonic() - self.timestamp > self.ttl_seconds:
+                self.timestamp = None
+                self._values = dict(
+                    (k, v) for k, v in self._values.items() if k in self.pinned
+                )
+            values = self._values
+            if kind in values:
+                return values[kind]
+            lock = self._kind_locks.setdefault(kind, threading.Lock())
+        with lock:
+            if kind not in values:
+                value = self.fetchers[kind](self.api)
+                fetched = time.monotonic()
+                values[kind] = value
+                self._latest[kind] = (fetched, value)
+                with self._lock:
+                    if self.timestamp is None and values is self._values:
+                        self.timestamp = fetched
+            return values[kind]
+
+    def _bgp_prefix_diff(self, api):
+        index = self.get("route_index")
+        return index.diff(iter_bgp_prefixes(api, index.peer_names))
+
+    def latest(self, kind):
+        # the last `(timestamp, value)` fetched of `kind` or None, without
+        # fetching, for the eta predictions and failure watches of wait_for
+        return self._latest.get(kind)
+
+
+class TrafficEta(object):
+    """
+    Predicts how many seconds are left until transmit ends, to pass as the
+    `eta` of wait_for. The end is first taken from the configured duration,
+    `packets` at `pps` or `seconds`, counted from when the TrafficEta is
+    created, so create it right after start_transmit. Once `metrics` returns
+    the latest `(timestamp, flow metrics)` with flows sending, the end moves
+    to when the slowest of them is done at its observed frames_tx_rate.
+    """
+
+    def __init__(self, metrics=None, packets=None, pps=None, seconds=None):
+        self.metrics = metrics
+        self.packets = packets
+        self.seconds = seconds if seconds is not None else packets / float(pps)
+        self.end = time.monotonic() + self.seconds
+
+    def __call__(self):
+        latest = None if self.metrics is None else self.metrics()
+        if latest is not None:
+            timestamp, metrics = latest
+            left = [
+                (self.packets - m.frames_tx) / m.frames_tx_rate
+                if self.packets is not None
+                else self.seconds - m.frames_tx / m.frames_tx_rate
+                for m in metrics
+                if m.transmit == m.STARTED and m.frames_tx_rate
+            ]
+            if left:
+                self.end = timestamp + max(left)
+        return self.end - time.monotonic()
+
+
+class SessionEta(object):
+    """
+    Predicts how many seconds are left until every BGP session is up from
+    the rate sessions came up at since the SessionEta was created, to pass
+    as the `eta` of wait_for; create it right after start_protocols.
+    `metrics` returns the latest `(timestamp, bgpv4 metrics)`. There is no
+    prediction until a session came up.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.monotonic()
+
+    def __call__(self):
+        latest = self.metrics()
+        if latest is None:
+            return None
+        timestamp, metrics = latest
+        up = sum(1 for m in metrics if m.session_state == m.UP)
+        if up == 0 or timestamp <= self.start:
+            return None
+        rate = up / (timestamp - self.start)
+        return timestamp + (len(metrics) - up) / rate - time.monotonic()
+
+
+def fail_fast(func, *watches):
+    """
+    Wraps a wait_for predicate so that the wait fails as soon as one of
+    `watches`, e.g. a FlowWatch, tells the condition can no longer turn
+    true, instead of at its timeout. A watch is called after every false
+    poll and returns a diagnosis string or None.
+    """
+
+    def check():
+        if func():
+            return True
+        for watch in watches:
+            diagnosis = watch()
+            if diagnosis is not None:
+                raise Exception("Stopped waiting early, %s" % diagnosis)
+        return False
+
+    return check
+
+
+class FlowWatch(object):
+    """
+    Spots flows that cannot reach the end their wait expects, for fail_fast.
+    `metrics` returns the latest `(timestamp, flow metrics)`. When every
+    flow is expected to deliver exactly `packets` frames, a flow is
+    diagnosed as soon as it
+    - sent or received more than `packets` frames
+    - stopped before sending `packets` frames
+    - stopped with frames missing and received nothing for `drain_seconds`
+
+    A flow that is started but sends nothing, or receives nothing while it
+    still sends, may recover, e.g. during a convergence test, so it is only
+    diagnosed once that lasted `stall_seconds`, counted from the first
+    metrics of the flow. The default is well above the sub-second outages
+    the convergence labs expect, pass None to leave stalls to the timeout of
+    the wait.
+    """
+
+    def __init__(self, metrics, packets=None, stall_seconds=10, drain_seconds=5):
+        self.metrics = metrics
+        self.packets = packets
+        self.stall_seconds = stall_seconds
+        self.drain_seconds = drain_seconds
+        self.timestamp = None
+        # flow name -> [frames_tx, tx changed at, frames_rx, rx changed at]
+        self.flows = {}
+
+    def __call__(self):
+        latest = self.metrics()
+        if latest is None or latest[0] == self.timestamp:
+            return None
+        self.timestamp, metrics = latest
+        now = self.timestamp
+        for m in metrics:
+            seen = self.flows.setdefault(m.name, [m.frames_tx, now, m.frames_rx, now])
+            if m.frames_tx != seen[0]:
+                seen[0:2] = [m.frames_tx, now]
+            if m.frames_rx != seen[2]:
+                seen[2:4] = [m.frames_rx, now]
+
+            if self.stall_seconds is not None and m.transmit == m.STARTED:
+                if now - seen[1] >= self.stall_seconds:
+                    return "flow %s is started but sent no frames for %.1fs (frames_tx %d)" % (
+                        m.name,
+                        now - seen[1],
+                        m.frames_tx,
+                    )
+                if m.frames_rx < m.frames_tx and now - seen[3] >= self.stall_seconds:
+                    return "flow %s received no frames for %.1fs, %d of %d sent frames missing" % (
+                        m.name,
+                        now - seen[3],
+                        m.frames_tx - m.frames_rx,
+                        m.frames_tx,
+                    )
+            if self.packets is None:
+                continue
+            if m.frames_tx > self.packets or m.frames_rx > self.packets:
+                return "flow %s sent %d and received %d frames, more than the %d configured" % (
+                    m.name,
+                    m.frames_tx,
+                    m.frames_rx,
+                    self.packets,
+                )
+            if m.transmit == m.STOPPED and 0 < m.frames_tx < self.packets:
+                return "flow %s stopped after sending %d of %d frames" % (
+                    m.name,
+                    m.frames_tx,
+                    self.packets,
+                )
+            if (
+                m.transmit == m.STOPPED
+                and m.frames_rx < m.frames_tx
+                and now - max(seen[1], seen[3]) >= self.drain_seconds
+            ):
+                return "flow %s stopped and received nothing for %.1fs, %d of %d sent frames missing" % (
+                    m.name,
+                    now - max(seen[1], seen[3]),
+                    m.frames_tx - m.frames_rx,
+                    m.frames_tx,
+                )
+        return None
+
+
+class BgpWatch(object):
+    """
+    Spots BGP peering that cannot come up, for fail_fast. `metrics` returns
+    the latest `(timestamp, bgpv4 metrics)`. Peering is diagnosed once no
+    session state or route count of any peer changed for `stall_seconds`,
+    counted from the first metrics. That defaults to 30s, the default OTG
+    keepalive interval: long enough for a peer to answer an OPEN, and short
+    enough to end the 60s waits of the labs early. A session going down
+    after being up counts as a change like any other, so peering that flaps
+    is left to the timeout of the wait.
+    """
+
+    def __init__(self, metrics, stall_seconds=30):
+        self.metrics = metrics
+        self.stall_seconds = stall_seconds
+        self.state = None
+        self.changed = None
+        self.up = set()
+
+    def __call__(self):
+        latest = self.metrics()
+        if latest is None:
+            return None
+        timestamp, metrics = latest
+        self.up.update(m.name for m in metrics if m.session_state == m.UP)
+
+        state = [(m.name, m.session_state, m.routes_advertised, m.routes_received) for m in metrics]
+        if state != self.state:
+            self.changed = timestamp
+            self.state = state
+            return None
+        if timestamp - self.changed < self.stall_seconds:
+            return None
+        down = [
+            m.name + (" (up before)" if m.name in self.up else "")
+            for m in metrics
+            if m.session_state == m.DOWN
+        ]
+        if down:
+            return "BGP sessions %s down for %.1fs with %d routes received" % (
+                ", ".join(down),
+                timestamp - self.changed,
+                sum(m.routes_received for m in metrics),
+            )
+        return "BGP routes unchanged for %.1fs at %s (advertised/received)" % (
+            timestamp - self.changed,
+            ", ".join("%s %d/%d" % (m.name, m.routes_advertised, m.routes_received) for m in metrics),
+        )
+
+
+def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None, eta=None):
     """
     Keeps calling the `func` until it returns true or `timeout_seconds` occurs
     every `interval_seconds`. `condition_str` should be a constant string
-    implying the actual condition being tested.
+    implying the actual condition being tested. `eta`, e.g. a TrafficEta,
+    returns the predicted seconds until `func` turns true, see wait_for_all.
 
     Usage
     -----
@@ -505,29 +1977,92 @@ def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None):
         poll_until(condition_satisfied, condition_str, **kwargs)
     ```
     """
+    wait_for_all([(func, condition_str, timeout_seconds, eta)], interval_seconds)
+
+
+def wait_for_all(conditions, interval_seconds=None):
+    """
+    Waits for every `(func, condition_str, timeout_seconds)` in `conditions`
+    at the same time. Each `func` is polled on its own every
+    `interval_seconds` and stops being polled as soon as it returns true;
+    a condition that is still false after its own `timeout_seconds` raises
+    and cancels the others.
+
+    A condition can have a fourth item `eta`, a callable returning the
+    predicted seconds until `func` turns true or None when it cannot tell.
+    It is asked again after every poll. While a prediction is further out
+    than `interval_seconds` the condition is polled up to three intervals
+    apart until `interval_seconds` before it, so one bad prediction costs
+    little and the fail_fast watches of `func` keep running. From there it
+    is polled five times as often until one interval past the prediction,
+    then every `interval_seconds` again.
+
+    Usage
+    -----
+    ```
+    wait_for_all(
+        [
+            (lambda: bgp_metrics_ok(cache, tc), "correct bgp peering", 60),
+            (lambda: bgp_prefixes_ok(cache, tc), "correct bgp prefixes", 60),
+        ]
+    )
+    ```
+    """
     if interval_seconds is None:
-        interval_seconds = 1
+        interval_seconds = 0.5
+    asyncio.run(_wait_for_all(conditions, interval_seconds))
+
+
+async def _wait_for_all(conditions, interval_seconds):
+    tasks = [
+        asyncio.ensure_future(
+            _wait_for_condition(func, condition_str, interval_seconds, timeout_seconds, *eta)
+        )
+        for func, condition_str, timeout_seconds, *eta in conditions
+    ]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for t in pending:
+        t.cancel()
+    for t in done:
+        t.result()
+
+
+async def _wait_for_condition(func, condition_str, interval_seconds, timeout_seconds, eta=None):
     if timeout_seconds is None:
         timeout_seconds = 60
-    start_seconds = int(time.time())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_seconds
 
     print('\n\nWaiting for %s ...' % condition_str)
     while True:
-        if func():
+        # predicates do blocking controller calls, keep them off the event loop
+        if await loop.run_in_executor(None, func):
             print('Done waiting for %s' % condition_str)
-            break
-        if (int(time.time()) - start_seconds) >= timeout_seconds:
+            return
+        if loop.time() >= deadline:
             msg = 'Time out occurred while waiting for %s' % condition_str
             raise Exception(msg)
 
-        time.sleep(interval_seconds)
-    
+        await asyncio.sleep(min(_poll_delay(eta, interval_seconds), deadline - loop.time()))
+
+
+def _poll_delay(eta, interval_seconds):
+    remaining = None if eta is None else eta()
+    if remaining is None or remaining < -interval_seconds:
+        return interval_seconds
+    if remaining > interval_seconds:
+        # e.g. a frames_tx_rate sampled while the flows ramp up predicts an
+        # end far too late
+        return min(remaining - interval_seconds, 3 * interval_seconds)
+    return interval_seconds / 5
+
 
 class Table(object):
-    def __init__(self, title, headers, col_width=15):
+    def __init__(self, title, headers, col_width=15, max_rows=None):
         self.title = title
         self.headers = headers
         self.col_width = col_width
+        self.max_rows = max_rows
         self.rows = []
 
     def append_row(self, row):
@@ -537,28 +2072,45 @@ class Table(object):
 
         self.rows.append(row)
 
-    def __str__(self):
-        out = ""
+    def write(self, stream, chunk_rows=1000):
+        """
+        Writes the table to `stream`, `chunk_rows` rows per write. When
+        `max_rows` is set only the first `max_rows` rows are written followed
+        by a line summarizing how many were left out.
+        """
         border = "-" * (len(self.headers) * self.col_width)
+        # one format string per row length instead of one per cell
+        formats = {}
+        cell = "%%-%ds" % self.col_width
+
+        def row_format(n):
+            if n not in formats:
+                formats[n] = cell * n + "\n"
+            return formats[n]
+
+        stream.write("\n%s\n%s\n%s\n" % (border, self.title, border))
+        stream.write(row_format(len(self.headers)) % tuple(self.headers))
+
+        shown = len(self.rows)
+        if self.max_rows is not None and shown > self.max_rows:
+            shown = self.max_rows
+        for start in range(0, shown, chunk_rows):
+            end = min(start + chunk_rows, shown)
+            stream.write(
+                "".join(
+                    row_format(len(row)) % tuple(row) for row in self.rows[start:end]
+                )
+            )
+        if shown < len(self.rows):
+            stream.write("... %d more rows (%d total)\n" % (len(self.rows) - shown, len(self.rows)))
 
-        out += "\n"
-        out += border
-        out += "\n%s\n" % self.title
-        out += border
-        out += "\n"
-
-        for h in self.headers:
-            out += ("%%-%ds" % self.col_width) % str(h)
-        out += "\n"
-
-        for row in self.rows:
-            for r in row:
-                out += ("%%-%ds" % self.col_width) % str(r)
-            out += "\n"
-        out += border
-        out += "\n\n"
+        stream.write(border)
+        stream.write("\n\n")
 
-        return out
+    def __str__(self):
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
 
 
 if __name__ == "__main__":
@@ -2,6 +2,15 @@ import logging as log
 import snappi
 from datetime import datetime
 import time
+import asyncio
+import io
+import sys
+import threading
+import json
+import requests.adapters
+import os
+import hashlib
+import importlib.metadata
 
    
 def Test_ibgp_route_prefix():
@@ -18,17 +27,42 @@ def Test_ibgp_route_prefix():
         "2SubnetCount": 3
     }
 
-    api = snappi.api(location="https://clab-lab-03-controller:8443", verify=False)
+    api = pooled_api(location="https://clab-lab-03-controller:8443", verify=False)
+    tracer = ApiTracer(api)
+    timeline = PhaseTimeline("lab-03_traffic")
+    try:
     
-    c = otg_config(api, test_const)
-
-    api.set_config(c)
+        set_config_payload(api, cached_config(api, otg_config, test_const))
+        timeline.mark("set_config")
     
-    start_protocols(api)
+        start_protocols(api)
+        timeline.mark("start_protocols")
     
-    start_transmit(api)
+        start_transmit(api)
+        timeline.mark("start_transmit")
+        cache = MetricsCache(api)
+        eta = TrafficEta(
+            lambda: cache.latest("flow"), packets=test_const["pktCount"], pps=test_const["pktRate"]
+        )
     
-    wait_for(lambda: flow_metrics_ok(api, test_const), "flow metrics",2,90)
+        wait_for(
+            fail_fast(
+                lambda: flow_metrics_ok(cache, test_const),
+                FlowWatch(lambda: cache.latest("flow"), packets=test_const["pktCount"]),
+            ),
+            "flow metrics",
+            timeout_seconds=90,
+            eta=eta,
+        )
+        timeline.mark("traffic_stopped")
+    finally:
+        tracer.print_summary()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        trace = results_path("api-%s.trace.json" % stamp)
+        if trace is not None:
+            tracer.write_chrome_trace(trace, timeline)
+            timeline.write(results_path("%s-%s.phases.json" % (timeline.run, stamp)))
+    timeline.check()
 
 def otg_config(api, tc):
     c = api.config()
@@ -92,8 +126,507 @@ def otg_config(api, tc):
 
     return c
 
-def flow_metrics_ok(api, tc):
-    for m in get_flow_metrics(api):
+CONFIG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ac2-workshop", "configs")
+
+
+def cached_config(api, builder, tc, cache_dir=CONFIG_CACHE_DIR):
+    """
+    Returns the serialized config `builder(api, tc)` builds, from an on-disk
+    cache when the same config was built before. Entries are keyed by a hash
+    of `tc`, the builder name, the source of this script and the installed
+    snappi version, so editing the builders or upgrading snappi invalidates
+    them without any cleanup.
+    """
+    key = hashlib.sha256()
+    key.update(json.dumps(tc, sort_keys=True).encode())
+    key.update(builder.__name__.encode())
+    with open(os.path.abspath(__file__), "rb") as f:
+        key.update(f.read())
+    key.update(importlib.metadata.version("snappi").encode())
+    path = os.path.join(cache_dir, key.hexdigest() + ".json")
+
+    if os.path.exists(path):
+        print("%s Using cached config %s    ..." % (datetime.now(), path))
+        with open(path) as f:
+            return f.read()
+
+    c = builder(api, tc)
+    payload = c if isinstance(c, str) else c.serialize()
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename so a concurrent run never reads a partial entry
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+    return payload
+
+
+class OtgHttp(object):
+    """
+    The HTTP transport under a snappi api, for the requests the labs send
+    without snappi objects: posting serialized configs, streaming captures
+    and fetching prefix shards. `request` sends them with the api's location,
+    `verify` and timeout and raises the same errors as the snappi calls.
+
+    OtgHttp and PooledTransport are the only places that reach into snappi
+    internals: the api's `_transport`, its `_session` and
+    `_parse_response_error`, and the `send_recv` PooledTransport overrides.
+    They are trusted on the snappi releases in SNAPPI_VERSIONS and checked
+    for here on any other, before pooled_api creates a PooledTransport,
+    which fails with the installed release named rather than with an
+    AttributeError somewhere in a lab.
+    """
+
+    # [first, last) snappi releases the internals were checked against
+    SNAPPI_VERSIONS = ((1, 0), (2, 0))
+    snappi_checked = False
+
+    def __init__(self, api):
+        self.api = api
+        self.transport = api._transport
+        if not OtgHttp.snappi_checked:
+            self._check_snappi()
+            OtgHttp.snappi_checked = True
+        self.session = self.transport._session
+        self.location = self.transport.location
+
+    def _check_snappi(self):
+        version = importlib.metadata.version("snappi")
+        release = tuple(int(p) for p in version.split(".")[:2])
+        if self.SNAPPI_VERSIONS[0] <= release < self.SNAPPI_VERSIONS[1]:
+            return
+        needed = ["location", "verify", "_session", "_parse_response_error", "send_recv"]
+        missing = [a for a in needed if not hasattr(self.transport, a)]
+        if missing:
+            raise Exception(
+                "snappi %s is not supported, its HTTP transport has no %s; install snappi %s.x"
+                % (version, ", ".join(missing), self.SNAPPI_VERSIONS[0][0])
+            )
+
+    def set_transport(self, transport):
+        # replaces the transport of the api, e.g. by a PooledTransport
+        self.api._transport = transport
+        self.transport = transport
+        self.session = transport._session
+        self.location = transport.location
+
+    def request(self, method, path, headers=None, **kwargs):
+        response = self.session.request(
+            method,
+            self.location + path,
+            headers=headers or {"Content-Type": "application/json"},
+            verify=self.transport.verify,
+            timeout=getattr(self.transport, "timeout_seconds", None),
+            **kwargs
+        )
+        if not response.ok:
+            with response:
+                self.transport._parse_response_error(response.status_code, response.text)
+        return response
+
+
+class PooledTransport(snappi.snappi.HttpTransport):
+    """
+    HttpTransport tuned for polling loops: up to `pool_size` keep-alive
+    connections are reused, so TLS is negotiated once per connection rather
+    than per call, every request gives up after `timeout_seconds`, responses
+    are gzip encoded only when `compress` is set, and JSON responses are
+    decoded with json instead of yaml. The session is safe to share between
+    threads, so independent requests can run concurrently, see MetricsCache.
+    Unlike HttpTransport it sends requests with the `verify` it was created
+    with. It builds on the same HttpTransport internals as OtgHttp, so
+    create it through pooled_api, which checks them first.
+    """
+
+    # what pooled_api recognizes it by, every lab and every reload of a lab
+    # by tools/otg_worker.py has a PooledTransport class of its own
+    pooled = True
+
+    def __init__(self, pool_size=10, timeout_seconds=30, compress=False, **kwargs):
+        super(PooledTransport, self).__init__(**kwargs)
+        self.timeout_seconds = timeout_seconds
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # controllers are usually next to the script, where compressing costs
+        # more than it saves
+        self._session.headers["Accept-Encoding"] = "gzip" if compress else "identity"
+
+    def send_recv(
+        self,
+        method,
+        relative_url,
+        payload=None,
+        return_object=None,
+        headers=None,
+        request_class=None,
+    ):
+        headers = headers or {"Content-Type": "application/json"}
+        data = None
+        if isinstance(payload, bytes):
+            data = payload
+            headers["Content-Type"] = "application/octet-stream"
+        elif isinstance(payload, str):
+            if request_class is not None:
+                request_class().deserialize(payload)
+            data = payload
+        elif payload is not None:
+            data = payload.serialize()
+
+        response = self._session.request(
+            method=method,
+            url=self.location + relative_url,
+            data=data,
+            headers=headers,
+            verify=self.verify,
+            timeout=self.timeout_seconds,
+        )
+        if not response.ok:
+            self._parse_response_error(response.status_code, response.text)
+        content_type = response.headers.get("content-type", "")
+        if "application/json" in content_type:
+            if return_object is None:
+                return response.json()
+            return return_object.deserialize(response.json())
+        if "application/octet-stream" in content_type:
+            return io.BytesIO(response.content)
+        return response
+
+
+def pooled_api(location, verify=False, pool_size=10, timeout_seconds=30, compress=False):
+    """
+    `snappi.api` over a PooledTransport. An api that already has one, e.g.
+    a session handed out again by tools/otg_worker.py, is returned as is.
+    The transport keeps the location of the api `snappi.api` returns, so
+    tools that redirect `snappi.api`, such as tools/run_labs.py, redirect
+    this one as well.
+    """
+    api = snappi.api(location=location, verify=verify)
+    http = OtgHttp(api)
+    if not getattr(http.transport, "pooled", False):
+        http.set_transport(
+            PooledTransport(
+                location=http.location,
+                verify=verify,
+                pool_size=pool_size,
+                timeout_seconds=timeout_seconds,
+                compress=compress,
+            )
+        )
+    return api
+
+
+# ApiTracer and PhaseTimeline are the same in every lab script that traces
+# its runs, copied so each script still runs on its own. Change them in all
+# of them
+class ApiTracer(object):
+    """
+    Times every call of `api` listed in CALLS and every HTTP request made
+    through its session, including the ones under those calls. Each record
+    keeps its start, end, request and response size. The gap between a call
+    and the request under it is client side serialization, and the request
+    itself is controller latency plus transfer.
+
+    `print_summary()` prints per call type latency percentiles and sizes,
+    `histogram(name)` buckets one type by powers of two milliseconds and
+    `write_chrome_trace(path)` writes every record as a Chrome trace that
+    chrome://tracing or ui.perfetto.dev can open.
+    """
+
+    CALLS = [
+        "set_config",
+        "get_config",
+        "update_config",
+        "set_control_state",
+        "get_metrics",
+        "get_states",
+        "get_capture",
+    ]
+
+    def __init__(self, api):
+        self.api = api
+        self.origin = time.perf_counter()
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # an api handed out again by tools/otg_worker.py still carries the
+        # previous run's tracer, wrap what was there before it
+        untraced = api.__dict__.setdefault("_untraced", {})
+        for name in self.CALLS:
+            untraced.setdefault(name, getattr(api, name))
+            setattr(api, name, self._traced_call(name, untraced[name]))
+        session = OtgHttp(api).session
+        untraced.setdefault("request", session.request)
+        session.request = self._traced_request(untraced["request"])
+
+    def _traced_call(self, name, call):
+        def traced(*args, **kwargs):
+            record = {"cat": "api", "name": name, "request_bytes": 0, "response_bytes": 0}
+            self._local.call = record
+            record["start"] = time.perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                record["end"] = time.perf_counter()
+                self._local.call = None
+                self._add(record)
+
+        return traced
+
+    def _traced_request(self, request):
+        def traced(method, url, **kwargs):
+            path = url.split("://", 1)[-1].partition("/")[2]
+            data = kwargs.get("data")
+            record = {
+                "cat": "http",
+                "name": "%s /%s" % (method.upper(), path),
+                "request_bytes": len(data) if data is not None else 0,
+                "response_bytes": 0,
+            }
+            record["start"] = time.perf_counter()
+            try:
+                response = request(method, url, **kwargs)
+                if kwargs.get("stream"):
+                    # the body is read by the caller after this returns
+                    record["response_bytes"] = int(response.headers.get("Content-Length", 0))
+                else:
+                    record["response_bytes"] = len(response.content)
+                return response
+            finally:
+                record["end"] = time.perf_counter()
+                call = getattr(self._local, "call", None)
+                if call is not None:
+                    call["request_bytes"] += record["request_bytes"]
+                    call["response_bytes"] += record["response_bytes"]
+                self._add(record)
+
+        return traced
+
+    def _add(self, record):
+        record["tid"] = threading.get_ident()
+        with self._lock:
+            self.records.append(record)
+
+    def durations(self, name):
+        with self._lock:
+            return sorted(r["end"] - r["start"] for r in self.records if r["name"] == name)
+
+    def histogram(self, name):
+        # upper bound in ms -> count, 1, 2, 4, ...
+        buckets = {}
+        for d in self.durations(name):
+            bound = 1
+            while bound < d * 1000:
+                bound *= 2
+            buckets[bound] = buckets.get(bound, 0) + 1
+        return dict(sorted(buckets.items()))
+
+    def print_summary(self):
+        with self._lock:
+            records = list(self.records)
+        calls = {}
+        for r in records:
+            calls.setdefault((r["cat"] != "api", r["name"]), []).append(r)
+
+        tb = Table(
+            "API Calls",
+            ["Count", "p50 ms", "p90 ms", "Max ms", "Total ms", "Req KB", "Resp KB", "Call"],
+            10,
+        )
+        for (_, name), rs in sorted(calls.items()):
+            d = sorted(r["end"] - r["start"] for r in rs)
+            tb.append_row(
+                [
+                    len(d),
+                    "%.1f" % (d[len(d) // 2] * 1000),
+                    "%.1f" % (d[len(d) * 9 // 10] * 1000),
+                    "%.1f" % (d[-1] * 1000),
+                    "%.1f" % (sum(d) * 1000),
+                    "%.1f" % (sum(r["request_bytes"] for r in rs) / 1024.0),
+                    "%.1f" % (sum(r["response_bytes"] for r in rs) / 1024.0),
+                    name,
+                ]
+            )
+        tb.write(sys.stdout)
+
+    def write_chrome_trace(self, path, timeline=None):
+        """
+        `timeline`, a PhaseTimeline of the same run, adds its phases on a
+        track of their own above the calls.
+        """
+        with self._lock:
+            records = list(self.records)
+        pid = os.getpid()
+        events = []
+        if timeline is not None:
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": 0, "args": {"name": "phases"}})
+            for p in timeline.phases:
+                events.append(
+                    {
+                        "ph": "X",
+                        "cat": "phase",
+                        "name": p["name"],
+                        "pid": pid,
+                        "tid": 0,
+                        "ts": (timeline.origin + p["start"] - self.origin) * 1e6,
+                        "dur": p["seconds"] * 1e6,
+                    }
+                )
+        for tid in sorted(set(r["tid"] for r in records)):
+            for t in threading.enumerate():
+                if t.ident == tid:
+                    events.append(
+                        {"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": t.name}}
+                    )
+        for r in records:
+            events.append(
+                {
+                    "ph": "X",
+                    "cat": r["cat"],
+                    "name": r["name"],
+                    "pid": pid,
+                    "tid": r["tid"],
+                    "ts": (r["start"] - self.origin) * 1e6,
+                    "dur": (r["end"] - r["start"]) * 1e6,
+                    "args": {
+                        "request_bytes": r["request_bytes"],
+                        "response_bytes": r["response_bytes"],
+                    },
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+# baselines of PhaseTimeline.check, outside the lab directories
+PHASE_BASELINE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ac2-workshop", "phases")
+# directory the API traces, phases and metric recordings of a run are
+# written to, tools/run_labs.py sets it per test. Nothing is kept when unset
+RESULTS_DIR_ENV = "OTG_RESULTS_DIR"
+
+
+def results_path(name):
+    # `name` in the results directory, None when runs keep no files
+    results_dir = os.environ.get(RESULTS_DIR_ENV)
+    if not results_dir:
+        return None
+    os.makedirs(results_dir, exist_ok=True)
+    return os.path.join(results_dir, name)
+
+
+class PhaseTimeline(object):
+    """
+    Marks the phases of a test run, e.g. set_config, start_protocols, bgp_up.
+    `mark(name)` ends a phase that started at the previous mark. `until(func,
+    name)` wraps a wait_for predicate so that its phase ends the first time
+    the predicate holds, which times conditions polled together under
+    wait_for_all separately.
+
+    `write(path)` saves the phases as JSON and `check()` compares them
+    against the baseline run of the same script and run name saved under
+    PHASE_BASELINE_DIR, or at `path` when given. A phase that took more than
+    `tolerance` longer and at least `slack_seconds` more than there is
+    reported as regressed, and raises only with `fail`, timings of a shared
+    lab are too noisy to fail a functional test on by default. With no
+    baseline yet the run is saved as the baseline.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.started = datetime.now()
+        self.origin = time.perf_counter()
+        self.phases = []
+        self._last = self.origin
+        self._lock = threading.Lock()
+
+    def _add(self, name, start, end):
+        with self._lock:
+            self.phases.append(
+                {
+                    "name": name,
+                    "start": start - self.origin,
+                    "end": end - self.origin,
+                    "seconds": end - start,
+                }
+            )
+            self._last = max(self._last, end)
+
+    def mark(self, name):
+        self._add(name, self._last, time.perf_counter())
+
+    def until(self, func, name):
+        start = self._last
+        done = []
+
+        def predicate():
+            ok = func()
+            if ok and not done:
+                done.append(True)
+                self._add(name, start, time.perf_counter())
+            return ok
+
+        return predicate
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "run": self.run,
+                    "started": self.started.isoformat(),
+                    "phases": self.phases,
+                },
+                f,
+                indent=2,
+            )
+        return path
+
+    def check(self, path=None, tolerance=0.25, slack_seconds=0.5, fail=False):
+        if path is None:
+            script = os.path.splitext(os.path.basename(__file__))[0]
+            path = os.path.join(PHASE_BASELINE_DIR, "%s.%s.json" % (script, self.run))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.write(path)
+            print("%s No phase baseline yet, saved this run to %s" % (datetime.now(), path))
+            return
+        with open(path) as f:
+            baseline = dict((p["name"], p["seconds"]) for p in json.load(f)["phases"])
+
+        tb = Table("Phases vs %s" % path, ["Baseline s", "Run s", "Change", "Status", "Phase"])
+        regressions = []
+        for p in self.phases:
+            base = baseline.get(p["name"])
+            if base is None:
+                tb.append_row(["_", "%.3f" % p["seconds"], "_", "new", p["name"]])
+                continue
+            status = "ok"
+            if p["seconds"] > base * (1 + tolerance) and p["seconds"] - base >= slack_seconds:
+                status = "REGRESSED"
+                regressions.append(p["name"])
+            change = "_" if base == 0 else "%+.0f%%" % ((p["seconds"] / base - 1) * 100)
+            tb.append_row(["%.3f" % base, "%.3f" % p["seconds"], change, status, p["name"]])
+        tb.write(sys.stdout)
+
+        if regressions:
+            message = "Phases slower than %s: %s" % (path, ", ".join(regressions))
+            if fail:
+                raise Exception(message)
+            print("%s %s" % (datetime.now(), message))
+
+
+def set_config_payload(api, payload):
+    """
+    POSTs an already serialized config, such as the ones cached_config
+    returns. `api.set_config` deserializes string payloads into snappi
+    objects to validate them, which is the cost the cache avoids, so the
+    request goes through the api's HTTP session directly.
+    """
+    OtgHttp(api).request("POST", "/config", data=payload).close()
+
+
+def flow_metrics_ok(cache, tc):
+    for m in cache.get("flow"):
         if (
             m.transmit != m.STOPPED
             or m.frames_tx != tc["pktCount"]
@@ -187,11 +720,200 @@ def stop_transmit(api):
     cs.traffic.flow_transmit.state = cs.traffic.flow_transmit.STOP
     api.set_control_state(cs)
 
-def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None):
+
+class MetricsCache(object):
+    """
+    Shares controller metrics and states between all predicates polled in the
+    same tick. `get(kind)` fetches a kind at most once per snapshot. A
+    snapshot is stamped with `timestamp` once its first fetch returned, and
+    the first `get` after it is older than `ttl_seconds` starts a new one, so
+    a fetch slower than `ttl_seconds` is still shared by the predicates
+    polled right after it.
+    """
+
+    def __init__(self, api, ttl_seconds=0.25):
+        self.api = api
+        self.ttl_seconds = ttl_seconds
+        self.timestamp = None
+        self.fetchers = {
+            "flow": get_flow_metrics,
+        }
+        self._values = {}
+        self._lock = threading.Lock()
+        self._kind_locks = {}
+        self._latest = {}
+
+    def get(self, kind):
+        # predicates run concurrently under wait_for_all, only one of them
+        # should hit the controller for a given kind while different kinds
+        # are fetched concurrently
+        with self._lock:
+            # a snapshot still fetching has no timestamp yet and never expires
+            if self.timestamp is not None and time.monotonic() - self.timestamp > self.ttl_seconds:
+                self.timestamp = None
+                self._values = {}
+            values = self._values
+            if kind in values:
+                return values[kind]
+            lock = self._kind_locks.setdefault(kind, threading.Lock())
+        with lock:
+            if kind not in values:
+                value = self.fetchers[kind](self.api)
+                fetched = time.monotonic()
+                values[kind] = value
+                self._latest[kind] = (fetched, value)
+                with self._lock:
+                    if self.timestamp is None and values is self._values:
+                        self.timestamp = fetched
+            return values[kind]
+
+    def latest(self, kind):
+        # the last `(timestamp, value)` fetched of `kind` or None, without
+        # fetching, for the eta predictions and failure watches of wait_for
+        return self._latest.get(kind)
+
+
+class TrafficEta(object):
+    """
+    Predicts how many seconds are left until transmit ends, to pass as the
+    `eta` of wait_for. The end is first taken from the configured duration,
+    `packets` at `pps` or `seconds`, counted from when the TrafficEta is
+    created, so create it right after start_transmit. Once `metrics` returns
+    the latest `(timestamp, flow metrics)` with flows sending, the end moves
+    to when the slowest of them is done at its observed frames_tx_rate.
+    """
+
+    def __init__(self, metrics=None, packets=None, pps=None, seconds=None):
+        self.metrics = metrics
+        self.packets = packets
+        self.seconds = seconds if seconds is not None else packets / float(pps)
+        self.end = time.monotonic() + self.seconds
+
+    def __call__(self):
+        latest = None if self.metrics is None else self.metrics()
+        if latest is not None:
+            timestamp, metrics = latest
+            left = [
+                (self.packets - m.frames_tx) / m.frames_tx_rate
+                if self.packets is not None
+                else self.seconds - m.frames_tx / m.frames_tx_rate
+                for m in metrics
+                if m.transmit == m.STARTED and m.frames_tx_rate
+            ]
+            if left:
+                self.end = timestamp + max(left)
+        return self.end - time.monotonic()
+
+
+def fail_fast(func, *watches):
+    """
+    Wraps a wait_for predicate so that the wait fails as soon as one of
+    `watches`, e.g. a FlowWatch, tells the condition can no longer turn
+    true, instead of at its timeout. A watch is called after every false
+    poll and returns a diagnosis string or None.
+    """
+
+    def check():
+        if func():
+            return True
+        for watch in watches:
+            diagnosis = watch()
+            if diagnosis is not None:
+                raise Exception("Stopped waiting early, %s" % diagnosis)
+        return False
+
+    return check
+
+
+class FlowWatch(object):
+    """
+    Spots flows that cannot reach the end their wait expects, for fail_fast.
+    `metrics` returns the latest `(timestamp, flow metrics)`. When every
+    flow is expected to deliver exactly `packets` frames, a flow is
+    diagnosed as soon as it
+    - sent or received more than `packets` frames
+    - stopped before sending `packets` frames
+    - stopped with frames missing and received nothing for `drain_seconds`
+
+    A flow that is started but sends nothing, or receives nothing while it
+    still sends, may recover, e.g. during a convergence test, so it is only
+    diagnosed once that lasted `stall_seconds`, counted from the first
+    metrics of the flow. The default is well above the sub-second outages
+    the convergence labs expect, pass None to leave stalls to the timeout of
+    the wait.
+    """
+
+    def __init__(self, metrics, packets=None, stall_seconds=10, drain_seconds=5):
+        self.metrics = metrics
+        self.packets = packets
+        self.stall_seconds = stall_seconds
+        self.drain_seconds = drain_seconds
+        self.timestamp = None
+        # flow name -> [frames_tx, tx changed at, frames_rx, rx changed at]
+        self.flows = {}
+
+    def __call__(self):
+        latest = self.metrics()
+        if latest is None or latest[0] == self.timestamp:
+            return None
+        self.timestamp, metrics = latest
+        now = self.timestamp
+        for m in metrics:
+            seen = self.flows.setdefault(m.name, [m.frames_tx, now, m.frames_rx, now])
+            if m.frames_tx != seen[0]:
+                seen[0:2] = [m.frames_tx, now]
+            if m.frames_rx != seen[2]:
+                seen[2:4] = [m.frames_rx, now]
+
+            if self.stall_seconds is not None and m.transmit == m.STARTED:
+                if now - seen[1] >= self.stall_seconds:
+                    return "flow %s is started but sent no frames for %.1fs (frames_tx %d)" % (
+                        m.name,
+                        now - seen[1],
+                        m.frames_tx,
+                    )
+                if m.frames_rx < m.frames_tx and now - seen[3] >= self.stall_seconds:
+                    return "flow %s received no frames for %.1fs, %d of %d sent frames missing" % (
+                        m.name,
+                        now - seen[3],
+                        m.frames_tx - m.frames_rx,
+                        m.frames_tx,
+                    )
+            if self.packets is None:
+                continue
+            if m.frames_tx > self.packets or m.frames_rx > self.packets:
+                return "flow %s sent %d and received %d frames, more than the %d configured" % (
+                    m.name,
+                    m.frames_tx,
+                    m.frames_rx,
+                    self.packets,
+                )
+            if m.transmit == m.STOPPED and 0 < m.frames_tx < self.packets:
+                return "flow %s stopped after sending %d of %d frames" % (
+                    m.name,
+                    m.frames_tx,
+                    self.packets,
+                )
+            if (
+                m.transmit == m.STOPPED
+                and m.frames_rx < m.frames_tx
+                and now - max(seen[1], seen[3]) >= self.drain_seconds
+            ):
+                return "flow %s stopped and received nothing for %.1fs, %d of %d sent frames missing" % (
+                    m.name,
+                    now - max(seen[1], seen[3]),
+                    m.frames_tx - m.frames_rx,
+                    m.frames_tx,
+                )
+        return None
+
+
+def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None, eta=None):
     """
     Keeps calling the `func` until it returns true or `timeout_seconds` occurs
     every `interval_seconds`. `condition_str` should be a constant string
-    implying the actual condition being tested.
+    implying the actual condition being tested. `eta`, e.g. a TrafficEta,
+    returns the predicted seconds until `func` turns true, see wait_for_all.
 
     Usage
     -----
@@ -208,29 +930,92 @@ def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None):
         poll_until(condition_satisfied, condition_str, **kwargs)
     ```
     """
+    wait_for_all([(func, condition_str, timeout_seconds, eta)], interval_seconds)
+
+
+def wait_for_all(conditions, interval_seconds=None):
+    """
+    Waits for every `(func, condition_str, timeout_seconds)` in `conditions`
+    at the same time. Each `func` is polled on its own every
+    `interval_seconds` and stops being polled as soon as it returns true;
+    a condition that is still false after its own `timeout_seconds` raises
+    and cancels the others.
+
+    A condition can have a fourth item `eta`, a callable returning the
+    predicted seconds until `func` turns true or None when it cannot tell.
+    It is asked again after every poll. While a prediction is further out
+    than `interval_seconds` the condition is polled up to three intervals
+    apart until `interval_seconds` before it, so one bad prediction costs
+    little and the fail_fast watches of `func` keep running. From there it
+    is polled five times as often until one interval past the prediction,
+    then every `interval_seconds` again.
+
+    Usage
+    -----
+    ```
+    wait_for_all(
+        [
+            (lambda: bgp_metrics_ok(cache, tc), "correct bgp peering", 60),
+            (lambda: bgp_prefixes_ok(cache, tc), "correct bgp prefixes", 60),
+        ]
+    )
+    ```
+    """
     if interval_seconds is None:
-        interval_seconds = 1
+        interval_seconds = 0.5
+    asyncio.run(_wait_for_all(conditions, interval_seconds))
+
+
+async def _wait_for_all(conditions, interval_seconds):
+    tasks = [
+        asyncio.ensure_future(
+            _wait_for_condition(func, condition_str, interval_seconds, timeout_seconds, *eta)
+        )
+        for func, condition_str, timeout_seconds, *eta in conditions
+    ]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for t in pending:
+        t.cancel()
+    for t in done:
+        t.result()
+
+
+async def _wait_for_condition(func, condition_str, interval_seconds, timeout_seconds, eta=None):
     if timeout_seconds is None:
         timeout_seconds = 60
-    start_seconds = int(time.time())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_seconds
 
     print('\n\nWaiting for %s ...' % condition_str)
     while True:
-        if func():
+        # predicates do blocking controller calls, keep them off the event loop
+        if await loop.run_in_executor(None, func):
             print('Done waiting for %s' % condition_str)
-            break
-        if (int(time.time()) - start_seconds) >= timeout_seconds:
+            return
+        if loop.time() >= deadline:
             msg = 'Time out occurred while waiting for %s' % condition_str
             raise Exception(msg)
 
-        time.sleep(interval_seconds)
+        await asyncio.sleep(min(_poll_delay(eta, interval_seconds), deadline - loop.time()))
+
+
+def _poll_delay(eta, interval_seconds):
+    remaining = None if eta is None else eta()
+    if remaining is None or remaining < -interval_seconds:
+        return interval_seconds
+    if remaining > interval_seconds:
+        # e.g. a frames_tx_rate sampled while the flows ramp up predicts an
+        # end far too late
+        return min(remaining - interval_seconds, 3 * interval_seconds)
+    return interval_seconds / 5
 
 
 class Table(object):
-    def __init__(self, title, headers, col_width=15):
+    def __init__(self, title, headers, col_width=15, max_rows=None):
         self.title = title
         self.headers = headers
         self.col_width = col_width
+        self.max_rows = max_rows
         self.rows = []
 
     def append_row(self, row):
@@ -240,28 +1025,45 @@ class Table(object):
 
         self.rows.append(row)
 
-    def __str__(self):
-        out = ""
+    def write(self, stream, chunk_rows=1000):
+        """
+        Writes the table to `stream`, `chunk_rows` rows per write. When
+        `max_rows` is set only the first `max_rows` rows are written followed
+        by a line summarizing how many were left out.
+        """
         border = "-" * (len(self.headers) * self.col_width)
+        # one format string per row length instead of one per cell
+        formats = {}
+        cell = "%%-%ds" % self.col_width
 
-        out += "\n"
-        out += border
-        out += "\n%s\n" % self.title
-        out += border
-        out += "\n"
+        def row_format(n):
+            if n not in formats:
+                formats[n] = cell * n + "\n"
+            return formats[n]
 
-        for h in self.headers:
-            out += ("%%-%ds" % self.col_width) % str(h)
-        out += "\n"
+        stream.write("\n%s\n%s\n%s\n" % (border, self.title, border))
+        stream.write(row_format(len(self.headers)) % tuple(self.headers))
 
-        for row in self.rows:
-            for r in row:
-                out += ("%%-%ds" % self.col_width) % str(r)
-            out += "\n"
-        out += border
-        out += "\n\n"
+        shown = len(self.rows)
+        if self.max_rows is not None and shown > self.max_rows:
+            shown = self.max_rows
+        for start in range(0, shown, chunk_rows):
+            end = min(start + chunk_rows, shown)
+            stream.write(
+                "".join(
+                    row_format(len(row)) % tuple(row) for row in self.rows[start:end]
+                )
+            )
+        if shown < len(self.rows):
+            stream.write("... %d more rows (%d total)\n" % (len(self.rows) - shown, len(self.rows)))
 
-        return out
+        stream.write(border)
+        stream.write("\n\n")
+
+    def __str__(self):
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
 
 
 if __name__ == "__main__":
@@ -128,20 +128,34 @@ def verify_statistics(api, configuration):
     return total_expected == total_frames_tx and total_frames_rx >= total_expected
 
 
-def wait_for(func, timeout=30, interval=1):
+def wait_for(func, timeout=30, interval=0.5):
 
     # Keeps calling the `func` until it returns true or `timeout` occurs every `interval` seconds.
 
-    import time
+    return wait_for_all([func], timeout, interval)
 
-    start = time.time()
 
-    while time.time() - start <= timeout:
-        if func():
-            return True
-        time.sleep(interval)
+def wait_for_all(funcs, timeout=30, interval=0.5):
 
-    return False
+    # Polls every function in `funcs` concurrently, each one every `interval` seconds, until all of
+    # them returned true (True) or `timeout` occurs for any of them (False).
+
+    import asyncio
+
+    async def poll(func):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            if await loop.run_in_executor(None, func):
+                return True
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(min(interval, deadline - loop.time()))
+
+    async def poll_all():
+        return all(await asyncio.gather(*[poll(func) for func in funcs]))
+
+    return asyncio.run(poll_all())
 
 
 if __name__ == "__main__":
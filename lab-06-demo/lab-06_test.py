@@ -2,6 +2,23 @@ import logging as log
 import snappi
 from datetime import datetime
 import time
+import asyncio
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import array
+import mmap
+import struct
+import os
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import tempfile
+import ipaddress
+import collections
+import requests.adapters
 
    
 def Test_ibgp_route_prefix():
@@ -27,45 +44,174 @@ def Test_ibgp_route_prefix():
         "routeCount": 5,
         "1AdvRoute": "101.10.10.1",
         "startDstRoute": "201.30.30.1",
+        # set to "127.0.0.1:50051" to stream metrics from otg-gnmi-server
+        "gnmiLocation": None,
     }
 
-    api = snappi.api(location="https://127.0.0.1:8443", verify=False)
-    c = ibgp_route_prefix_config(api, test_const)
-
-    api.set_config(c)
+    api = pooled_api(location="https://127.0.0.1:8443", verify=False)
+    tracer = ApiTracer(api)
+    timeline = PhaseTimeline("lab-06_ibgp_route_prefix")
+    # stopped and flushed however the run ends, the sampler polls in the
+    # background
+    recorder = None
+    sampler = None
+    gnmi = None
+    try:
+        # when the controller already runs this config with other flow rates or
+        # sizes only the flows are updated, BGP stays up
+        config = IncrementalConfig(api)
+        payload = cached_config(api, ibgp_route_prefix_config, test_const)
+        # or, for large peer and route tables:
+        # payload = cached_config(api, ibgp_route_prefix_bulk_config, test_const)
+        if config.apply(payload):
+            timeline.mark("set_config")
+            config.start_protocols()
+            timeline.mark("start_protocols")
+        else:
+            timeline.mark("update_config")
+
+        cache = MetricsCache(api)
+        if test_const["gnmiLocation"] is not None:
+            gnmi = GnmiMetrics(api, test_const["gnmiLocation"])
+            cache.fetchers.update(gnmi.fetchers)
+    
+        wait_for(
+            fail_fast(
+                lambda: bgp_metrics_ok(cache, test_const),
+                BgpWatch(lambda: cache.latest("bgpv4")),
+            ),
+            "correct bgp peering",
+            timeout_seconds=60,
+            eta=SessionEta(lambda: cache.latest("bgpv4")),
+        )
+        timeline.mark("bgp_up")
     
-    start_protocols(api)
+        get_bgp_prefixes(api)
     
-    wait_for(lambda: bgp_metrics_ok(api, test_const),"correct bgp peering",2,60)
+        start_transmit(api)
+        timeline.mark("start_transmit")
     
-    get_bgp_prefixes(api)
+        start = time.time()
+        eta = TrafficEta(lambda: cache.latest("flow"), seconds=test_const["trafficDuration"])
+
+        live = LiveTable()
+        live.start()
+        recorder = MetricsRecorder(results_path("traffic-%s" % datetime.now().strftime("%Y%m%d-%H%M%S")))
+        try:
+            while True:
+                recorder.record("flow", get_flow_metrics(api, live))
+                recorder.record("port", get_port_metrics(api, live))
+                if time.time() - start > (test_const["trafficDuration"]/2):
+                    break
+                time.sleep(2)
+        finally:
+            live.stop()
+        timeline.mark("traffic")
+
+        # sample densely around the route withdraw / link down for the outage
+        sampler = FlowSampler(api, ["bgpFlow"], recorder)
+
+        packet_rate = get_packet_rate(api)
     
-    start_transmit(api)
+        withdraw_routes(api, config.route_names(["d2_bgpv4_peer_rrv4"]))
+        timeline.mark("withdraw_routes")
     
-    start = time.time()
+        # link_operation(api, "down")
 
-    while True:
-        get_flow_metrics(api)
-        get_port_metrics(api)
-        if time.time() - start > (test_const["trafficDuration"]/2):
-            break
         time.sleep(2)
-
-    packet_rate = get_packet_rate(api)
     
-    withdraw_routes(api)
+        get_bgp_prefixes(api)    
     
-    # link_operation(api, "down")
+        wait_for(
+            fail_fast(lambda: traffic_stopped(cache), FlowWatch(lambda: cache.latest("flow"))),
+            "traffic stopped",
+            timeout_seconds=90,
+            eta=eta,
+        )
+        timeline.mark("traffic_stopped")
+        get_port_metrics(api)
 
-    time.sleep(2)
-    
-    get_bgp_prefixes(api)    
-    
-    wait_for(lambda: traffic_stopped(api), "traffic stopped",2,90)
+        sampler.stop()
 
-    get_convergence_time(api,packet_rate)
+        get_convergence_time(api,packet_rate)
+        print_convergence(recorder.close(), "flow:bgpFlow")
     
-    # link_operation(api, "up")
+        # link_operation(api, "up")
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if recorder is not None:
+            recorder.close()
+        if gnmi is not None:
+            gnmi.close()
+        tracer.print_summary()
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        trace = results_path("api-%s.trace.json" % stamp)
+        if trace is not None:
+            tracer.write_chrome_trace(trace, timeline)
+            timeline.write(results_path("%s-%s.phases.json" % (timeline.run, stamp)))
+    timeline.check()
+
+
+def Test_gnmi_metrics():
+    # GnmiMetrics against GnmiStandIn, needs grpcio and pygnmi but no controller
+    missing = [p for p, m in [("grpcio", "grpc"), ("pygnmi", "pygnmi")] if importlib.util.find_spec(m) is None]
+    if missing:
+        print("%s Skipping Test_gnmi_metrics, %s not installed" % (datetime.now(), " and ".join(missing)))
+        return
+
+    api = snappi.api(location="https://127.0.0.1:8443", verify=False)
+    updates = {
+        ("flow", "bgpFlow"): {
+            "state/transmit": "STARTED",
+            "state/counters/out-pkts": 10,
+            "state/counters/in-pkts": 9,
+        },
+        ("bgpv4", "p2_bgp_peer"): {
+            "state/session-state": "UP",
+            "state/counters/routes-received": 5,
+            # an update without a value leaves the metric as it was
+            "state/counters/routes-advertised": None,
+        },
+    }
+
+    standin = GnmiStandIn(updates)
+    gnmi = GnmiMetrics(api, standin.location)
+    try:
+        flows = gnmi.get("flow")
+        got = [(m.name, m.transmit, m.frames_tx, m.frames_rx) for m in flows]
+        if got != [("bgpFlow", "started", 10, 9)]:
+            raise Exception("Unexpected gNMI flow metrics %s" % got)
+        peers = gnmi.get("bgpv4")
+        got = [(m.name, m.session_state, m.routes_received, m.routes_advertised) for m in peers]
+        if got != [("p2_bgp_peer", "up", 5, None)]:
+            raise Exception("Unexpected gNMI bgpv4 metrics %s" % got)
+
+        updates[("flow", "bgpFlow")]["state/counters/out-pkts"] = 20
+        wait_for(lambda: gnmi.get("flow")[0].frames_tx == 20, "streamed flow update", 0.1, 5)
+        # what get returned before is a copy and did not change
+        if flows[0].frames_tx != 10:
+            raise Exception("Metrics returned by get changed to frames_tx %d" % flows[0].frames_tx)
+    finally:
+        gnmi.close()
+        standin.server.stop(None)
+
+    standin = GnmiStandIn(updates, fail_after_samples=2)
+    gnmi = GnmiMetrics(api, standin.location)
+    try:
+        if gnmi.get("flow")[0].frames_tx != 20:
+            raise Exception("gNMI flow metrics missed the update to frames_tx 20")
+        gnmi._thread.join(5)
+        try:
+            gnmi.get("flow")
+        except Exception as e:
+            if "UNAVAILABLE" not in str(e):
+                raise
+        else:
+            raise Exception("get returned metrics of a failed subscription")
+    finally:
+        gnmi.close()
+        standin.server.stop(None)
 
 
 def ibgp_route_prefix_config(api, tc):
@@ -198,8 +344,685 @@ def ibgp_route_prefix_config(api, tc):
     return c
 
 
-def bgp_metrics_ok(api, tc):
-    for m in get_bgpv4_metrics(api):
+def ibgp_route_prefix_bulk_config(api, tc):
+    """
+    Builds the same config as ibgp_route_prefix_config from peer and route
+    tables with bgp_bulk_devices and returns it serialized, ready for
+    set_config_payload.
+    """
+    peers = {
+        "name": ["d1", "d2", "d3"],
+        "port": ["p1", "p2", "p3"],
+        "mac": [tc["1Mac"], tc["2Mac"], tc["3Mac"]],
+        "ip": [tc["1Ip"], tc["2Ip"], tc["3Ip"]],
+        "gateway": [tc["1Gateway"], tc["2Gateway"], tc["3Gateway"]],
+        "prefix": [tc["1Prefix"], tc["2Prefix"], tc["3Prefix"]],
+        "as_number": [tc["bgpAs"]] * 3,
+        "as_type": ["ibgp"] * 3,
+    }
+    routes = {
+        "name": ["d1_bgpv4_peer_rrv4", "d2_bgpv4_peer_rrv4", "d3_bgpv4_peer_rrv4"],
+        "peer": [0, 1, 2],
+        "version": [4] * 3,
+        "address": [tc["1AdvRoute"], tc["startDstRoute"], tc["startDstRoute"]],
+        "prefix": [32] * 3,
+        "count": [tc["routeCount"]] * 3,
+        "step": [1] * 3,
+        "next_hop": [tc["1Ip"], tc["2Ip"], tc["3Ip"]],
+        "local_preference": [None, 200, 150],
+        "multi_exit_discriminator": [None, 100, 200],
+    }
+
+    ports = [
+        {"name": "p1", "location": "10.36.70.122;1;1"},
+        {"name": "p2", "location": "10.36.70.122;1;2"},
+        {"name": "p3", "location": "10.36.70.122;1;3"},
+    ]
+    flows = [
+        {
+            "name": "bgpFlow",
+            "tx_rx": {
+                "choice": "device",
+                "device": {
+                    "tx_names": ["d1_bgpv4_peer_rrv4"],
+                    "rx_names": ["d2_bgpv4_peer_rrv4", "d3_bgpv4_peer_rrv4"],
+                },
+            },
+            "packet": [
+                {"choice": "ethernet", "ethernet": {"src": {"choice": "value", "value": tc["1Mac"]}}},
+                {
+                    "choice": "ipv4",
+                    "ipv4": {
+                        "src": {
+                            "choice": "increment",
+                            "increment": {"start": tc["1AdvRoute"], "count": tc["routeCount"]},
+                        },
+                        "dst": {
+                            "choice": "increment",
+                            "increment": {"start": tc["startDstRoute"], "count": tc["routeCount"]},
+                        },
+                    },
+                },
+            ],
+            "size": {"choice": "fixed", "fixed": tc["pktSize"]},
+            "rate": {"choice": "percentage", "percentage": tc["lineRatePercentage"]},
+            "duration": {"choice": "fixed_seconds", "fixed_seconds": {"seconds": tc["trafficDuration"]}},
+            "metrics": {"enable": True},
+        }
+    ]
+
+    return '{"ports":%s,"devices":%s,"flows":%s}' % (
+        json.dumps(ports),
+        bgp_bulk_devices(peers, routes),
+        json.dumps(flows),
+    )
+
+
+# JSON templates used by bgp_bulk_devices, one per object kind, filled in with
+# % so that a route or a peer costs a single string format. String fields are
+# filled in already JSON encoded, quotes included
+BULK_DEVICE = (
+    '{"name":%(name)s,"ethernets":[{"name":%(eth_name)s,'
+    '"connection":{"choice":"port_name","port_name":%(port)s},'
+    '"mac":%(mac)s,"mtu":1500,"ipv4_addresses":[{"name":%(ip_name)s,'
+    '"address":%(ip)s,"gateway":%(gateway)s,"prefix":%(prefix)d}]}],'
+    '"bgp":{"router_id":%(ip)s,"ipv4_interfaces":[{"ipv4_name":%(ip_name)s,'
+    '"peers":[{"name":%(peer_name)s,"peer_address":%(gateway)s,'
+    '"as_type":%(as_type)s,"as_number":%(as_number)d,'
+    '"learned_information_filter":{"unicast_ipv4_prefix":true,"unicast_ipv6_prefix":true}'
+    '%(routes)s}]}]}}'
+)
+BULK_ROUTE = (
+    '{"name":%s,"next_hop_mode":"manual","next_hop_address_type":"ipv%d",'
+    '"next_hop_ipv%d_address":%s,"addresses":[{"address":%s,"prefix":%d,'
+    '"count":%d,"step":%d}]%s}'
+)
+BULK_ROUTE_ADVANCED = ',"advanced":{%s}'
+BULK_ROUTE_COMMUNITY = (
+    ',"communities":[{"type":"manual_as_number","as_number":%d,"as_custom":%d}]'
+)
+BULK_ROUTE_AS_PATH = (
+    ',"as_path":{"as_set_mode":"include_as_set",'
+    '"segments":[{"type":"as_seq","as_numbers":[%s]}]}'
+)
+
+
+def bgp_bulk_devices(peers, routes):
+    """
+    Serializes BGP devices straight to the JSON of the OTG `devices` list
+    without building any snappi objects. `peers` and `routes` are tables
+    given as dicts of equally long columns:
+
+    peers:  name, port, mac, ip, gateway, prefix, as_number, as_type
+    routes: name, peer (index into peers), version (4 or 6), address,
+            prefix, count, step, next_hop and optionally local_preference,
+            multi_exit_discriminator, origin, community ((as_number,
+            as_custom) pairs) and as_path (lists of AS numbers)
+
+    Devices, ethernets, ipv4 addresses and peers are named after the peer
+    name the same way the *_route_prefix_config builders name them, so the
+    payload deserializes to the config the snappi object path builds.
+    """
+    # what json.dumps does for a str, without its per call overhead
+    string = json.encoder.encode_basestring_ascii
+    n = len(routes["name"])
+    columns = {}
+    for col in ("local_preference", "multi_exit_discriminator", "origin", "community", "as_path"):
+        columns[col] = routes.get(col) or [None] * n
+
+    v4_routes = [[] for _ in peers["name"]]
+    v6_routes = [[] for _ in peers["name"]]
+    for i in range(n):
+        extra = ""
+        advanced = []
+        if columns["local_preference"][i] is not None:
+            advanced.append('"local_preference":%d' % columns["local_preference"][i])
+        if columns["multi_exit_discriminator"][i] is not None:
+            advanced.append('"multi_exit_discriminator":%d' % columns["multi_exit_discriminator"][i])
+        if columns["origin"][i] is not None:
+            advanced.append('"origin":%s' % string(columns["origin"][i]))
+        if advanced:
+            extra += BULK_ROUTE_ADVANCED % ",".join(advanced)
+        if columns["community"][i] is not None:
+            extra += BULK_ROUTE_COMMUNITY % columns["community"][i]
+        if columns["as_path"][i] is not None:
+            extra += BULK_ROUTE_AS_PATH % ",".join(str(a) for a in columns["as_path"][i])
+
+        version = routes["version"][i]
+        (v6_routes if version == 6 else v4_routes)[routes["peer"][i]].append(
+            BULK_ROUTE
+            % (
+                string(routes["name"][i]),
+                version,
+                version,
+                string(routes["next_hop"][i]),
+                string(routes["address"][i]),
+                routes["prefix"][i],
+                routes["count"][i],
+                routes["step"][i],
+                extra,
+            )
+        )
+
+    devices = []
+    for i in range(len(peers["name"])):
+        row = {col: values[i] for col, values in peers.items()}
+        for col in ("name", "port", "mac", "ip", "gateway", "as_type"):
+            row[col] = string(row[col])
+        # the names derived from the peer name, suffixed inside the quotes
+        row["eth_name"] = row["name"][:-1] + '_eth"'
+        row["ip_name"] = row["name"][:-1] + '_ip"'
+        row["peer_name"] = row["name"][:-1] + '_bgpv4_peer"'
+        row["routes"] = ""
+        if v4_routes[i]:
+            row["routes"] += ',"v4_routes":[%s]' % ",".join(v4_routes[i])
+        if v6_routes[i]:
+            row["routes"] += ',"v6_routes":[%s]' % ",".join(v6_routes[i])
+        devices.append(BULK_DEVICE % row)
+    return "[" + ",".join(devices) + "]"
+
+
+CONFIG_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ac2-workshop", "configs")
+
+
+def cached_config(api, builder, tc, cache_dir=CONFIG_CACHE_DIR):
+    """
+    Returns the serialized config `builder(api, tc)` builds, from an on-disk
+    cache when the same config was built before. Entries are keyed by a hash
+    of `tc`, the builder name, the source of this script and the installed
+    snappi version, so editing the builders or upgrading snappi invalidates
+    them without any cleanup.
+    """
+    key = hashlib.sha256()
+    key.update(json.dumps(tc, sort_keys=True).encode())
+    key.update(builder.__name__.encode())
+    with open(os.path.abspath(__file__), "rb") as f:
+        key.update(f.read())
+    key.update(importlib.metadata.version("snappi").encode())
+    path = os.path.join(cache_dir, key.hexdigest() + ".json")
+
+    if os.path.exists(path):
+        print("%s Using cached config %s    ..." % (datetime.now(), path))
+        with open(path) as f:
+            return f.read()
+
+    c = builder(api, tc)
+    payload = c if isinstance(c, str) else c.serialize()
+    os.makedirs(cache_dir, exist_ok=True)
+    # write then rename so a concurrent run never reads a partial entry
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+    return payload
+
+
+class OtgHttp(object):
+    """
+    The HTTP transport under a snappi api, for the requests the labs send
+    without snappi objects: posting serialized configs, streaming captures
+    and fetching prefix shards. `request` sends them with the api's location,
+    `verify` and timeout and raises the same errors as the snappi calls.
+
+    OtgHttp and PooledTransport are the only places that reach into snappi
+    internals: the api's `_transport`, its `_session` and
+    `_parse_response_error`, and the `send_recv` PooledTransport overrides.
+    They are trusted on the snappi releases in SNAPPI_VERSIONS and checked
+    for here on any other, before pooled_api creates a PooledTransport,
+    which fails with the installed release named rather than with an
+    AttributeError somewhere in a lab.
+    """
+
+    # [first, last) snappi releases the internals were checked against
+    SNAPPI_VERSIONS = ((1, 0), (2, 0))
+    snappi_checked = False
+
+    def __init__(self, api):
+        self.api = api
+        self.transport = api._transport
+        if not OtgHttp.snappi_checked:
+            self._check_snappi()
+            OtgHttp.snappi_checked = True
+        self.session = self.transport._session
+        self.location = self.transport.location
+
+    def _check_snappi(self):
+        version = importlib.metadata.version("snappi")
+        release = tuple(int(p) for p in version.split(".")[:2])
+        if self.SNAPPI_VERSIONS[0] <= release < self.SNAPPI_VERSIONS[1]:
+            return
+        needed = ["location", "verify", "_session", "_parse_response_error", "send_recv"]
+        missing = [a for a in needed if not hasattr(self.transport, a)]
+        if missing:
+            raise Exception(
+                "snappi %s is not supported, its HTTP transport has no %s; install snappi %s.x"
+                % (version, ", ".join(missing), self.SNAPPI_VERSIONS[0][0])
+            )
+
+    def set_transport(self, transport):
+        # replaces the transport of the api, e.g. by a PooledTransport
+        self.api._transport = transport
+        self.transport = transport
+        self.session = transport._session
+        self.location = transport.location
+
+    def request(self, method, path, headers=None, **kwargs):
+        response = self.session.request(
+            method,
+            self.location + path,
+            headers=headers or {"Content-Type": "application/json"},
+            verify=self.transport.verify,
+            timeout=getattr(self.transport, "timeout_seconds", None),
+            **kwargs
+        )
+        if not response.ok:
+            with response:
+                self.transport._parse_response_error(response.status_code, response.text)
+        return response
+
+
+class PooledTransport(snappi.snappi.HttpTransport):
+    """
+    HttpTransport tuned for polling loops: up to `pool_size` keep-alive
+    connections are reused, so TLS is negotiated once per connection rather
+    than per call, every request gives up after `timeout_seconds`, responses
+    are gzip encoded only when `compress` is set, and JSON responses are
+    decoded with json instead of yaml. The session is safe to share between
+    threads, so independent requests can run concurrently, see MetricsCache.
+    Unlike HttpTransport it sends requests with the `verify` it was created
+    with. It builds on the same HttpTransport internals as OtgHttp, so
+    create it through pooled_api, which checks them first.
+    """
+
+    # what pooled_api recognizes it by, every lab and every reload of a lab
+    # by tools/otg_worker.py has a PooledTransport class of its own
+    pooled = True
+
+    def __init__(self, pool_size=10, timeout_seconds=30, compress=False, **kwargs):
+        super(PooledTransport, self).__init__(**kwargs)
+        self.timeout_seconds = timeout_seconds
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # controllers are usually next to the script, where compressing costs
+        # more than it saves
+        self._session.headers["Accept-Encoding"] = "gzip" if compress else "identity"
+
+    def send_recv(
+        self,
+        method,
+        relative_url,
+        payload=None,
+        return_object=None,
+        headers=None,
+        request_class=None,
+    ):
+        headers = headers or {"Content-Type": "application/json"}
+        data = None
+        if isinstance(payload, bytes):
+            data = payload
+            headers["Content-Type"] = "application/octet-stream"
+        elif isinstance(payload, str):
+            if request_class is not None:
+                request_class().deserialize(payload)
+            data = payload
+        elif payload is not None:
+            data = payload.serialize()
+
+        response = self._session.request(
+            method=method,
+            url=self.location + relative_url,
+            data=data,
+            headers=headers,
+            verify=self.verify,
+            timeout=self.timeout_seconds,
+        )
+        if not response.ok:
+            self._parse_response_error(response.status_code, response.text)
+        content_type = response.headers.get("content-type", "")
+        if "application/json" in content_type:
+            if return_object is None:
+                return response.json()
+            return return_object.deserialize(response.json())
+        if "application/octet-stream" in content_type:
+            return io.BytesIO(response.content)
+        return response
+
+
+def pooled_api(location, verify=False, pool_size=10, timeout_seconds=30, compress=False):
+    """
+    `snappi.api` over a PooledTransport. An api that already has one, e.g.
+    a session handed out again by tools/otg_worker.py, is returned as is.
+    The transport keeps the location of the api `snappi.api` returns, so
+    tools that redirect `snappi.api`, such as tools/run_labs.py, redirect
+    this one as well.
+    """
+    api = snappi.api(location=location, verify=verify)
+    http = OtgHttp(api)
+    if not getattr(http.transport, "pooled", False):
+        http.set_transport(
+            PooledTransport(
+                location=http.location,
+                verify=verify,
+                pool_size=pool_size,
+                timeout_seconds=timeout_seconds,
+                compress=compress,
+            )
+        )
+    return api
+
+
+# ApiTracer and PhaseTimeline are the same in every lab script that traces
+# its runs, copied so each script still runs on its own. Change them in all
+# of them
+class ApiTracer(object):
+    """
+    Times every call of `api` listed in CALLS and every HTTP request made
+    through its session, including the ones under those calls. Each record
+    keeps its start, end, request and response size. The gap between a call
+    and the request under it is client side serialization, and the request
+    itself is controller latency plus transfer.
+
+    `print_summary()` prints per call type latency percentiles and sizes,
+    `histogram(name)` buckets one type by powers of two milliseconds and
+    `write_chrome_trace(path)` writes every record as a Chrome trace that
+    chrome://tracing or ui.perfetto.dev can open.
+    """
+
+    CALLS = [
+        "set_config",
+        "get_config",
+        "update_config",
+        "set_control_state",
+        "get_metrics",
+        "get_states",
+        "get_capture",
+    ]
+
+    def __init__(self, api):
+        self.api = api
+        self.origin = time.perf_counter()
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # an api handed out again by tools/otg_worker.py still carries the
+        # previous run's tracer, wrap what was there before it
+        untraced = api.__dict__.setdefault("_untraced", {})
+        for name in self.CALLS:
+            untraced.setdefault(name, getattr(api, name))
+            setattr(api, name, self._traced_call(name, untraced[name]))
+        session = OtgHttp(api).session
+        untraced.setdefault("request", session.request)
+        session.request = self._traced_request(untraced["request"])
+
+    def _traced_call(self, name, call):
+        def traced(*args, **kwargs):
+            record = {"cat": "api", "name": name, "request_bytes": 0, "response_bytes": 0}
+            self._local.call = record
+            record["start"] = time.perf_counter()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                record["end"] = time.perf_counter()
+                self._local.call = None
+                self._add(record)
+
+        return traced
+
+    def _traced_request(self, request):
+        def traced(method, url, **kwargs):
+            path = url.split("://", 1)[-1].partition("/")[2]
+            data = kwargs.get("data")
+            record = {
+                "cat": "http",
+                "name": "%s /%s" % (method.upper(), path),
+                "request_bytes": len(data) if data is not None else 0,
+                "response_bytes": 0,
+            }
+            record["start"] = time.perf_counter()
+            try:
+                response = request(method, url, **kwargs)
+                if kwargs.get("stream"):
+                    # the body is read by the caller after this returns
+                    record["response_bytes"] = int(response.headers.get("Content-Length", 0))
+                else:
+                    record["response_bytes"] = len(response.content)
+                return response
+            finally:
+                record["end"] = time.perf_counter()
+                call = getattr(self._local, "call", None)
+                if call is not None:
+                    call["request_bytes"] += record["request_bytes"]
+                    call["response_bytes"] += record["response_bytes"]
+                self._add(record)
+
+        return traced
+
+    def _add(self, record):
+        record["tid"] = threading.get_ident()
+        with self._lock:
+            self.records.append(record)
+
+    def durations(self, name):
+        with self._lock:
+            return sorted(r["end"] - r["start"] for r in self.records if r["name"] == name)
+
+    def histogram(self, name):
+        # upper bound in ms -> count, 1, 2, 4, ...
+        buckets = {}
+        for d in self.durations(name):
+            bound = 1
+            while bound < d * 1000:
+                bound *= 2
+            buckets[bound] = buckets.get(bound, 0) + 1
+        return dict(sorted(buckets.items()))
+
+    def print_summary(self):
+        with self._lock:
+            records = list(self.records)
+        calls = {}
+        for r in records:
+            calls.setdefault((r["cat"] != "api", r["name"]), []).append(r)
+
+        tb = Table(
+            "API Calls",
+            ["Count", "p50 ms", "p90 ms", "Max ms", "Total ms", "Req KB", "Resp KB", "Call"],
+            10,
+        )
+        for (_, name), rs in sorted(calls.items()):
+            d = sorted(r["end"] - r["start"] for r in rs)
+            tb.append_row(
+                [
+                    len(d),
+                    "%.1f" % (d[len(d) // 2] * 1000),
+                    "%.1f" % (d[len(d) * 9 // 10] * 1000),
+                    "%.1f" % (d[-1] * 1000),
+                    "%.1f" % (sum(d) * 1000),
+                    "%.1f" % (sum(r["request_bytes"] for r in rs) / 1024.0),
+                    "%.1f" % (sum(r["response_bytes"] for r in rs) / 1024.0),
+                    name,
+                ]
+            )
+        tb.write(sys.stdout)
+
+    def write_chrome_trace(self, path, timeline=None):
+        """
+        `timeline`, a PhaseTimeline of the same run, adds its phases on a
+        track of their own above the calls.
+        """
+        with self._lock:
+            records = list(self.records)
+        pid = os.getpid()
+        events = []
+        if timeline is not None:
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": 0, "args": {"name": "phases"}})
+            for p in timeline.phases:
+                events.append(
+                    {
+                        "ph": "X",
+                        "cat": "phase",
+                        "name": p["name"],
+                        "pid": pid,
+                        "tid": 0,
+                        "ts": (timeline.origin + p["start"] - self.origin) * 1e6,
+                        "dur": p["seconds"] * 1e6,
+                    }
+                )
+        for tid in sorted(set(r["tid"] for r in records)):
+            for t in threading.enumerate():
+                if t.ident == tid:
+                    events.append(
+                        {"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": t.name}}
+                    )
+        for r in records:
+            events.append(
+                {
+                    "ph": "X",
+                    "cat": r["cat"],
+                    "name": r["name"],
+                    "pid": pid,
+                    "tid": r["tid"],
+                    "ts": (r["start"] - self.origin) * 1e6,
+                    "dur": (r["end"] - r["start"]) * 1e6,
+                    "args": {
+                        "request_bytes": r["request_bytes"],
+                        "response_bytes": r["response_bytes"],
+                    },
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+# baselines of PhaseTimeline.check, outside the lab directories
+PHASE_BASELINE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ac2-workshop", "phases")
+# directory the API traces, phases and metric recordings of a run are
+# written to, tools/run_labs.py sets it per test. Nothing is kept when unset
+RESULTS_DIR_ENV = "OTG_RESULTS_DIR"
+
+
+def results_path(name):
+    # `name` in the results directory, None when runs keep no files
+    results_dir = os.environ.get(RESULTS_DIR_ENV)
+    if not results_dir:
+        return None
+    os.makedirs(results_dir, exist_ok=True)
+    return os.path.join(results_dir, name)
+
+
+class PhaseTimeline(object):
+    """
+    Marks the phases of a test run, e.g. set_config, start_protocols, bgp_up.
+    `mark(name)` ends a phase that started at the previous mark. `until(func,
+    name)` wraps a wait_for predicate so that its phase ends the first time
+    the predicate holds, which times conditions polled together under
+    wait_for_all separately.
+
+    `write(path)` saves the phases as JSON and `check()` compares them
+    against the baseline run of the same script and run name saved under
+    PHASE_BASELINE_DIR, or at `path` when given. A phase that took more than
+    `tolerance` longer and at least `slack_seconds` more than there is
+    reported as regressed, and raises only with `fail`, timings of a shared
+    lab are too noisy to fail a functional test on by default. With no
+    baseline yet the run is saved as the baseline.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.started = datetime.now()
+        self.origin = time.perf_counter()
+        self.phases = []
+        self._last = self.origin
+        self._lock = threading.Lock()
+
+    def _add(self, name, start, end):
+        with self._lock:
+            self.phases.append(
+                {
+                    "name": name,
+                    "start": start - self.origin,
+                    "end": end - self.origin,
+                    "seconds": end - start,
+                }
+            )
+            self._last = max(self._last, end)
+
+    def mark(self, name):
+        self._add(name, self._last, time.perf_counter())
+
+    def until(self, func, name):
+        start = self._last
+        done = []
+
+        def predicate():
+            ok = func()
+            if ok and not done:
+                done.append(True)
+                self._add(name, start, time.perf_counter())
+            return ok
+
+        return predicate
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "run": self.run,
+                    "started": self.started.isoformat(),
+                    "phases": self.phases,
+                },
+                f,
+                indent=2,
+            )
+        return path
+
+    def check(self, path=None, tolerance=0.25, slack_seconds=0.5, fail=False):
+        if path is None:
+            script = os.path.splitext(os.path.basename(__file__))[0]
+            path = os.path.join(PHASE_BASELINE_DIR, "%s.%s.json" % (script, self.run))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.write(path)
+            print("%s No phase baseline yet, saved this run to %s" % (datetime.now(), path))
+            return
+        with open(path) as f:
+            baseline = dict((p["name"], p["seconds"]) for p in json.load(f)["phases"])
+
+        tb = Table("Phases vs %s" % path, ["Baseline s", "Run s", "Change", "Status", "Phase"])
+        regressions = []
+        for p in self.phases:
+            base = baseline.get(p["name"])
+            if base is None:
+                tb.append_row(["_", "%.3f" % p["seconds"], "_", "new", p["name"]])
+                continue
+            status = "ok"
+            if p["seconds"] > base * (1 + tolerance) and p["seconds"] - base >= slack_seconds:
+                status = "REGRESSED"
+                regressions.append(p["name"])
+            change = "_" if base == 0 else "%+.0f%%" % ((p["seconds"] / base - 1) * 100)
+            tb.append_row(["%.3f" % base, "%.3f" % p["seconds"], change, status, p["name"]])
+        tb.write(sys.stdout)
+
+        if regressions:
+            message = "Phases slower than %s: %s" % (path, ", ".join(regressions))
+            if fail:
+                raise Exception(message)
+            print("%s %s" % (datetime.now(), message))
+
+
+def set_config_payload(api, payload):
+    """
+    POSTs an already serialized config. `api.set_config` deserializes string
+    payloads into snappi objects to validate them, which is the cost the bulk
+    builders avoid, so the request goes through the api's HTTP session
+    directly.
+    """
+    OtgHttp(api).request("POST", "/config", data=payload).close()
+
+
+def bgp_metrics_ok(cache, tc):
+    for m in cache.get("bgpv4"):
         if (
             m.session_state == m.DOWN
             or m.routes_advertised < tc["routeCount"]
@@ -209,9 +1032,8 @@ def bgp_metrics_ok(api, tc):
     return True
 
 
-def traffic_stopped(api):
-    for m in get_flow_metrics(api):
-        get_port_metrics(api)
+def traffic_stopped(cache):
+    for m in cache.get("flow"):
         if m.transmit != m.STOPPED:
             return False
     return True
@@ -248,53 +1070,109 @@ def get_bgpv4_metrics(api):
     return metrics
 
 
-def get_bgp_prefixes(api):
-    print("%s Getting BGP prefixes    ..." % datetime.now())
-    req = api.states_request()
-    req.bgp_prefixes.bgp_peer_names = []
-    bgp_prefixes = api.get_states(req).bgp_prefixes
+def bgp_peer_names(config):
+    return [
+        peer.name
+        for d in config.devices
+        for intf in list(d.bgp.ipv4_interfaces) + list(d.bgp.ipv6_interfaces)
+        for peer in intf.peers
+    ]
 
-    tb = Table(
-        "BGP Prefixes",
-        [
-            "Name",
-            "IPv4 Address",
-            "IPv4 Next Hop",
-            "IPv6 Address",
-            "IPv6 Next Hop",
-        ],
-        20,
-    )
 
-    for b in bgp_prefixes:
-        for p in b.ipv4_unicast_prefixes:
-            tb.append_row(
-                [
-                    b.bgp_peer_name,
-                    "{}/{}".format(p.ipv4_address, p.prefix_length),
-                    p.ipv4_next_hop,
-                    "",
-                    "" if p.ipv6_next_hop is None else p.ipv6_next_hop,
-                ]
+def iter_bgp_prefixes(api, peer_names=None, group_size=1, max_workers=1):
+    """
+    Yields the learned BGP prefixes one shard at a time as
+    `(peer_name, family, prefixes)`, where a shard is one peer and address
+    family and `prefixes` its decoded JSON, e.g.
+    `{"ipv4_address": ..., "prefix_length": ..., "ipv4_next_hop": ...}`.
+    Only the current shards are held, so memory is bounded by the shard size
+    rather than the whole RIB. `peer_names` defaults to every BGP peer of the
+    config.
+
+    Each states request covers `group_size` peers and one address family, and
+    up to `max_workers` of them are in flight at once over as many pooled
+    connections. Shards are yielded in peer order either way.
+
+    The requests go through the api's HTTP session since `api.get_states`
+    builds a snappi object per prefix, which takes longer than the peers
+    take to learn a large RIB.
+    """
+    if peer_names is None:
+        peer_names = bgp_peer_names(api.get_config())
+    http = OtgHttp(api)
+    if max_workers > 1:
+        adapter = http.session.get_adapter(http.location)
+        if getattr(adapter, "_pool_maxsize", 0) < max_workers:
+            http.session.mount(
+                http.location, requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
             )
-        for p in b.ipv6_unicast_prefixes:
+
+    def fetch(names, family):
+        req = api.states_request()
+        req.bgp_prefixes.bgp_peer_names = names
+        req.bgp_prefixes.prefix_filters = [family + "_unicast"]
+        response = http.request("POST", "/monitor/states", data=req.serialize())
+        states = response.json().get("bgp_prefixes", [])
+        response.close()
+        # a group comes back in whatever order the controller keeps its peers
+        order = dict((n, i) for i, n in enumerate(names))
+        states.sort(key=lambda s: order.get(s.get("bgp_peer_name"), len(names)))
+        return [
+            (s.get("bgp_peer_name", names[0]), family, s.get(family + "_unicast_prefixes", []))
+            for s in states
+        ]
+
+    shards = [
+        (peer_names[i : i + group_size], family)
+        for i in range(0, len(peer_names), group_size)
+        for family in ["ipv4", "ipv6"]
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # at most `max_workers` shards fetched ahead of the consumer
+        pending = collections.deque()
+        for shard in shards:
+            pending.append(pool.submit(fetch, *shard))
+            if len(pending) >= max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def get_bgp_prefixes(api, peer_names=None, group_size=1, max_workers=1):
+    print("%s Getting BGP prefixes    ..." % datetime.now())
+    total = 0
+    # one table per shard so only one shard's rows are held at a time
+    for name, family, prefixes in iter_bgp_prefixes(api, peer_names, group_size, max_workers):
+        if not prefixes:
+            continue
+        label = "IPv4" if family == "ipv4" else "IPv6"
+        tb = Table(
+            "BGP Prefixes %s %s" % (name, label),
+            [
+                "Name",
+                label + " Address",
+                label + " Next Hop",
+            ],
+            20,
+        )
+        for p in prefixes:
             tb.append_row(
                 [
-                    b.bgp_peer_name,
-                    "",
-                    "" if p.ipv4_next_hop is None else p.ipv4_next_hop,
-                    "{}/{}".format(p.ipv6_address, p.prefix_length),
-                    p.ipv6_next_hop,
+                    name,
+                    "{}/{}".format(p[family + "_address"], p["prefix_length"]),
+                    p.get(family + "_next_hop", ""),
                 ]
             )
+        tb.write(sys.stdout)
+        total += len(prefixes)
 
-    print(tb)
-    return bgp_prefixes
+    return total
 
 
-def get_flow_metrics(api):
+def get_flow_metrics(api, live=None):
 
-    print("%s Getting flow metrics    ..." % datetime.now())
+    if live is None:
+        print("%s Getting flow metrics    ..." % datetime.now())
     req = api.metrics_request()
     req.flow.flow_names = []
 
@@ -327,13 +1205,17 @@ def get_flow_metrics(api):
                 m.bytes_rx,
             ]
         )
-    print(tb)
+    if live is None:
+        print(tb)
+    else:
+        live.update(tb)
     return metrics
 
 
-def get_port_metrics(api):
+def get_port_metrics(api, live=None):
 
-    print("%s Getting port metrics    ..." % datetime.now())
+    if live is None:
+        print("%s Getting port metrics    ..." % datetime.now())
     req = api.metrics_request()
     req.port.port_names = []
 
@@ -370,7 +1252,10 @@ def get_port_metrics(api):
                 m.bytes_rx_rate,
             ]
         )
-    print(tb)
+    if live is None:
+        print(tb)
+    else:
+        live.update(tb)
     return metrics
 
 
@@ -401,12 +1286,12 @@ def stop_transmit(api):
     api.set_control_state(cs)
 
 
-def withdraw_routes(api):
+def withdraw_routes(api, route_names=None):
     print("%s Withdraw routes from port 2    ..." % datetime.now())
     cs = api.control_state()
     cs.choice = cs.PROTOCOL
     cs.protocol.choice = cs.protocol.ROUTE
-    cs.protocol.route.names = ["d2_bgpv4_peer_rrv4"]
+    cs.protocol.route.names = route_names or ["d2_bgpv4_peer_rrv4"]
     cs.protocol.route.state = cs.protocol.route.WITHDRAW
     api.set_control_state(cs)
 
@@ -424,6 +1309,19 @@ def link_operation(api, operation):
     api.set_control_state(cs)
 
 
+def route_operation(api, route_names, operation):
+    print("%s %s routes %s    ..." % (datetime.now(), operation.capitalize(), ", ".join(route_names)))
+    cs = api.control_state()
+    cs.choice = cs.PROTOCOL
+    cs.protocol.choice = cs.protocol.ROUTE
+    cs.protocol.route.names = route_names
+    if operation == "withdraw":
+        cs.protocol.route.state = cs.protocol.route.WITHDRAW
+    else:
+        cs.protocol.route.state = cs.protocol.route.ADVERTISE
+    api.set_control_state(cs)
+
+
 def get_packet_rate(api):
     mr = api.metrics_request()
     mr.flow.flow_names = ["bgpFlow"]
@@ -443,11 +1341,1187 @@ def get_convergence_time(api,packet_rate):
 
 
 
-def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None):
+class IncrementalConfig(object):
+    """
+    Applies serialized configs, such as the ones cached_config returns,
+    pushing only what changed since the config the controller runs:
+
+    - flows whose only differences are rate and/or size go through
+      `update_config`, which keeps traffic and protocols running
+    - route ranges left out of the new config are withdrawn, and route
+      ranges brought back are advertised again
+    - a route range that only changed its route count withdraws or
+      advertises blocks of its routes. A full push splits every range into
+      blocks at each count it was applied with before, up to the largest,
+      so any of those counts is reached again by route operations alone.
+      The first block keeps the name of the range, the others are named
+      `<name>@<first route>`; `route_names` gives the advertised blocks of
+      ranges, e.g. to withdraw them with route_operation
+    - any other difference, including new route ranges and route counts
+      not applied before, falls back to a full set_config_payload. So do
+      route count changes the flows follow, e.g. a flow sweeping every
+      route address, as update_config only changes rate and size
+
+    The first `apply` compares with the config the controller returns, so a
+    lab run again with only another rate or packet size keeps the BGP
+    sessions of the previous run instead of re-converging. That config is
+    only trusted while every one of its BGP sessions is up, and since its
+    withdrawn routes are not known every route of the new config is
+    advertised again. A controller returning the config in another form than
+    it was set, e.g. with defaults filled in, gets full pushes.
+
+    `apply` returns True when the config was pushed in full. Then protocols
+    have to be started with `start_protocols`, which also withdraws the
+    blocks above the applied route counts.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.applied = None
+        # route range name -> (the range at its largest route count, the
+        # counts its blocks end at or None when it is not split), as the
+        # controller has them
+        self.ranges = {}
+        # block names advertised, None while not known
+        self.advertised = set()
+
+    def apply(self, payload):
+        new = json.loads(payload)
+        routes = _pop_routes(new)
+        if self.applied is None:
+            self._load()
+        delta = self._delta(new, routes)
+
+        if delta is None:
+            self._push(payload, routes)
+            self.applied = new
+            return True
+
+        flows, property_names, withdraw, advertise, wanted = delta
+        if flows:
+            print("%s Updating %s of flows %s    ..." % (datetime.now(), "/".join(property_names), ", ".join(flows)))
+            cu = self.api.config_update()
+            cu.flows.property_names = property_names
+            for f in new.get("flows", []):
+                if f["name"] in flows:
+                    cu.flows.flows.add().deserialize(f)
+            self.api.update_config(cu)
+        if withdraw:
+            route_operation(self.api, withdraw, "withdraw")
+        if advertise:
+            route_operation(self.api, advertise, "advertise")
+
+        self.applied = new
+        self.advertised = wanted
+        return False
+
+    def start_protocols(self):
+        start_protocols(self.api)
+        surplus = sorted(self._blocks() - self.advertised)
+        if surplus:
+            route_operation(self.api, surplus, "withdraw")
+
+    def route_names(self, names):
+        # the advertised blocks of the route ranges `names`
+        return sorted(
+            block
+            for name in names
+            for block, _, _ in self._split(name)
+            if self.advertised is None or block in self.advertised
+        )
+
+    def _push(self, payload, routes):
+        ranges = {}
+        for name, route in routes.items():
+            count = _route_count(route)
+            if count is None:
+                ranges[name] = (route, None)
+                continue
+            counts = set([count])
+            known, ends = self.ranges.get(name, (None, None))
+            if ends is not None and _route_with_count(known, 0) == _route_with_count(route, 0):
+                counts.update(ends)
+            ranges[name] = (_route_with_count(route, max(counts)), sorted(counts))
+        self.ranges = ranges
+
+        config = json.loads(payload)
+        for routes_of_peer in _route_lists(config):
+            routes_of_peer[:] = [
+                _route_block(self.ranges[r["name"]][0], block, start, count)
+                for r in routes_of_peer
+                for block, start, count in self._split(r["name"])
+            ]
+        print("%s Applying full config    ..." % datetime.now())
+        set_config_payload(self.api, json.dumps(config))
+        self.advertised = self._wanted(
+            dict((name, _route_count(route)) for name, route in routes.items())
+        )
+
+    def _load(self):
+        # the config the controller runs, while all of its BGP sessions are up
+        applied = OtgHttp(self.api).request("GET", "/config").json()
+        blocks = _pop_routes(applied)
+        peers = [
+            p["name"]
+            for d in applied.get("devices", [])
+            for interfaces in ("ipv4_interfaces", "ipv6_interfaces")
+            for i in d.get("bgp", {}).get(interfaces, [])
+            for p in i.get("peers", [])
+        ]
+        if peers:
+            req = self.api.metrics_request()
+            req.bgpv4.peer_names = peers
+            metrics = self.api.get_metrics(req).bgpv4_metrics
+            if len(metrics) != len(peers) or any(m.session_state != m.UP for m in metrics):
+                return
+
+        # blocks of a split range are put together again
+        split = {}
+        for name, route in blocks.items():
+            base, _, start = name.rpartition("@")
+            if base in blocks and start.isdigit():
+                split.setdefault(base, []).append((int(start), route))
+        ranges = {}
+        for name, route in blocks.items():
+            if name in ranges or name.rpartition("@")[0] in split:
+                continue
+            count = _route_count(route)
+            if count is None:
+                ranges[name] = (route, None)
+                continue
+            ends = [count]
+            for start, block in sorted(split.get(name, [])):
+                count = start + _route_count(block)
+                ends.append(count)
+            ranges[name] = (_route_with_count(route, count), ends)
+
+        self.applied = applied
+        self.ranges = ranges
+        self.advertised = None
+
+    def _delta(self, new, routes):
+        if self.applied is None:
+            return None
+
+        # route ranges can only be withdrawn and advertised again in place,
+        # in the blocks they were pushed with
+        counts = {}
+        for name, route in routes.items():
+            if name not in self.ranges:
+                return None
+            known, ends = self.ranges[name]
+            count = _route_count(route)
+            if ends is None:
+                if known != route:
+                    return None
+            elif _route_with_count(known, 0) != _route_with_count(route, 0) or count not in ends + [0]:
+                return None
+            counts[name] = count
+        wanted = self._wanted(counts)
+        if self.advertised is None:
+            withdraw = sorted(self._blocks() - wanted)
+            advertise = sorted(wanted)
+        else:
+            withdraw = sorted(self.advertised - wanted)
+            advertise = sorted(wanted - self.advertised)
+
+        old_flows = self.applied.get("flows", [])
+        new_flows = new.get("flows", [])
+        if [f["name"] for f in old_flows] != [f["name"] for f in new_flows]:
+            return None
+        flows = []
+        property_names = set()
+        for old, f in zip(old_flows, new_flows):
+            changed = set(k for k in set(old) | set(f) if old.get(k) != f.get(k))
+            if not changed <= set(["rate", "size"]):
+                return None
+            if changed:
+                flows.append(f["name"])
+                property_names |= changed
+
+        rest = lambda d: dict((k, v) for k, v in d.items() if k != "flows")
+        if rest(self.applied) != rest(new):
+            return None
+        return flows, sorted(property_names), withdraw, advertise, wanted
+
+    def _split(self, name):
+        # (block name, first route, route count) of every block of a range
+        route, ends = self.ranges[name]
+        if ends is None:
+            return [(name, 0, None)]
+        starts = [0] + ends[:-1]
+        return [
+            (name if start == 0 else "%s@%d" % (name, start), start, end - start)
+            for start, end in zip(starts, ends)
+            if end > start
+        ]
+
+    def _blocks(self):
+        return set(block for name in self.ranges for block, _, _ in self._split(name))
+
+    def _wanted(self, counts):
+        # the blocks advertising the first `counts[name]` routes of each range
+        return set(
+            block
+            for name, count in counts.items()
+            for block, start, _ in self._split(name)
+            if count is None or start < count
+        )
+
+
+def _route_lists(config):
+    # the v4/v6 route range lists of every bgp peer of a serialized config
+    for d in config.get("devices", []):
+        for interfaces in ("ipv4_interfaces", "ipv6_interfaces"):
+            for i in d.get("bgp", {}).get(interfaces, []):
+                for p in i.get("peers", []):
+                    for key in ("v4_routes", "v6_routes"):
+                        if key in p:
+                            yield p[key]
+
+
+def _pop_routes(config):
+    # removes the v4/v6 route ranges from every bgp peer of a serialized
+    # config and returns them by name
+    routes = {}
+    for d in config.get("devices", []):
+        for interfaces in ("ipv4_interfaces", "ipv6_interfaces"):
+            for i in d.get("bgp", {}).get(interfaces, []):
+                for p in i.get("peers", []):
+                    for key in ("v4_routes", "v6_routes"):
+                        for r in p.pop(key, []):
+                            routes[r["name"]] = r
+    return routes
+
+
+def _route_count(route):
+    # routes of a range of one address block, None for any other range
+    addresses = route.get("addresses", [])
+    if len(addresses) != 1:
+        return None
+    return int(addresses[0].get("count", 1))
+
+
+def _route_with_count(route, count):
+    route = json.loads(json.dumps(route))
+    route["addresses"][0]["count"] = count
+    return route
+
+
+def _route_block(route, name, start, count):
+    # `count` routes of `route` from its route `start` on, named `name`
+    block = json.loads(json.dumps(route))
+    block["name"] = name
+    if count is None:
+        return block
+    a = block["addresses"][0]
+    address = ipaddress.ip_address(a["address"])
+    prefix = a.get("prefix", 24 if address.version == 4 else 64)
+    shift = address.max_prefixlen - prefix
+    a["address"] = str(ipaddress.ip_address(int(address) + ((start * int(a.get("step", 1))) << shift)))
+    a["count"] = count
+    return block
+
+
+class LiveTable(object):
+    """
+    Shows the latest version of one or more tables every `refresh_seconds`,
+    independent of how often they are polled. On a TTY the tables are
+    redrawn in place and only the lines that changed are rewritten; other
+    streams (CI logs) get one compact line per changed row with the deltas
+    since the previous refresh. Rows are keyed by their first column.
+    """
+
+    def __init__(self, stream=None, refresh_seconds=1):
+        self.stream = sys.stdout if stream is None else stream
+        self.refresh_seconds = refresh_seconds
+        self.tty = self.stream.isatty()
+        self._tables = {}
+        self._lines = []
+        self._logged = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def update(self, table):
+        with self._lock:
+            self._tables[table.title] = table
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            tables = list(self._tables.values())
+        if self.tty:
+            self._redraw(tables)
+        else:
+            self._log_deltas(tables)
+        self.stream.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_seconds):
+            self.refresh()
+
+    def _redraw(self, tables):
+        out = io.StringIO()
+        for tb in tables:
+            tb.write(out)
+        lines = out.getvalue().split("\n")[:-1]
+
+        if len(lines) != len(self._lines):
+            # layout changed, clear what was drawn before and draw it all
+            if self._lines:
+                self.stream.write("\x1b[%dF\x1b[J" % len(self._lines))
+            for line in lines:
+                self.stream.write(line + "\n")
+        elif lines != self._lines:
+            self.stream.write("\x1b[%dF" % len(lines))
+            for old, new in zip(self._lines, lines):
+                if old == new:
+                    # not CSI E, which does not scroll on the last line of
+                    # the terminal and would leave the cursor a line high
+                    self.stream.write("\n")
+                else:
+                    self.stream.write("\x1b[2K" + new + "\n")
+        self._lines = lines
+
+    def _log_deltas(self, tables):
+        for tb in tables:
+            for row in tb.rows:
+                key = (tb.title, row[0])
+                previous = self._logged.get(key)
+                self._logged[key] = row
+                if previous == row:
+                    continue
+                changes = []
+                for i in range(1, len(row)):
+                    old = None if previous is None else previous[i]
+                    if old == row[i]:
+                        continue
+                    if isinstance(old, (int, float)) and isinstance(row[i], (int, float)):
+                        changes.append("%s %s (%+g)" % (tb.headers[i], row[i], row[i] - old))
+                    else:
+                        changes.append("%s %s" % (tb.headers[i], row[i]))
+                self.stream.write(
+                    "%s %s %s: %s\n" % (datetime.now(), tb.title, row[0], ", ".join(changes))
+                )
+
+
+class MetricsRecorder(object):
+    """
+    Records every polled flow and port metric into preallocated typed
+    columns, one row per (timestamp, flow/port) sample. When `capacity` rows
+    are filled the columns are written to `<prefix>.<n>.otgts` and reused,
+    so memory stays constant however long the run is. Use read_recording to
+    memory-map a file back and replay_recording to iterate its samples.
+    Without a `prefix` the files go to a temporary directory that is removed
+    with the recorder.
+    """
+
+    COLUMNS = [
+        ("timestamp", "d"),
+        ("series", "I"),
+        ("frames_tx", "Q"),
+        ("frames_rx", "Q"),
+        ("bytes_tx", "Q"),
+        ("bytes_rx", "Q"),
+        ("frames_tx_rate", "d"),
+        ("frames_rx_rate", "d"),
+        ("bytes_tx_rate", "d"),
+        ("bytes_rx_rate", "d"),
+    ]
+
+    def __init__(self, prefix=None, capacity=65536):
+        self._scratch = None
+        if prefix is None:
+            self._scratch = tempfile.TemporaryDirectory(prefix="otgts-")
+            prefix = os.path.join(self._scratch.name, "metrics")
+        self.prefix = prefix
+        self.capacity = capacity
+        self.columns = {}
+        for name, typecode in self.COLUMNS:
+            self.columns[name] = array.array(typecode, bytes(array.array(typecode).itemsize * capacity))
+        self.rows = 0
+        self.files = []
+        # series are numbered in the order they are first seen, e.g. "flow:bgpFlow"
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, metrics, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            for m in metrics:
+                if self.rows == self.capacity:
+                    self._rotate()
+                key = "%s:%s" % (kind, m.name)
+                if key not in self.series:
+                    self.series[key] = len(self.series)
+                row = self.rows
+                self.columns["timestamp"][row] = timestamp
+                self.columns["series"][row] = self.series[key]
+                for name, typecode in self.COLUMNS[2:]:
+                    value = getattr(m, name, None)
+                    if value is None:
+                        value = 0 if typecode == "Q" else float("nan")
+                    self.columns[name][row] = value
+                self.rows += 1
+
+    def close(self):
+        with self._lock:
+            if self.rows:
+                self._rotate()
+        return self.files
+
+    def _rotate(self):
+        path = "%s.%05d.otgts" % (self.prefix, len(self.files))
+        columns = []
+        offset = 0
+        for name, typecode in self.COLUMNS:
+            columns.append([name, typecode, offset])
+            offset += _align8(self.rows * self.columns[name].itemsize)
+        header = json.dumps(
+            {
+                "rows": self.rows,
+                "byteorder": sys.byteorder,
+                "series": sorted(self.series, key=self.series.get),
+                "columns": columns,
+            }
+        ).encode()
+        header += b" " * (_align8(len(header)) - len(header))
+
+        with open(path, "wb") as f:
+            f.write(OTGTS_MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for name, typecode in self.COLUMNS:
+                data = memoryview(self.columns[name])[: self.rows]
+                f.write(data)
+                f.write(bytes(_align8(data.nbytes) - data.nbytes))
+        print("%s Recorded %d samples to %s" % (datetime.now(), self.rows, path))
+        self.files.append(path)
+        self.rows = 0
+
+
+OTGTS_MAGIC = b"OTGTS01\n"
+
+
+def _align8(n):
+    return (n + 7) & ~7
+
+
+def read_recording(path):
+    """
+    Memory-maps a file written by MetricsRecorder and returns the series
+    names and a dict of column name to a zero-copy memoryview of the column.
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm[:8] != OTGTS_MAGIC:
+        raise Exception("%s is not a metrics recording" % path)
+    header_len = struct.unpack_from("<Q", mm, 8)[0]
+    header = json.loads(bytes(mm[16 : 16 + header_len]))
+    if header["byteorder"] != sys.byteorder:
+        raise Exception("%s was recorded on a %s endian host" % (path, header["byteorder"]))
+
+    data = memoryview(mm)[16 + header_len :]
+    columns = {}
+    for name, typecode, offset in header["columns"]:
+        size = header["rows"] * array.array(typecode).itemsize
+        columns[name] = data[offset : offset + size].cast(typecode)
+    return header["series"], columns
+
+
+def replay_recording(paths):
+    # yields (timestamp, series name, {column: value}) for every recorded
+    # sample, in recording order
+    for path in paths:
+        series, columns = read_recording(path)
+        names = [name for name, _ in MetricsRecorder.COLUMNS[2:]]
+        for row in range(len(columns["timestamp"])):
+            yield (
+                columns["timestamp"][row],
+                series[columns["series"][row]],
+                dict((name, columns[name][row]) for name in names),
+            )
+
+
+class FlowSampler(object):
+    """
+    Polls only frames_tx and frames_rx of `flow_names` every
+    `interval_seconds` in the background and records them into `recorder`,
+    stamped with the middle of each request. Run it around withdraw_routes
+    or link_operation to get the counter resolution analyze_convergence
+    needs.
+    """
+
+    def __init__(self, api, flow_names, recorder, interval_seconds=0.05):
+        self.api = api
+        self.flow_names = flow_names
+        self.recorder = recorder
+        self.interval_seconds = interval_seconds
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        req = self.api.metrics_request()
+        req.flow.flow_names = self.flow_names
+        req.flow.metric_names = [req.flow.FRAMES_TX, req.flow.FRAMES_RX]
+        next_sample = time.monotonic()
+        while not self._stopped.is_set():
+            before = time.time()
+            metrics = self.api.get_metrics(req).flow_metrics
+            self.recorder.record("flow", metrics, (before + time.time()) / 2)
+            next_sample += self.interval_seconds
+            self._stopped.wait(max(0, next_sample - time.monotonic()))
+
+
+def analyze_convergence(files, series, threshold=0.5):
+    """
+    Finds traffic outages of `series` (e.g. "flow:bgpFlow") in recordings
+    written by MetricsRecorder. An interval is lossy when the frames received
+    in it fall below `threshold` times the frames sent in it, so the end of
+    traffic is not mistaken for an outage. Every run of lossy intervals is
+    one outage:
+
+    - start/end: placed inside the edge intervals from the frames lost in
+      them at that interval's tx rate
+    - duration: end - start, in seconds
+    - lost_frames: frames sent but not received across the outage
+    - confidence: 0..1, how well the edge timing agrees with lost_frames at
+      the tx rate, scaled down when the sampling interval is coarse compared
+      to the outage
+    """
+    t = array.array("d")
+    tx = array.array("Q")
+    rx = array.array("Q")
+    for path in files:
+        names, columns = read_recording(path)
+        if series not in names:
+            continue
+        index = names.index(series)
+        for row, s in enumerate(columns["series"]):
+            if s == index:
+                t.append(columns["timestamp"][row])
+                tx.append(columns["frames_tx"][row])
+                rx.append(columns["frames_rx"][row])
+
+    # per interval deltas, interval i spans t[i]..t[i+1]
+    dt = [b - a for a, b in zip(t, t[1:])]
+    dtx = [b - a for a, b in zip(tx, tx[1:])]
+    drx = [b - a for a, b in zip(rx, rx[1:])]
+    lossy = [s > 0 and r < threshold * s for s, r in zip(dtx, drx)]
+    if not any(lossy):
+        return []
+    resolution = sorted(dt)[len(dt) // 2]
+
+    # rising and falling edges of the lossy series
+    edges = [i for i in range(len(lossy)) if lossy[i] != (i > 0 and lossy[i - 1])]
+    if len(edges) % 2:
+        edges.append(len(lossy))
+
+    outages = []
+    for first, after in zip(edges[0::2], edges[1::2]):
+        # an outage edge covering less than `threshold` of its interval
+        # still belongs to the outage
+        if first > 0 and drx[first - 1] < 0.99 * dtx[first - 1]:
+            first -= 1
+        if after < len(lossy) and drx[after] < 0.99 * dtx[after]:
+            after += 1
+        last = after - 1
+        lost = sum(dtx[first:after]) - sum(drx[first:after])
+        rate = sum(dtx[first:after]) / sum(dt[first:after])
+        lost_first = (dtx[first] - drx[first]) * dt[first] / dtx[first]
+        lost_last = (dtx[last] - drx[last]) * dt[last] / dtx[last]
+        if first == last:
+            # both edges in one interval, assume it is centered
+            start = t[first] + (dt[first] - lost_first) / 2
+            end = start + lost_first
+        else:
+            start = t[first + 1] - lost_first
+            end = t[last] + lost_last
+        duration = end - start
+        from_loss = lost / rate
+        agreement = 1 - min(1, abs(duration - from_loss) / max(duration, from_loss, 1e-9))
+        outages.append(
+            {
+                "start": start,
+                "end": end,
+                "duration": duration,
+                "lost_frames": lost,
+                "confidence": agreement * from_loss / (from_loss + resolution),
+            }
+        )
+    return outages
+
+
+def print_convergence(files, series):
+    outages = analyze_convergence(files, series)
+    if not outages:
+        print("%s No outage found on %s" % (datetime.now(), series))
+    for o in outages:
+        print(
+            "%s Outage on %s from %s to %s: %.3f ms, %d frames lost, confidence %.2f"
+            % (
+                datetime.now(),
+                series,
+                datetime.fromtimestamp(o["start"]).time(),
+                datetime.fromtimestamp(o["end"]).time(),
+                o["duration"] * 1000,
+                o["lost_frames"],
+                o["confidence"],
+            )
+        )
+    return outages
+
+
+class MetricsCache(object):
+    """
+    Shares controller metrics and states between all predicates polled in the
+    same tick. `get(kind)` fetches a kind at most once per snapshot. A
+    snapshot is stamped with `timestamp` once its first fetch returned, and
+    the first `get` after it is older than `ttl_seconds` starts a new one, so
+    a fetch slower than `ttl_seconds` is still shared by the predicates
+    polled right after it.
+    """
+
+    def __init__(self, api, ttl_seconds=0.25):
+        self.api = api
+        self.ttl_seconds = ttl_seconds
+        self.timestamp = None
+        self.fetchers = {
+            "flow": get_flow_metrics,
+            "bgpv4": get_bgpv4_metrics,
+        }
+        self._values = {}
+        self._lock = threading.Lock()
+        self._kind_locks = {}
+        self._latest = {}
+
+    def get(self, kind):
+        # predicates run concurrently under wait_for_all, only one of them
+        # should hit the controller for a given kind while different kinds
+        # are fetched concurrently
+        with self._lock:
+            # a snapshot still fetching has no timestamp yet and never expires
+            if self.timestamp is not None and time.monotonic() - self.timestamp > self.ttl_seconds:
+                self.timestamp = None
+                self._values = {}
+            values = self._values
+            if kind in values:
+                return values[kind]
+            lock = self._kind_locks.setdefault(kind, threading.Lock())
+        with lock:
+            if kind not in values:
+                value = self.fetchers[kind](self.api)
+                fetched = time.monotonic()
+                values[kind] = value
+                self._latest[kind] = (fetched, value)
+                with self._lock:
+                    if self.timestamp is None and values is self._values:
+                        self.timestamp = fetched
+            return values[kind]
+
+    def latest(self, kind):
+        # the last `(timestamp, value)` fetched of `kind` or None, without
+        # fetching, for the eta predictions and failure watches of wait_for
+        return self._latest.get(kind)
+
+
+# gNMI list and leaf paths served by otg-gnmi-server, mapped to the snappi
+# metric attributes that get_flow_metrics/get_port_metrics/get_bgpv4_metrics
+# return
+GNMI_METRICS_PATHS = {
+    "flow": (
+        "flows",
+        "flow",
+        {
+            "state/transmit": "transmit",
+            "state/counters/out-pkts": "frames_tx",
+            "state/counters/in-pkts": "frames_rx",
+            "state/out-frame-rate": "frames_tx_rate",
+            "state/in-frame-rate": "frames_rx_rate",
+            "state/counters/out-octets": "bytes_tx",
+            "state/counters/in-octets": "bytes_rx",
+        },
+    ),
+    "port": (
+        "ports",
+        "port",
+        {
+            "state/transmit": "transmit",
+            "state/counters/out-frames": "frames_tx",
+            "state/counters/in-frames": "frames_rx",
+            "state/out-frame-rate": "frames_tx_rate",
+            "state/in-frame-rate": "frames_rx_rate",
+            "state/counters/out-octets": "bytes_tx",
+            "state/counters/in-octets": "bytes_rx",
+            "state/out-rate": "bytes_tx_rate",
+            "state/in-rate": "bytes_rx_rate",
+        },
+    ),
+    "bgpv4": (
+        "bgp-peers",
+        "bgp-peer",
+        {
+            "state/session-state": "session_state",
+            "state/counters/routes-advertised": "routes_advertised",
+            "state/counters/routes-received": "routes_received",
+        },
+    ),
+}
+
+# leaves of GNMI_METRICS_PATHS that are enums in snappi
+GNMI_ENUM_LEAVES = set(["state/transmit", "state/session-state"])
+
+
+class GnmiMetrics(object):
+    """
+    Keeps flow, port and bgpv4 metrics up to date from a gNMI STREAM
+    subscription to otg-gnmi-server instead of polling `api.get_metrics`.
+    The metrics are kept as the same snappi objects the REST helpers return
+    and updated every `sample_ms` milliseconds; `get` returns a copy of them
+    and raises once the subscription failed or ended, so waits do not pass
+    on stale or empty metrics. `fetchers` can replace the REST ones in a
+    MetricsCache.
+
+    Requires the `grpcio` and `pygnmi` packages. `credentials` are passed to
+    `grpc.secure_channel`, an insecure channel is used when they are None.
+    """
+
+    def __init__(self, api, location, sample_ms=100, credentials=None):
+        import grpc
+        from pygnmi.spec.v080 import gnmi_pb2, gnmi_pb2_grpc
+
+        self._pb = gnmi_pb2
+        self._api = api
+        self._location = location
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._closed = False
+        # why the subscription ended when it did not end by close()
+        self._error = None
+        self._response = api.metrics_response()
+        self._metrics = {
+            "flow": self._response.flow_metrics,
+            "port": self._response.port_metrics,
+            "bgpv4": self._response.bgpv4_metrics,
+        }
+        self._by_name = {kind: {} for kind in self._metrics}
+        self.fetchers = {
+            "flow": lambda api: self.get("flow"),
+            "port": lambda api: self.get("port"),
+            "bgpv4": lambda api: self.get("bgpv4"),
+        }
+
+        if credentials is None:
+            self._channel = grpc.insecure_channel(location)
+        else:
+            self._channel = grpc.secure_channel(location, credentials)
+        stub = gnmi_pb2_grpc.gNMIStub(self._channel)
+        self._stream = stub.Subscribe(iter([self._subscribe_request(sample_ms)]))
+
+        print("%s Subscribed to gNMI metrics on %s    ..." % (datetime.now(), location))
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    def get(self, kind, timeout_seconds=10):
+        # the initial snapshot is complete once the server sends sync_response
+        if not self._synced.wait(timeout_seconds):
+            raise Exception(
+                "No gNMI sync_response from %s within %ds" % (self._location, timeout_seconds)
+            )
+        with self._lock:
+            if self._error is not None:
+                raise Exception("gNMI metrics from %s are stale, %s" % (self._location, self._error))
+            # a copy, the receive thread keeps updating the metrics in place
+            items = [m.serialize(m.DICT) for m in self._metrics[kind]]
+        metrics = getattr(self._api.metrics_response(), kind + "_metrics")
+        for item in items:
+            metrics.add().deserialize(item)
+        return metrics
+
+    def close(self):
+        self._closed = True
+        self._stream.cancel()
+        self._channel.close()
+
+    def _subscribe_request(self, sample_ms):
+        pb = self._pb
+        subscriptions = [
+            pb.Subscription(
+                path=pb.Path(
+                    elem=[pb.PathElem(name=lst), pb.PathElem(name=item, key={"name": "*"})]
+                ),
+                mode=pb.SAMPLE,
+                sample_interval=sample_ms * 1000000,
+            )
+            for lst, item, _ in GNMI_METRICS_PATHS.values()
+        ]
+        return pb.SubscribeRequest(
+            subscribe=pb.SubscriptionList(
+                subscription=subscriptions,
+                mode=pb.SubscriptionList.STREAM,
+                encoding=pb.JSON,
+            )
+        )
+
+    def _receive(self):
+        import grpc
+
+        error = "subscription ended"
+        try:
+            for response in self._stream:
+                if response.sync_response:
+                    self._synced.set()
+                elif response.HasField("update"):
+                    with self._lock:
+                        self._apply(response.update)
+        except grpc.RpcError as e:
+            error = "subscription failed: %s %s" % (e.code(), e.details())
+        finally:
+            if not self._closed:
+                print("%s gNMI %s" % (datetime.now(), error))
+                with self._lock:
+                    self._error = error
+            # wakes up get, which raises
+            self._synced.set()
+
+    def _apply(self, notification):
+        prefix = list(notification.prefix.elem)
+        for u in notification.update:
+            elems = prefix + list(u.path.elem)
+            if len(elems) < 2:
+                continue
+            for kind, (lst, item, leaves) in GNMI_METRICS_PATHS.items():
+                if elems[0].name == lst and elems[1].name == item:
+                    break
+            else:
+                continue
+            m = self._metric(kind, elems[1].key["name"])
+            leaf = "/".join(e.name for e in elems[2:])
+            for path, value in _gnmi_leaves(leaf, _gnmi_value(u.val)):
+                if path not in leaves or value is None:
+                    continue
+                if path in GNMI_ENUM_LEAVES:
+                    # enums are upper case in gNMI and lower case in snappi
+                    value = value.lower()
+                setattr(m, leaves[path], value)
+
+    def _metric(self, kind, name):
+        m = self._by_name[kind].get(name)
+        if m is None:
+            m = self._metrics[kind].add(name=name)
+            self._by_name[kind][name] = m
+        return m
+
+
+def _gnmi_value(val):
+    choice = val.WhichOneof("value")
+    if choice is None:
+        # an update without a value
+        return None
+    if choice in ("json_val", "json_ietf_val"):
+        return json.loads(getattr(val, choice))
+    return getattr(val, choice)
+
+
+def _gnmi_leaves(path, value):
+    # JSON encoded updates may carry a whole subtree, flatten it to leaves
+    if isinstance(value, dict):
+        for k, v in value.items():
+            k = k.split(":")[-1]
+            for leaf in _gnmi_leaves(path + "/" + k if path else k, v):
+                yield leaf
+    else:
+        yield path, value
+
+
+class GnmiStandIn(object):
+    """
+    In-process stand-in for otg-gnmi-server to exercise GnmiMetrics without
+    a controller. `updates` maps `(kind, name)` to a dict of leaf path to
+    value, e.g. `{("flow", "bgpFlow"): {"state/counters/out-pkts": 10}}`, and
+    is streamed to every subscriber each `sample_ms`. Use `location` as the
+    GnmiMetrics location. With `fail_after_samples` every subscription is
+    aborted with UNAVAILABLE after that many samples, like a server going
+    away.
+    """
+
+    def __init__(self, updates, sample_ms=100, fail_after_samples=None):
+        import grpc
+        from concurrent import futures
+        from pygnmi.spec.v080 import gnmi_pb2, gnmi_pb2_grpc
+
+        standin = self
+
+        class Servicer(gnmi_pb2_grpc.gNMIServicer):
+            def Subscribe(self, request_iterator, context):
+                next(request_iterator)
+                yield gnmi_pb2.SubscribeResponse(update=standin.notification())
+                yield gnmi_pb2.SubscribeResponse(sync_response=True)
+                samples = 0
+                while context.is_active():
+                    time.sleep(sample_ms / 1000.0)
+                    samples += 1
+                    if fail_after_samples is not None and samples > fail_after_samples:
+                        context.abort(grpc.StatusCode.UNAVAILABLE, "stand-in went away")
+                    yield gnmi_pb2.SubscribeResponse(update=standin.notification())
+
+        self._pb = gnmi_pb2
+        self.updates = updates
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        gnmi_pb2_grpc.add_gNMIServicer_to_server(Servicer(), self.server)
+        self.location = "127.0.0.1:%d" % self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+
+    def notification(self):
+        pb = self._pb
+        notification = pb.Notification(timestamp=time.time_ns())
+        for (kind, name), leaves in self.updates.items():
+            lst, item, _ = GNMI_METRICS_PATHS[kind]
+            for leaf, value in leaves.items():
+                elems = [pb.PathElem(name=lst), pb.PathElem(name=item, key={"name": name})]
+                elems += [pb.PathElem(name=e) for e in leaf.split("/")]
+                if value is None:
+                    val = pb.TypedValue()
+                else:
+                    val = pb.TypedValue(json_val=json.dumps(value).encode())
+                notification.update.add(path=pb.Path(elem=elems), val=val)
+        return notification
+
+    def stop(self):
+        self.server.stop(None)
+
+
+class TrafficEta(object):
+    """
+    Predicts how many seconds are left until transmit ends, to pass as the
+    `eta` of wait_for. The end is first taken from the configured duration,
+    `packets` at `pps` or `seconds`, counted from when the TrafficEta is
+    created, so create it right after start_transmit. Once `metrics` returns
+    the latest `(timestamp, flow metrics)` with flows sending, the end moves
+    to when the slowest of them is done at its observed frames_tx_rate.
+    """
+
+    def __init__(self, metrics=None, packets=None, pps=None, seconds=None):
+        self.metrics = metrics
+        self.packets = packets
+        self.seconds = seconds if seconds is not None else packets / float(pps)
+        self.end = time.monotonic() + self.seconds
+
+    def __call__(self):
+        latest = None if self.metrics is None else self.metrics()
+        if latest is not None:
+            timestamp, metrics = latest
+            left = [
+                (self.packets - m.frames_tx) / m.frames_tx_rate
+                if self.packets is not None
+                else self.seconds - m.frames_tx / m.frames_tx_rate
+                for m in metrics
+                if m.transmit == m.STARTED and m.frames_tx_rate
+            ]
+            if left:
+                self.end = timestamp + max(left)
+        return self.end - time.monotonic()
+
+
+class SessionEta(object):
+    """
+    Predicts how many seconds are left until every BGP session is up from
+    the rate sessions came up at since the SessionEta was created, to pass
+    as the `eta` of wait_for; create it right after start_protocols.
+    `metrics` returns the latest `(timestamp, bgpv4 metrics)`. There is no
+    prediction until a session came up.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.monotonic()
+
+    def __call__(self):
+        latest = self.metrics()
+        if latest is None:
+            return None
+        timestamp, metrics = latest
+        up = sum(1 for m in metrics if m.session_state == m.UP)
+        if up == 0 or timestamp <= self.start:
+            return None
+        rate = up / (timestamp - self.start)
+        return timestamp + (len(metrics) - up) / rate - time.monotonic()
+
+
+def fail_fast(func, *watches):
+    """
+    Wraps a wait_for predicate so that the wait fails as soon as one of
+    `watches`, e.g. a FlowWatch, tells the condition can no longer turn
+    true, instead of at its timeout. A watch is called after every false
+    poll and returns a diagnosis string or None.
+    """
+
+    def check():
+        if func():
+            return True
+        for watch in watches:
+            diagnosis = watch()
+            if diagnosis is not None:
+                raise Exception("Stopped waiting early, %s" % diagnosis)
+        return False
+
+    return check
+
+
+class FlowWatch(object):
+    """
+    Spots flows that cannot reach the end their wait expects, for fail_fast.
+    `metrics` returns the latest `(timestamp, flow metrics)`. When every
+    flow is expected to deliver exactly `packets` frames, a flow is
+    diagnosed as soon as it
+    - sent or received more than `packets` frames
+    - stopped before sending `packets` frames
+    - stopped with frames missing and received nothing for `drain_seconds`
+
+    A flow that is started but sends nothing, or receives nothing while it
+    still sends, may recover, e.g. during a convergence test, so it is only
+    diagnosed once that lasted `stall_seconds`, counted from the first
+    metrics of the flow. The default is well above the sub-second outages
+    the convergence labs expect, pass None to leave stalls to the timeout of
+    the wait.
+    """
+
+    def __init__(self, metrics, packets=None, stall_seconds=10, drain_seconds=5):
+        self.metrics = metrics
+        self.packets = packets
+        self.stall_seconds = stall_seconds
+        self.drain_seconds = drain_seconds
+        self.timestamp = None
+        # flow name -> [frames_tx, tx changed at, frames_rx, rx changed at]
+        self.flows = {}
+
+    def __call__(self):
+        latest = self.metrics()
+        if latest is None or latest[0] == self.timestamp:
+            return None
+        self.timestamp, metrics = latest
+        now = self.timestamp
+        for m in metrics:
+            seen = self.flows.setdefault(m.name, [m.frames_tx, now, m.frames_rx, now])
+            if m.frames_tx != seen[0]:
+                seen[0:2] = [m.frames_tx, now]
+            if m.frames_rx != seen[2]:
+                seen[2:4] = [m.frames_rx, now]
+
+            if self.stall_seconds is not None and m.transmit == m.STARTED:
+                if now - seen[1] >= self.stall_seconds:
+                    return "flow %s is started but sent no frames for %.1fs (frames_tx %d)" % (
+                        m.name,
+                        now - seen[1],
+                        m.frames_tx,
+                    )
+                if m.frames_rx < m.frames_tx and now - seen[3] >= self.stall_seconds:
+                    return "flow %s received no frames for %.1fs, %d of %d sent frames missing" % (
+                        m.name,
+                        now - seen[3],
+                        m.frames_tx - m.frames_rx,
+                        m.frames_tx,
+                    )
+            if self.packets is None:
+                continue
+            if m.frames_tx > self.packets or m.frames_rx > self.packets:
+                return "flow %s sent %d and received %d frames, more than the %d configured" % (
+                    m.name,
+                    m.frames_tx,
+                    m.frames_rx,
+                    self.packets,
+                )
+            if m.transmit == m.STOPPED and 0 < m.frames_tx < self.packets:
+                return "flow %s stopped after sending %d of %d frames" % (
+                    m.name,
+                    m.frames_tx,
+                    self.packets,
+                )
+            if (
+                m.transmit == m.STOPPED
+                and m.frames_rx < m.frames_tx
+                and now - max(seen[1], seen[3]) >= self.drain_seconds
+            ):
+                return "flow %s stopped and received nothing for %.1fs, %d of %d sent frames missing" % (
+                    m.name,
+                    now - max(seen[1], seen[3]),
+                    m.frames_tx - m.frames_rx,
+                    m.frames_tx,
+                )
+        return None
+
+
+class BgpWatch(object):
+    """
+    Spots BGP peering that cannot come up, for fail_fast. `metrics` returns
+    the latest `(timestamp, bgpv4 metrics)`. Peering is diagnosed once no
+    session state or route count of any peer changed for `stall_seconds`,
+    counted from the first metrics. That defaults to 30s, the default OTG
+    keepalive interval: long enough for a peer to answer an OPEN, and short
+    enough to end the 60s waits of the labs early. A session going down
+    after being up counts as a change like any other, so peering that flaps
+    is left to the timeout of the wait.
+    """
+
+    def __init__(self, metrics, stall_seconds=30):
+        self.metrics = metrics
+        self.stall_seconds = stall_seconds
+        self.state = None
+        self.changed = None
+        self.up = set()
+
+    def __call__(self):
+        latest = self.metrics()
+        if latest is None:
+            return None
+        timestamp, metrics = latest
+        self.up.update(m.name for m in metrics if m.session_state == m.UP)
+
+        state = [(m.name, m.session_state, m.routes_advertised, m.routes_received) for m in metrics]
+        if state != self.state:
+            self.changed = timestamp
+            self.state = state
+            return None
+        if timestamp - self.changed < self.stall_seconds:
+            return None
+        down = [
+            m.name + (" (up before)" if m.name in self.up else "")
+            for m in metrics
+            if m.session_state == m.DOWN
+        ]
+        if down:
+            return "BGP sessions %s down for %.1fs with %d routes received" % (
+                ", ".join(down),
+                timestamp - self.changed,
+                sum(m.routes_received for m in metrics),
+            )
+        return "BGP routes unchanged for %.1fs at %s (advertised/received)" % (
+            timestamp - self.changed,
+            ", ".join("%s %d/%d" % (m.name, m.routes_advertised, m.routes_received) for m in metrics),
+        )
+
+
+def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None, eta=None):
     """
     Keeps calling the `func` until it returns true or `timeout_seconds` occurs
     every `interval_seconds`. `condition_str` should be a constant string
-    implying the actual condition being tested.
+    implying the actual condition being tested. `eta`, e.g. a TrafficEta,
+    returns the predicted seconds until `func` turns true, see wait_for_all.
 
     Usage
     -----
@@ -464,29 +2538,92 @@ def wait_for(func, condition_str, interval_seconds=None, timeout_seconds=None):
         poll_until(condition_satisfied, condition_str, **kwargs)
     ```
     """
+    wait_for_all([(func, condition_str, timeout_seconds, eta)], interval_seconds)
+
+
+def wait_for_all(conditions, interval_seconds=None):
+    """
+    Waits for every `(func, condition_str, timeout_seconds)` in `conditions`
+    at the same time. Each `func` is polled on its own every
+    `interval_seconds` and stops being polled as soon as it returns true;
+    a condition that is still false after its own `timeout_seconds` raises
+    and cancels the others.
+
+    A condition can have a fourth item `eta`, a callable returning the
+    predicted seconds until `func` turns true or None when it cannot tell.
+    It is asked again after every poll. While a prediction is further out
+    than `interval_seconds` the condition is polled up to three intervals
+    apart until `interval_seconds` before it, so one bad prediction costs
+    little and the fail_fast watches of `func` keep running. From there it
+    is polled five times as often until one interval past the prediction,
+    then every `interval_seconds` again.
+
+    Usage
+    -----
+    ```
+    wait_for_all(
+        [
+            (lambda: bgp_metrics_ok(cache, tc), "correct bgp peering", 60),
+            (lambda: bgp_prefixes_ok(cache, tc), "correct bgp prefixes", 60),
+        ]
+    )
+    ```
+    """
     if interval_seconds is None:
-        interval_seconds = 1
+        interval_seconds = 0.5
+    asyncio.run(_wait_for_all(conditions, interval_seconds))
+
+
+async def _wait_for_all(conditions, interval_seconds):
+    tasks = [
+        asyncio.ensure_future(
+            _wait_for_condition(func, condition_str, interval_seconds, timeout_seconds, *eta)
+        )
+        for func, condition_str, timeout_seconds, *eta in conditions
+    ]
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    for t in pending:
+        t.cancel()
+    for t in done:
+        t.result()
+
+
+async def _wait_for_condition(func, condition_str, interval_seconds, timeout_seconds, eta=None):
     if timeout_seconds is None:
         timeout_seconds = 60
-    start_seconds = int(time.time())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout_seconds
 
     print('\n\nWaiting for %s ...' % condition_str)
     while True:
-        if func():
+        # predicates do blocking controller calls, keep them off the event loop
+        if await loop.run_in_executor(None, func):
             print('Done waiting for %s' % condition_str)
-            break
-        if (int(time.time()) - start_seconds) >= timeout_seconds:
+            return
+        if loop.time() >= deadline:
             msg = 'Time out occurred while waiting for %s' % condition_str
             raise Exception(msg)
 
-        time.sleep(interval_seconds)
-    
+        await asyncio.sleep(min(_poll_delay(eta, interval_seconds), deadline - loop.time()))
+
+
+def _poll_delay(eta, interval_seconds):
+    remaining = None if eta is None else eta()
+    if remaining is None or remaining < -interval_seconds:
+        return interval_seconds
+    if remaining > interval_seconds:
+        # e.g. a frames_tx_rate sampled while the flows ramp up predicts an
+        # end far too late
+        return min(remaining - interval_seconds, 3 * interval_seconds)
+    return interval_seconds / 5
+
 
 class Table(object):
-    def __init__(self, title, headers, col_width=15):
+    def __init__(self, title, headers, col_width=15, max_rows=None):
         self.title = title
         self.headers = headers
         self.col_width = col_width
+        self.max_rows = max_rows
         self.rows = []
 
     def append_row(self, row):
@@ -496,28 +2633,45 @@ class Table(object):
 
         self.rows.append(row)
 
-    def __str__(self):
-        out = ""
+    def write(self, stream, chunk_rows=1000):
+        """
+        Writes the table to `stream`, `chunk_rows` rows per write. When
+        `max_rows` is set only the first `max_rows` rows are written followed
+        by a line summarizing how many were left out.
+        """
         border = "-" * (len(self.headers) * self.col_width)
+        # one format string per row length instead of one per cell
+        formats = {}
+        cell = "%%-%ds" % self.col_width
+
+        def row_format(n):
+            if n not in formats:
+                formats[n] = cell * n + "\n"
+            return formats[n]
+
+        stream.write("\n%s\n%s\n%s\n" % (border, self.title, border))
+        stream.write(row_format(len(self.headers)) % tuple(self.headers))
+
+        shown = len(self.rows)
+        if self.max_rows is not None and shown > self.max_rows:
+            shown = self.max_rows
+        for start in range(0, shown, chunk_rows):
+            end = min(start + chunk_rows, shown)
+            stream.write(
+                "".join(
+                    row_format(len(row)) % tuple(row) for row in self.rows[start:end]
+                )
+            )
+        if shown < len(self.rows):
+            stream.write("... %d more rows (%d total)\n" % (len(self.rows) - shown, len(self.rows)))
 
-        out += "\n"
-        out += border
-        out += "\n%s\n" % self.title
-        out += border
-        out += "\n"
-
-        for h in self.headers:
-            out += ("%%-%ds" % self.col_width) % str(h)
-        out += "\n"
-
-        for row in self.rows:
-            for r in row:
-                out += ("%%-%ds" % self.col_width) % str(r)
-            out += "\n"
-        out += border
-        out += "\n\n"
+        stream.write(border)
+        stream.write("\n\n")
 
-        return out
+    def __str__(self):
+        out = io.StringIO()
+        self.write(out)
+        return out.getvalue()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,400 @@
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import mock_otg
+
+## Benchmarks the client side hot paths of a lab script at several scales,
+## against payloads generated by the mock controller, so no controller is
+## needed:
+##
+##   config_build        ebgp_route_prefix_config built and serialized
+##   config_bulk         bgp_bulk_devices for `--peers` peers
+##   flow_metrics_parse  a get_metrics response of `--flows` flows
+##                       deserialized and checked field by field
+##   table_render        a flow metrics Table of `--flows` rows rendered
+##   prefix_match        RouteIndex.diff over `--routes` routes per family
+##                       split over `--peers` peers, every peer learning the
+##                       routes of the others
+##
+## Cases whose helpers the lab script does not have are skipped, e.g.
+## config_build and prefix_match for lab-04.
+##
+## Results are stored per git commit and lab script under BENCH_DIR. Every
+## run is compared with the results of the same lab script at the nearest
+## ancestor commit that has any (HEAD itself when the work tree has changes)
+## and fails when a case loses more than `--tolerance` of its throughput or
+## grows its peak memory by more than `--memory-tolerance`. Results are only
+## stored for a clean work tree, so a baseline always belongs to its commit.
+##
+##   python tools/bench.py
+##   python tools/bench.py --flows 1000 10000 --peers 2 16 --routes 100000
+
+BENCH_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ac2-workshop", "bench")
+DEFAULT_LAB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lab-02", "lab-02_test.py")
+
+
+def load_lab(path):
+    name = os.path.splitext(os.path.basename(path))[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, path)
+    m = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(m)
+    return m
+
+
+def test_const(route_count=5):
+    # the constants of Test_ebgp_route_prefix
+    return {
+        "pktRate": 200,
+        "pktCount": 1000,
+        "pktSize": 128,
+        "txMac": "00:00:01:01:01:01",
+        "txIp": "1.1.1.1",
+        "txGateway": "1.1.1.2",
+        "txPrefix": 24,
+        "txAs": 1111,
+        "rxMac": "00:00:01:01:01:02",
+        "rxIp": "1.1.1.2",
+        "rxGateway": "1.1.1.1",
+        "rxPrefix": 4,
+        "rxAs": 1112,
+        "txRouteCount": route_count,
+        "rxRouteCount": route_count,
+        "txNextHopV4": "1.1.1.3",
+        "txNextHopV6": "::1:1:1:3",
+        "rxNextHopV4": "1.1.1.4",
+        "rxNextHopV6": "::1:1:1:4",
+        "txAdvRouteV4": "10.10.10.1",
+        "rxAdvRouteV4": "20.20.20.1",
+        "txAdvRouteV6": "::10:10:10:1",
+        "rxAdvRouteV6": "::20:20:20:1",
+    }
+
+
+def peer_tables(peers, routes):
+    # `peers` eBGP peers on their own port each advertising `routes` v4 and
+    # v6 routes from disjoint ranges, in the column layout of bgp_bulk_devices
+    peer_rows = {
+        "name": ["d%d" % i for i in range(peers)],
+        "port": ["p%d" % i for i in range(peers)],
+        "mac": ["00:00:01:01:%02x:%02x" % (i >> 8, i & 0xFF) for i in range(peers)],
+        "ip": ["1.1.%d.%d" % (i >> 7, (i & 0x7F) * 2 + 1) for i in range(peers)],
+        "gateway": ["1.1.%d.%d" % (i >> 7, (i & 0x7F) * 2 + 2) for i in range(peers)],
+        "prefix": [24] * peers,
+        "as_number": [1111 + i for i in range(peers)],
+        "as_type": ["ebgp"] * peers,
+    }
+    route_rows = {
+        "name": [],
+        "peer": [],
+        "version": [],
+        "address": [],
+        "prefix": [],
+        "count": [],
+        "step": [],
+        "next_hop": [],
+    }
+    for i in range(peers):
+        for version, address, prefix, next_hop in [
+            (4, mock_otg._address("ipv4", (10 << 24) + i * routes), 32, "1.1.%d.%d" % (i >> 7, (i & 0x7F) * 2 + 1)),
+            (6, "2001:db8:%x::" % i, 128, "::1:1:%x:1" % i),
+        ]:
+            route_rows["name"].append("d%d_rrv%d" % (i, version))
+            route_rows["peer"].append(i)
+            route_rows["version"].append(version)
+            route_rows["address"].append(address)
+            route_rows["prefix"].append(prefix)
+            route_rows["count"].append(routes)
+            route_rows["step"].append(1)
+            route_rows["next_hop"].append(next_hop)
+    return peer_rows, route_rows
+
+
+# cases, each returning `(func, items)` for one scale
+
+def config_build(lab, api, scale):
+    tc = test_const()
+
+    def run():
+        lab.ebgp_route_prefix_config(api, tc).serialize()
+
+    return run, 1
+
+
+def config_bulk(lab, api, scale):
+    peers, routes = peer_tables(scale["peers"], 1)
+
+    def run():
+        lab.bgp_bulk_devices(peers, routes)
+
+    return run, scale["peers"]
+
+
+def flow_metrics_payload(flows):
+    tc = test_const()
+    sim = mock_otg.Simulator(bgp_up_ms=0)
+    sim.set_config(
+        {
+            "ports": [{"name": "ptx"}, {"name": "prx"}],
+            "flows": [
+                {
+                    "name": "f%d" % i,
+                    "tx_rx": {"choice": "port", "port": {"tx_name": "ptx", "rx_names": ["prx"]}},
+                    "size": {"choice": "fixed", "fixed": tc["pktSize"]},
+                    "rate": {"choice": "pps", "pps": tc["pktRate"]},
+                    "duration": {"choice": "fixed_packets", "fixed_packets": {"packets": tc["pktCount"]}},
+                }
+                for i in range(flows)
+            ],
+        }
+    )
+    sim.set_control_state({"choice": "traffic", "traffic": {"flow_transmit": {"state": "start"}}})
+    return json.dumps({"choice": "flow_metrics", "flow_metrics": sim.flow_metrics([])})
+
+
+def flow_metrics_parse(lab, api, scale):
+    payload = flow_metrics_payload(scale["flows"])
+    tc = test_const()
+
+    def run():
+        # what api.get_metrics and flow_metrics_ok do with the response
+        done = 0
+        for m in api.metrics_response().deserialize(payload).flow_metrics:
+            if m.transmit == m.STOPPED and m.frames_tx == tc["pktCount"] and m.frames_rx == tc["pktCount"]:
+                done += 1
+        return done
+
+    return run, scale["flows"]
+
+
+def table_render(lab, api, scale):
+    metrics = json.loads(flow_metrics_payload(scale["flows"]))["flow_metrics"]
+    columns = ["name", "transmit", "frames_tx", "frames_rx", "frames_tx_rate", "frames_rx_rate", "bytes_tx", "bytes_rx"]
+
+    def run():
+        tb = lab.Table(
+            "Flow Metrics",
+            ["Name", "State", "Frames Tx", "Frames Rx", "FPS Tx", "FPS Rx", "Bytes Tx", "Bytes Rx"],
+        )
+        for m in metrics:
+            tb.append_row([m[c] for c in columns])
+        str(tb)
+
+    return run, scale["flows"]
+
+
+def prefix_match(lab, api, scale):
+    peers = scale["peers"]
+    routes = max(1, scale["routes"] // peers)
+    peer_rows, route_rows = peer_tables(peers, routes)
+    payload = lab.bgp_bulk_devices(peer_rows, route_rows)
+    config = api.config().deserialize('{"devices":%s}' % payload)
+    sim = mock_otg.Simulator(bgp_up_ms=0)
+    sim.set_config(json.loads('{"ports":[%s],"devices":%s}' % (",".join('{"name":"%s"}' % p for p in peer_rows["port"]), payload)))
+    sim.set_control_state({"choice": "protocol", "protocol": {"choice": "all", "all": {"state": "start"}}})
+    # decoded once, the way iter_bgp_prefixes hands them over
+    shards = []
+    for family in ["ipv4", "ipv6"]:
+        for s in json.loads(sim.bgp_prefixes([], [family]))["bgp_prefixes"]:
+            shards.append((s["bgp_peer_name"], family, s[family + "_unicast_prefixes"]))
+    index = lab.RouteIndex(config)
+
+    def run():
+        diff = index.diff(iter(shards))
+        if any(diff.values()):
+            raise Exception("prefix_match: unexpected diff %s" % {k: len(v) for k, v in diff.items()})
+
+    return run, sum(len(s[2]) for s in shards)
+
+
+# name, case, scale parameters, lab helpers the case needs
+CASES = [
+    ("config_build", config_build, [], ["ebgp_route_prefix_config"]),
+    ("config_bulk", config_bulk, ["peers"], ["bgp_bulk_devices"]),
+    ("flow_metrics_parse", flow_metrics_parse, ["flows"], []),
+    ("table_render", table_render, ["flows"], ["Table"]),
+    ("prefix_match", prefix_match, ["peers", "routes"], ["bgp_bulk_devices", "RouteIndex"]),
+]
+
+
+def measure(func, items, repeat, min_seconds):
+    """
+    Returns items per second of the fastest of `repeat` rounds, a round
+    calling `func` until it took at least `min_seconds`, and the peak
+    traced memory of one more call in KiB.
+    """
+    best = None
+    for _ in range(repeat):
+        calls = 0
+        gc.collect()
+        start = time.perf_counter()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                break
+        per_call = elapsed / calls
+        if best is None or per_call < best:
+            best = per_call
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return items / best, peak / 1024.0
+
+
+def run_cases(lab, api, args):
+    results = {}
+    for name, case, params, needs in CASES:
+        if args.cases and name not in args.cases:
+            continue
+        missing = [n for n in needs if not hasattr(lab, n)]
+        if missing:
+            print("%s Skipping %s, the lab has no %s" % (datetime.now(), name, ", ".join(missing)))
+            continue
+        grids = [{}]
+        for p in params:
+            grids = [dict(g, **{p: v}) for g in grids for v in getattr(args, p)]
+        for scale in grids:
+            key = name + "".join(" %s=%d" % (p, scale[p]) for p in params)
+            print("%s Running %s    ..." % (datetime.now(), key))
+            func, items = case(lab, api, scale)
+            throughput, peak = measure(func, items, args.repeat, args.min_seconds)
+            results[key] = {"items_per_second": throughput, "peak_kib": peak}
+    return results
+
+
+def git(*args):
+    return subprocess.run(
+        ["git"] + list(args), capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def results_file(bench_dir, commit, lab_path):
+    # results of one lab script at one commit
+    lab = os.path.splitext(os.path.basename(lab_path))[0]
+    return os.path.join(bench_dir, "%s.%s.json" % (commit, lab))
+
+
+def find_baseline(bench_dir, lab_path):
+    # nearest commit with stored results of the lab script, HEAD only counts
+    # when the work tree has changes since those are what is measured
+    # against it
+    head = git("rev-parse", "HEAD")
+    dirty = bool(git("status", "--porcelain", "--untracked-files=no"))
+    for commit in git("rev-list", "--max-count=500", "HEAD").split():
+        if commit == head and not dirty:
+            continue
+        path = results_file(bench_dir, commit, lab_path)
+        if os.path.exists(path):
+            return commit, path
+    return None, None
+
+
+def compare(lab, results, baseline, tolerance, memory_tolerance):
+    """
+    Prints every case next to its baseline and returns the ones that
+    regressed. Cases or scales the baseline does not have are not checked.
+    """
+    tb = lab.Table(
+        "Benchmarks",
+        ["Items/s", "Baseline", "Peak KiB", "Baseline", "Status", "Case"],
+    )
+    regressions = []
+    for key, r in results.items():
+        b = baseline.get(key)
+        status = "new"
+        if b is not None:
+            status = "ok"
+            if r["items_per_second"] < b["items_per_second"] * (1 - tolerance):
+                status = "SLOWER"
+            elif r["peak_kib"] > b["peak_kib"] * (1 + memory_tolerance):
+                status = "MEMORY"
+            if status != "ok":
+                regressions.append(key)
+        tb.append_row(
+            [
+                "%.1f" % r["items_per_second"],
+                "-" if b is None else "%.1f" % b["items_per_second"],
+                "%.1f" % r["peak_kib"],
+                "-" if b is None else "%.1f" % b["peak_kib"],
+                status,
+                key,
+            ]
+        )
+    print(tb)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client side hot path benchmarks")
+    parser.add_argument("--lab", default=DEFAULT_LAB, help="lab script whose helpers are benchmarked")
+    parser.add_argument("--cases", nargs="*", help="only run these cases")
+    parser.add_argument("--flows", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--peers", type=int, nargs="+", default=[2, 16])
+    parser.add_argument("--routes", type=int, nargs="+", default=[1000, 50000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-seconds", type=float, default=0.2)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed loss of throughput")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1, help="allowed growth of peak memory")
+    parser.add_argument("--bench-dir", default=BENCH_DIR)
+    parser.add_argument("--baseline", help="results file to compare with instead of the nearest commit's")
+    args = parser.parse_args()
+
+    # paths given on the command line are relative to where bench was run
+    args.lab = os.path.abspath(args.lab)
+    args.bench_dir = os.path.abspath(args.bench_dir)
+    if args.baseline is not None:
+        args.baseline = os.path.abspath(args.baseline)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    lab = load_lab(args.lab)
+    api = lab.snappi.api(location="http://127.0.0.1:%d" % mock_otg.DEFAULT_PORT)
+    results = run_cases(lab, api, args)
+
+    baseline_path = args.baseline
+    if baseline_path is None:
+        commit, baseline_path = find_baseline(args.bench_dir, args.lab)
+        if commit is not None:
+            print("%s Comparing with %s    ..." % (datetime.now(), commit[:12]))
+    baseline = {}
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(lab, results, baseline, args.tolerance, args.memory_tolerance)
+
+    if not git("status", "--porcelain", "--untracked-files=no"):
+        head = git("rev-parse", "HEAD")
+        os.makedirs(args.bench_dir, exist_ok=True)
+        path = results_file(args.bench_dir, head, args.lab)
+        # merged so that runs of different cases or scales add up
+        stored = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)["results"]
+        stored.update(results)
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "commit": head,
+                    "lab": os.path.relpath(args.lab, os.path.dirname(os.path.abspath(__file__))),
+                    "timestamp": datetime.now().isoformat(),
+                    "results": stored,
+                },
+                f,
+                indent=2,
+            )
+        print("%s Results stored in %s" % (datetime.now(), path))
+
+    if regressions:
+        raise Exception("Benchmarks regressed: %s" % ", ".join(regressions))
@@ -0,0 +1,603 @@
+import argparse
+import json
+import random
+import socket
+import ssl
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+## Offline stand-in for keng-controller, so client side hot paths can be
+## benchmarked and profiled without the controller, traffic and protocol
+## engines. It serves the OTG endpoints the labs use and simulates:
+##
+##   - flow counters from `rate`, `size` and `duration` (fixed_packets,
+##     fixed_seconds or continuous), with frames lost while a flow's
+##     receivers are unreachable and for `--convergence-ms` after one of
+##     several receivers goes away
+##   - port counters, link up/down and capture state
+##   - BGP sessions coming up `--bgp-up-ms` after start_protocols, every peer
+##     learning every route range advertised by the other peers, withdraw and
+##     advertise of routes
+##
+## `--latency-ms`/`--jitter-ms` delay every response and `--time-scale`
+## speeds simulated time up, e.g. 10 runs a 20s traffic test in 2s.
+##
+##   python tools/mock_otg.py --port 8443 --latency-ms 2
+##   api = snappi.api(location="http://127.0.0.1:8443")
+
+DEFAULT_PORT = 8443
+
+# line rate assumed for percentage rates
+LINE_RATE_BPS = 10 * 10**9
+
+
+def _address(family, n):
+    if family == "ipv4":
+        return socket.inet_ntop(socket.AF_INET, n.to_bytes(4, "big"))
+    return socket.inet_ntop(socket.AF_INET6, n.to_bytes(16, "big"))
+
+
+def _int_address(family, address):
+    af = socket.AF_INET if family == "ipv4" else socket.AF_INET6
+    return int.from_bytes(socket.inet_pton(af, address), "big")
+
+
+class Simulator(object):
+    def __init__(self, time_scale=1.0, bgp_up_ms=1000, convergence_ms=100):
+        self.time_scale = time_scale
+        self.bgp_up_seconds = bgp_up_ms / 1000.0
+        self.convergence_seconds = convergence_ms / 1000.0
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.set_config({})
+
+    def now(self):
+        return (time.perf_counter() - self.origin) * self.time_scale
+
+    # config
+
+    def set_config(self, config):
+        self.config = config
+        self.ports = {}
+        self.port_of = {}
+        self.peers = {}
+        self.routes = {}
+        self.flows = {}
+        self.protocols = False
+        self.bgp_up = False
+        self.withdrawn = set()
+        self.down_ports = set()
+        self.scheduled = []
+        # bumped on every change of what the peers learn
+        self.version = 0
+        self.prefix_cache = {}
+
+        for p in config.get("ports", []):
+            self.ports[p["name"]] = {"location": p.get("location", ""), "capture": False}
+            self.port_of[p["name"]] = p["name"]
+        for d in config.get("devices", []):
+            addresses = {}
+            for eth in d.get("ethernets", []):
+                port = eth.get("connection", {}).get("port_name", eth.get("port_name"))
+                self.port_of[d["name"]] = port
+                self.port_of[eth["name"]] = port
+                for family in ["ipv4", "ipv6"]:
+                    for ip in eth.get(family + "_addresses", []):
+                        self.port_of[ip["name"]] = port
+                        addresses[ip["name"]] = ip["address"]
+            bgp = d.get("bgp", {})
+            for family in ["ipv4", "ipv6"]:
+                for intf in bgp.get(family + "_interfaces", []):
+                    port = self.port_of.get(intf[family + "_name"])
+                    for peer in intf.get("peers", []):
+                        self._add_peer(peer, port, family, addresses.get(intf[family + "_name"]))
+        for f in config.get("flows", []):
+            self._add_flow(f)
+        self._update_reachability(self.now())
+
+    def _add_peer(self, peer, port, family, local_address):
+        self.port_of[peer["name"]] = port
+        routes = []
+        for route_family, key in [("ipv4", "v4_routes"), ("ipv6", "v6_routes")]:
+            for r in peer.get(key, []):
+                if r.get("next_hop_mode", "local_ip") == "manual":
+                    if r.get("next_hop_address_type", "ipv4") == "ipv4":
+                        next_hop = ("ipv4", r.get("next_hop_ipv4_address", "0.0.0.0"))
+                    else:
+                        next_hop = ("ipv6", r.get("next_hop_ipv6_address", "::0"))
+                    next_hop = (next_hop[0], _address(next_hop[0], _int_address(*next_hop)))
+                else:
+                    next_hop = (family, local_address or ("0.0.0.0" if family == "ipv4" else "::"))
+                ranges = []
+                bits = 32 if route_family == "ipv4" else 128
+                for a in r.get("addresses", []):
+                    prefix = a.get("prefix", 24 if route_family == "ipv4" else 64)
+                    shift = bits - prefix
+                    network = _int_address(route_family, a["address"]) >> shift << shift
+                    ranges.append((network, prefix, a.get("count", 1), a.get("step", 1) << shift))
+                route = {
+                    "name": r["name"],
+                    "peer": peer["name"],
+                    "family": route_family,
+                    "ranges": ranges,
+                    "next_hop": next_hop,
+                    "count": sum(c for _, _, c, _ in ranges),
+                }
+                self.routes[r["name"]] = route
+                self.port_of[r["name"]] = port
+                routes.append(route)
+        self.peers[peer["name"]] = {"name": peer["name"], "port": port, "routes": routes}
+
+    def _add_flow(self, f):
+        tx_rx = f.get("tx_rx", {})
+        if tx_rx.get("choice") == "port":
+            tx_names = [tx_rx["port"]["tx_name"]]
+            rx_names = tx_rx["port"].get("rx_names") or [tx_rx["port"].get("rx_name")]
+        else:
+            tx_names = tx_rx.get("device", {}).get("tx_names", [])
+            rx_names = tx_rx.get("device", {}).get("rx_names", [])
+        flow = {
+            "name": f["name"],
+            "tx_names": tx_names,
+            "rx_names": [n for n in rx_names if n is not None],
+            "start": None,
+            "stop": None,
+            "base_tx": 0,
+            "base_rx": 0,
+            "outages": [],
+            "reachable": False,
+            "available": set(),
+        }
+        self._set_flow_rate(flow, f)
+        self.flows[f["name"]] = flow
+
+    def _set_flow_rate(self, flow, f):
+        size = f.get("size", {})
+        choice = size.get("choice", "fixed")
+        if choice == "increment" or choice == "random":
+            s = size[choice]
+            flow["size"] = (s.get("start", s.get("min", 64)) + s.get("end", s.get("max", 1518))) / 2.0
+        else:
+            flow["size"] = size.get("fixed", 64)
+
+        rate = f.get("rate", {})
+        choice = rate.get("choice", "pps")
+        bits = (flow["size"] + 20) * 8
+        if choice == "pps":
+            flow["pps"] = float(rate.get("pps", 1000))
+        elif choice == "percentage":
+            flow["pps"] = LINE_RATE_BPS * float(rate["percentage"]) / 100 / bits
+        else:
+            scale = {"bps": 1, "kbps": 10**3, "mbps": 10**6, "gbps": 10**9}[choice]
+            flow["pps"] = float(rate[choice]) * scale / bits
+
+        duration = f.get("duration", {})
+        choice = duration.get("choice", "fixed_packets")
+        if choice == "fixed_packets":
+            flow["limit"] = int(duration.get("fixed_packets", {}).get("packets", 1))
+        elif choice == "fixed_seconds":
+            flow["limit"] = int(float(duration["fixed_seconds"].get("seconds", 1)) * flow["pps"])
+        else:
+            flow["limit"] = None
+
+    def update_config(self, update):
+        t = self._advance()
+        properties = update.get("flows", {}).get("property_names", [])
+        configured = dict((f["name"], f) for f in self.config.get("flows", []))
+        for f in update.get("flows", {}).get("flows", []):
+            flow = self.flows.get(f["name"])
+            if flow is None:
+                raise ValueError("unknown flow %s" % f["name"])
+            self._rebase(flow, t)
+            self._set_flow_rate(flow, f)
+            # get_config returns the updated flows, as the controller does
+            for p in properties:
+                if p in f:
+                    configured[f["name"]][p] = f[p]
+
+    # state changes
+
+    def _advance(self):
+        # runs the scheduled changes that are due, in time order, and
+        # returns the current time
+        t = self.now()
+        self.scheduled.sort(key=lambda e: e[0])
+        while self.scheduled and self.scheduled[0][0] <= t:
+            at, change = self.scheduled.pop(0)
+            change()
+            self._update_reachability(at)
+        return t
+
+    def _bgp_established(self):
+        self.bgp_up = True
+        self.version += 1
+
+    def set_control_state(self, cs):
+        t = self._advance()
+        choice = cs.get("choice")
+        if choice == "protocol":
+            protocol = cs["protocol"]
+            if protocol.get("choice") == "all":
+                self.protocols = protocol["all"]["state"] == "start"
+                self.bgp_up = False
+                self.scheduled = []
+                if self.protocols:
+                    self.scheduled.append((t + self.bgp_up_seconds, self._bgp_established))
+            elif protocol.get("choice") == "route":
+                names = protocol["route"].get("names") or list(self.routes)
+                if protocol["route"]["state"] == "withdraw":
+                    self.withdrawn.update(names)
+                else:
+                    self.withdrawn.difference_update(names)
+        elif choice == "traffic":
+            transmit = cs["traffic"]["flow_transmit"]
+            names = transmit.get("flow_names") or list(self.flows)
+            for name in names:
+                flow = self.flows[name]
+                if transmit["state"] == "start":
+                    flow.update(start=t, stop=None, base_tx=0, base_rx=0)
+                    flow["outages"] = [[t, None]] if not flow["reachable"] else []
+                elif flow["start"] is not None and flow["stop"] is None:
+                    flow["stop"] = t
+        elif choice == "port":
+            port = cs["port"]
+            if port.get("choice") == "link":
+                names = port["link"].get("port_names") or list(self.ports)
+                if port["link"]["state"] == "down":
+                    self.down_ports.update(names)
+                else:
+                    self.down_ports.difference_update(names)
+            elif port.get("choice") == "capture":
+                names = port["capture"].get("port_names") or list(self.ports)
+                for name in names:
+                    self.ports[name]["capture"] = port["capture"]["state"] == "start"
+        self.version += 1
+        self._update_reachability(t)
+
+    def _available(self, name):
+        port = self.port_of.get(name)
+        if port in self.down_ports:
+            return False
+        route = self.routes.get(name)
+        if route is None:
+            return True
+        return self.protocols and self.bgp_up and name not in self.withdrawn
+
+    def _update_reachability(self, t):
+        for flow in self.flows.values():
+            sending = all(self.port_of.get(n) not in self.down_ports for n in flow["tx_names"])
+            available = set(n for n in flow["rx_names"] if self._available(n))
+            reachable = sending and bool(available)
+            outages = flow["outages"]
+            if flow["reachable"] and not reachable:
+                if outages and outages[-1][1] is not None and outages[-1][1] > t:
+                    outages[-1][1] = t
+                outages.append([t, None])
+            elif not flow["reachable"] and reachable:
+                if outages and outages[-1][1] is None:
+                    outages[-1][1] = t
+            elif reachable and flow["available"] - available:
+                # traffic to a receiver that went away is lost until the
+                # others take over
+                outages.append([t, t + self.convergence_seconds])
+            flow["reachable"] = reachable
+            flow["available"] = available
+
+    # counters
+
+    def _flow_counters(self, flow, t):
+        if flow["start"] is None:
+            return 0, 0, False
+        end = t if flow["stop"] is None else min(t, flow["stop"])
+        if flow["limit"] is not None:
+            end = min(end, flow["start"] + flow["limit"] / flow["pps"])
+        sent = max(0.0, end - flow["start"])
+        lost = 0.0
+        for a, b in flow["outages"]:
+            b = t if b is None else b
+            lost += max(0.0, min(b, end) - max(a, flow["start"]))
+        tx = int(sent * flow["pps"])
+        if flow["limit"] is not None:
+            tx = min(tx, flow["limit"])
+        rx = max(0, tx - int(round(lost * flow["pps"])))
+        running = end == t and flow["stop"] is None
+        return flow["base_tx"] + tx, flow["base_rx"] + rx, running
+
+    def _rebase(self, flow, t):
+        tx, rx, running = self._flow_counters(flow, t)
+        if not running:
+            return
+        if flow["limit"] is not None:
+            flow["limit"] -= tx - flow["base_tx"]
+        flow.update(start=t, base_tx=tx, base_rx=rx)
+        flow["outages"] = [[t, None]] if not flow["reachable"] else []
+
+    def _receiving(self, flow, t):
+        if not flow["reachable"]:
+            return False
+        return not any(a <= t < (t if b is None else b) for a, b in flow["outages"])
+
+    def flow_metrics(self, names):
+        t = self._advance()
+        metrics = []
+        for name in names or list(self.flows):
+            flow = self.flows[name]
+            tx, rx, running = self._flow_counters(flow, t)
+            tx_rate = flow["pps"] if running else 0.0
+            rx_rate = tx_rate if self._receiving(flow, t) else 0.0
+            metrics.append(
+                {
+                    "name": name,
+                    "transmit": "started" if running else "stopped",
+                    "frames_tx": tx,
+                    "frames_rx": rx,
+                    "bytes_tx": int(tx * flow["size"]),
+                    "bytes_rx": int(rx * flow["size"]),
+                    "frames_tx_rate": tx_rate,
+                    "frames_rx_rate": rx_rate,
+                    "loss": 0.0 if tx == 0 else 100.0 * (tx - rx) / tx,
+                }
+            )
+        return metrics
+
+    def port_metrics(self, names):
+        t = self._advance()
+        totals = dict((name, [0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, False]) for name in self.ports)
+        for flow in self.flows.values():
+            tx, rx, running = self._flow_counters(flow, t)
+            tx_rate = flow["pps"] if running else 0.0
+            rx_rate = tx_rate if self._receiving(flow, t) else 0.0
+            tx_port = self.port_of.get(flow["tx_names"][0]) if flow["tx_names"] else None
+            rx_names = sorted(flow["available"]) or flow["rx_names"]
+            rx_port = self.port_of.get(rx_names[0]) if rx_names else None
+            if tx_port in totals:
+                c = totals[tx_port]
+                c[0] += tx
+                c[2] += int(tx * flow["size"])
+                c[4] += tx_rate
+                c[6] += tx_rate * flow["size"]
+                c[8] = c[8] or running
+            if rx_port in totals:
+                c = totals[rx_port]
+                c[1] += rx
+                c[3] += int(rx * flow["size"])
+                c[5] += rx_rate
+                c[7] += rx_rate * flow["size"]
+
+        metrics = []
+        for name in names or list(self.ports):
+            c = totals[name]
+            metrics.append(
+                {
+                    "name": name,
+                    "location": self.ports[name]["location"],
+                    "link": "down" if name in self.down_ports else "up",
+                    "capture": "started" if self.ports[name]["capture"] else "stopped",
+                    "frames_tx": c[0],
+                    "frames_rx": c[1],
+                    "bytes_tx": c[2],
+                    "bytes_rx": c[3],
+                    "frames_tx_rate": c[4],
+                    "frames_rx_rate": c[5],
+                    "bytes_tx_rate": c[6],
+                    "bytes_rx_rate": c[7],
+                    "transmit": "started" if c[8] else "stopped",
+                }
+            )
+        return metrics
+
+    def _peer_up(self, peer):
+        return self.protocols and self.bgp_up and peer["port"] not in self.down_ports
+
+    def _advertised(self, peer):
+        if not self._peer_up(peer):
+            return []
+        return [r for r in peer["routes"] if r["name"] not in self.withdrawn]
+
+    def bgpv4_metrics(self, names):
+        self._advance()
+        advertised = dict(
+            (name, sum(r["count"] for r in self._advertised(peer)))
+            for name, peer in self.peers.items()
+        )
+        metrics = []
+        for name in names or list(self.peers):
+            peer = self.peers[name]
+            up = self._peer_up(peer)
+            metrics.append(
+                {
+                    "name": name,
+                    "session_state": "up" if up else "down",
+                    "session_flap_count": 0,
+                    "routes_advertised": advertised[name],
+                    "routes_received": sum(c for n, c in advertised.items() if n != name) if up else 0,
+                }
+            )
+        return metrics
+
+    def bgp_prefixes(self, names, families):
+        # returns the JSON text, prefixes are formatted once per peer,
+        # family and change and served from the cache after that
+        self._advance()
+        shards = []
+        for name in names or list(self.peers):
+            peer = self.peers[name]
+            fields = ['"bgp_peer_name": %s' % json.dumps(name)]
+            for family in families:
+                key = (name, family, self.version)
+                if key not in self.prefix_cache:
+                    self.prefix_cache[key] = self._prefixes_json(peer, family)
+                fields.append('"%s_unicast_prefixes": [%s]' % (family, self.prefix_cache[key]))
+            shards.append("{%s}" % ", ".join(fields))
+        return '{"choice": "bgp_prefixes", "bgp_prefixes": [%s]}' % ", ".join(shards)
+
+    def _prefixes_json(self, peer, family):
+        if not self._peer_up(peer):
+            return ""
+        items = []
+        for other in self.peers.values():
+            if other is peer:
+                continue
+            for route in self._advertised(other):
+                if route["family"] != family:
+                    continue
+                hop_family, hop = route["next_hop"]
+                item = '{"%s_address": "%%s", "prefix_length": %d, "origin": "igp", "path_id": 0, "%s_next_hop": "%s"}'
+                for network, prefix, count, stride in route["ranges"]:
+                    fmt = item % (family, prefix, hop_family, hop)
+                    items.extend(
+                        fmt % _address(family, network + i * stride) for i in range(count)
+                    )
+        return ", ".join(items)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, without this every
+    # response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def _dispatch(self, method):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        delay = server.latency_seconds + random.uniform(0, server.jitter_seconds)
+        if delay:
+            time.sleep(delay)
+
+        sim = server.simulator
+        path = self.path.split("?")[0]
+        try:
+            with sim.lock:
+                if (method, path) == ("POST", "/config"):
+                    sim.set_config(body)
+                    self._reply({"warnings": []})
+                elif (method, path) == ("GET", "/config"):
+                    self._reply(sim.config)
+                elif (method, path) == ("PATCH", "/config"):
+                    sim.update_config(body)
+                    self._reply({"warnings": []})
+                elif (method, path) == ("POST", "/control/state"):
+                    sim.set_control_state(body)
+                    self._reply({"warnings": []})
+                elif (method, path) == ("POST", "/monitor/metrics"):
+                    self._reply(self._metrics(sim, body))
+                elif (method, path) == ("POST", "/monitor/states"):
+                    request = body.get("bgp_prefixes", {})
+                    families = [f[: -len("_unicast")] for f in request.get("prefix_filters", [])]
+                    text = sim.bgp_prefixes(
+                        request.get("bgp_peer_names", []),
+                        [f for f in ["ipv4", "ipv6"] if not families or f in families],
+                    )
+                    self._reply_text(text)
+                elif (method, path) == ("POST", "/monitor/capture"):
+                    # an empty Ethernet pcap
+                    header = b"\xd4\xc3\xb2\xa1\x02\x00\x04\x00" + b"\x00" * 8 + b"\xff\xff\x00\x00\x01\x00\x00\x00"
+                    self._reply_bytes(header, "application/octet-stream")
+                elif (method, path) == ("GET", "/capabilities/version"):
+                    self._reply({"api_spec_version": "", "sdk_version": "", "app_version": "mock"})
+                else:
+                    self._reply({"code": 404, "errors": ["%s %s not found" % (method, path)]}, 404)
+        except (KeyError, ValueError) as e:
+            self._reply({"code": 400, "errors": ["%s: %s" % (type(e).__name__, e)]}, 400)
+
+    def _metrics(self, sim, body):
+        choice = body.get("choice", "port")
+        request = body.get(choice, {})
+        if choice == "flow":
+            return {"choice": "flow_metrics", "flow_metrics": sim.flow_metrics(request.get("flow_names", []))}
+        if choice == "port":
+            return {"choice": "port_metrics", "port_metrics": sim.port_metrics(request.get("port_names", []))}
+        if choice == "bgpv4":
+            return {"choice": "bgpv4_metrics", "bgpv4_metrics": sim.bgpv4_metrics(request.get("peer_names", []))}
+        raise ValueError("metrics choice %s is not simulated" % choice)
+
+    def _reply(self, obj, status=200):
+        self._reply_text(json.dumps(obj), status)
+
+    def _reply_text(self, text, status=200):
+        self._reply_bytes(text.encode(), "application/json", status)
+
+    def _reply_bytes(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start(
+    port=DEFAULT_PORT,
+    host="127.0.0.1",
+    latency_ms=0,
+    jitter_ms=0,
+    time_scale=1.0,
+    bgp_up_ms=1000,
+    convergence_ms=100,
+    certfile=None,
+    keyfile=None,
+):
+    """
+    Serves a Simulator on a background thread and returns the server and the
+    location to pass to `snappi.api`. `port=0` picks a free port. Stop it
+    with `server.shutdown()`.
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.simulator = Simulator(time_scale, bgp_up_ms, convergence_ms)
+    server.latency_seconds = latency_ms / 1000.0
+    server.jitter_seconds = jitter_ms / 1000.0
+    scheme = "http"
+    if certfile is not None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "%s://%s:%d" % (scheme, host, server.server_address[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline stand-in for an OTG controller")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--time-scale", type=float, default=1.0)
+    parser.add_argument("--bgp-up-ms", type=float, default=1000)
+    parser.add_argument("--convergence-ms", type=float, default=100)
+    parser.add_argument("--certfile", help="serve https with this certificate")
+    parser.add_argument("--keyfile")
+    args = parser.parse_args()
+
+    server, location = start(
+        args.port,
+        args.host,
+        args.latency_ms,
+        args.jitter_ms,
+        args.time_scale,
+        args.bgp_up_ms,
+        args.convergence_ms,
+        args.certfile,
+        args.keyfile,
+    )
+    print("%s Mock controller listening on %s    ..." % (datetime.now(), location))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,172 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+## Long-lived worker that keeps `snappi` imported and one `snappi.api(...)`
+## session per controller location warm, so lab entry points such as
+## `Traffic_Test` or `Test_ebgp_route_prefix` skip the import, model
+## initialization and TLS handshake on every run.
+##
+##   python tools/otg_worker.py serve
+##   python tools/otg_worker.py run lab-04/lab-04-1_test.py Test_ibgp_route_prefix
+
+DEFAULT_SOCKET = "/tmp/otg-worker.sock"
+# how long the threads a job started get to end after it returned
+JOIN_SECONDS = 10
+
+
+class Worker(object):
+    def __init__(self):
+        import snappi
+
+        self.snappi = snappi
+        self.create_api = snappi.api
+        self.apis = {}
+        self.modules = {}
+        # lab scripts write files relative to their directory and print to
+        # sys.stdout, so runs are serialized
+        self.lock = threading.Lock()
+        self.stdout = sys.stdout
+        # non-daemon threads of earlier jobs still running, no job runs
+        # until they end
+        self.strays = []
+
+        snappi.api = self.api
+        snappi.snappi.api = self.api
+
+    def api(self, **kwargs):
+        key = json.dumps(kwargs, sort_keys=True, default=str)
+        if key not in self.apis:
+            print("%s Creating session to %s    ..." % (datetime.now(), kwargs.get("location")))
+            self.apis[key] = self.create_api(**kwargs)
+        return self.apis[key]
+
+    def module(self, path):
+        mtime = os.path.getmtime(path)
+        cached = self.modules.get(path)
+        if cached is None or cached[0] != mtime:
+            name = os.path.splitext(os.path.basename(path))[0].replace("-", "_")
+            spec = importlib.util.spec_from_file_location(name, path)
+            m = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(m)
+            cached = (mtime, m)
+            self.modules[path] = cached
+        return cached[1]
+
+    def run(self, script, entry):
+        path = os.path.abspath(script)
+        result = {"script": script, "entry": entry, "ok": False, "output": ""}
+        with self.lock:
+            self.strays = [t for t in self.strays if t.is_alive()]
+            if self.strays:
+                result["seconds"] = 0.0
+                result["error"] = "Refused, threads of an earlier job still running: %s\n" % ", ".join(
+                    t.name for t in self.strays
+                )
+                return result
+
+            out = io.StringIO()
+            before = set(threading.enumerate())
+            cwd = os.getcwd()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(out):
+                try:
+                    os.chdir(os.path.dirname(path))
+                    getattr(self.module(path), entry)()
+                    result["ok"] = True
+                except BaseException:
+                    result["error"] = traceback.format_exc()
+                finally:
+                    os.chdir(cwd)
+                self.join(set(threading.enumerate()) - before, result)
+            result["seconds"] = time.perf_counter() - start
+        result["output"] = out.getvalue()
+        return result
+
+    def join(self, threads, result):
+        # waits for the threads a job left running, a job leaving non-daemon
+        # threads behind fails and blocks the next jobs until they end
+        deadline = time.monotonic() + JOIN_SECONDS
+        for t in threads:
+            t.join(max(0, deadline - time.monotonic()))
+        left = sorted((t for t in threads if t.is_alive()), key=lambda t: t.name)
+        if left:
+            print(
+                "%s Threads still running after the job: %s"
+                % (datetime.now(), ", ".join("%s%s" % (t.name, " (daemon)" if t.daemon else "") for t in left))
+            )
+        self.strays = [t for t in left if not t.daemon]
+        if self.strays:
+            result["ok"] = False
+            result["error"] = result.get("error", "") + "Left non-daemon threads running: %s\n" % ", ".join(
+                t.name for t in self.strays
+            )
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line)
+            worker = self.server.worker
+            # to the worker's own stdout, another job may be running
+            print("%s Running %s %s    ..." % (datetime.now(), request["script"], request["entry"]), file=worker.stdout)
+            result = worker.run(request["script"], request["entry"])
+            print(
+                "%s %s in %.3fs" % (datetime.now(), "PASSED" if result["ok"] else "FAILED", result["seconds"]),
+                file=worker.stdout,
+            )
+            self.wfile.write((json.dumps(result) + "\n").encode())
+
+
+def serve(socket_path):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.worker = Worker()
+    print("%s Worker listening on %s    ..." % (datetime.now(), socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def submit(socket_path, script, entry):
+    # returns the result dict of one run, see Worker.run
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        request = {"script": os.path.abspath(script), "entry": entry}
+        s.sendall((json.dumps(request) + "\n").encode())
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm snappi worker for lab entry points")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("serve")
+    run = sub.add_parser("run")
+    run.add_argument("script")
+    run.add_argument("entry")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.socket)
+    else:
+        result = submit(args.socket, args.script, args.entry)
+        print(result["output"], end="")
+        if not result["ok"]:
+            print(result["error"], end="")
+        print("%s %s in %.3fs" % (datetime.now(), "PASSED" if result["ok"] else "FAILED", result["seconds"]))
+        raise SystemExit(0 if result["ok"] else 1)
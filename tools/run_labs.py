@@ -0,0 +1,332 @@
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+
+## Runs lab entry points (`Traffic_Test`, `Test_*`) concurrently, each in
+## its own process against a controller stack leased from a pool, so the
+## suite takes about as long as its slowest test when there are enough
+## stacks. A stack is one controller plus its test ports, e.g. one compose
+## or containerlab deployment; a test holds its stack until it ends.
+##
+## The pool is a JSON list of stacks:
+##
+##   [
+##     {"name": "b2b-1", "labs": ["lab-02", "lab-05"],
+##      "location": "https://localhost:8443"},
+##     {"name": "b2b-2", "labs": ["lab-02", "lab-05"],
+##      "location": "https://localhost:9443",
+##      "ports": {"localhost:5551+localhost:50071": "localhost:5561+localhost:50081",
+##                "localhost:5552+localhost:50072": "localhost:5562+localhost:50082"}}
+##   ]
+##
+## `labs` limits which lab directories or scripts a stack can run (any
+## when missing), `ports` maps the port locations a lab configures to the
+## stack's own.
+## Without a pool every distinct controller location hardcoded in the labs
+## is a stack of its own, so labs on different controllers already run in
+## parallel and labs sharing one take turns.
+##
+## Output of every test goes to RESULTS_DIR/<timestamp>/, next to a
+## results.json of the whole run, and the API traces, phases and metric
+## recordings the test writes to RESULTS_DIR/<timestamp>/<test>/. Tests run longest first, by the durations
+## of the previous run.
+##
+##   python tools/run_labs.py
+##   python tools/run_labs.py --pool stacks.json lab-02 lab-04
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+RESULTS_DIR = os.path.join(ROOT, "lab-runs")
+ENTRY_RE = re.compile(r"^def (Traffic_Test|Test_\w+)\(\):", re.M)
+LOCATION_RE = re.compile(r"(?:api\(location=|\"controller_location\": )\"([^\"]+)\"")
+
+
+def discover(selected=None):
+    """
+    Returns `(script, entry, default location)` of every entry point in the
+    lab-*/ scripts, only of the lab directories or scripts in `selected`
+    when given.
+    """
+    tests = []
+    for script in sorted(glob.glob(os.path.join(ROOT, "lab-*", "*.py"))):
+        lab = os.path.basename(os.path.dirname(script))
+        if selected and lab not in selected and os.path.basename(script) not in selected:
+            continue
+        with open(script) as f:
+            source = f.read()
+        location = LOCATION_RE.search(source)
+        for entry in ENTRY_RE.findall(source):
+            tests.append((script, entry, location.group(1) if location else None))
+    return tests
+
+
+class Pool(object):
+    """
+    Leases stacks to tests. `lease(script)` blocks until a stack that can
+    run `script` is free and returns it, None when no stack can, and
+    `release(stack)` hands it back. Stacks go to waiting tests in the order
+    they asked for one. Subclasses may drop stacks from `stacks` while
+    tests wait, e.g. tools/warm_pool.py, and must `notify_all` then.
+    """
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+        self.free = list(stacks)
+        self.waiting = []
+        self.cond = threading.Condition()
+
+    def can_run(self, stack, script):
+        labs = stack.get("labs")
+        return (
+            not labs
+            or os.path.basename(os.path.dirname(script)) in labs
+            or os.path.basename(script) in labs
+        )
+
+    def lease(self, script):
+        with self.cond:
+            ticket = object()
+            self.waiting.append((ticket, script))
+            while True:
+                if not any(self.can_run(s, script) for s in self.stacks):
+                    self.waiting.remove((ticket, script))
+                    self.cond.notify_all()
+                    return None
+                earlier = self.waiting[: self.waiting.index((ticket, script))]
+                for stack in self.free:
+                    if self.can_run(stack, script) and not any(
+                        self.can_run(stack, s) for _, s in earlier
+                    ):
+                        self.free.remove(stack)
+                        self.waiting.remove((ticket, script))
+                        # later tests may now be first in line for a stack
+                        self.cond.notify_all()
+                        return stack
+                self.cond.wait()
+
+    def release(self, stack):
+        with self.cond:
+            self.free.append(stack)
+            self.cond.notify_all()
+
+
+def default_stacks(tests):
+    # one stack per controller the labs point at, limited to the scripts
+    # pointing at it
+    stacks = {}
+    for script, entry, location in tests:
+        if location is None:
+            continue
+        stack = stacks.setdefault(location, {"name": location, "location": location, "labs": []})
+        if os.path.basename(script) not in stack["labs"]:
+            stack["labs"].append(os.path.basename(script))
+    return list(stacks.values())
+
+
+def previous_seconds(results_dir):
+    # durations of the last run, to start the longest tests first
+    runs = sorted(glob.glob(os.path.join(results_dir, "*", "results.json")))
+    if not runs:
+        return {}
+    with open(runs[-1]) as f:
+        return dict(("%s:%s" % (r["script"], r["entry"]), r["seconds"]) for r in json.load(f))
+
+
+def run_test(pool, script, entry, run_dir, timeout_seconds):
+    name = "%s-%s" % (os.path.splitext(os.path.basename(script))[0], entry)
+    result = {"script": os.path.relpath(script, ROOT), "entry": entry, "ok": False, "seconds": 0.0}
+    stack = pool.lease(script)
+    if stack is None:
+        result["error"] = "no stack in the pool runs %s" % result["script"]
+        print("%s SKIPPED %s, %s" % (datetime.now(), name, result["error"]))
+        return result
+
+    result["stack"] = stack["name"]
+    result["log"] = os.path.join(run_dir, name + ".log")
+    print("%s Running %s on %s    ..." % (datetime.now(), name, stack["name"]))
+    start = time.perf_counter()
+    try:
+        with open(result["log"], "w") as log:
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "child",
+                    script,
+                    entry,
+                    "--location",
+                    stack.get("location", ""),
+                    "--ports",
+                    json.dumps(stack.get("ports", {})),
+                ],
+                cwd=os.path.dirname(script),
+                env=dict(os.environ, OTG_RESULTS_DIR=os.path.join(run_dir, name)),
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                timeout=timeout_seconds,
+            )
+        result["ok"] = process.returncode == 0
+        result["returncode"] = process.returncode
+    except subprocess.TimeoutExpired:
+        result["error"] = "timed out after %ds" % timeout_seconds
+    finally:
+        result["seconds"] = time.perf_counter() - start
+        pool.release(stack)
+    print(
+        "%s %s %s in %.3fs"
+        % (datetime.now(), "PASSED" if result["ok"] else "FAILED", name, result["seconds"])
+    )
+    return result
+
+
+def run_all(tests, pool, results_dir, timeout_seconds):
+    run_dir = os.path.join(results_dir, datetime.now().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(run_dir, exist_ok=True)
+    seconds = previous_seconds(results_dir)
+    tests = sorted(
+        tests,
+        key=lambda t: -seconds.get("%s:%s" % (os.path.relpath(t[0], ROOT), t[1]), float("inf")),
+    )
+
+    results = [None] * len(tests)
+
+    def worker(i, script, entry):
+        try:
+            results[i] = run_test(pool, script, entry, run_dir, timeout_seconds)
+        except BaseException:
+            results[i] = {"script": os.path.relpath(script, ROOT), "entry": entry, "ok": False, "seconds": 0.0}
+            results[i]["error"] = traceback.format_exc()
+
+    # one thread per test, the pool decides how many actually run
+    threads = [
+        threading.Thread(target=worker, args=(i, script, entry))
+        for i, (script, entry, _) in enumerate(tests)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with open(os.path.join(run_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    return run_dir, results
+
+
+def print_results(results, total_seconds):
+    col_width = 15
+    headers = ["Status", "Seconds", "Stack", "Test"]
+    border = "-" * (len(headers) * col_width)
+    row = ("%%-%ds" % col_width) * len(headers)
+    print("\n%s\nLab Runs\n%s" % (border, border))
+    print(row % tuple(headers))
+    for r in results:
+        status = "PASSED" if r["ok"] else ("SKIPPED" if "stack" not in r else "FAILED")
+        print(
+            row
+            % (status, "%.3f" % r["seconds"], r.get("stack", "-"), "%s %s" % (r["script"], r["entry"]))
+        )
+    print(border)
+    print(
+        "%d passed, %d failed in %.3fs, %.3fs of tests\n"
+        % (
+            sum(1 for r in results if r["ok"]),
+            sum(1 for r in results if not r["ok"]),
+            total_seconds,
+            sum(r["seconds"] for r in results),
+        )
+    )
+
+
+def redirect(location, ports):
+    """
+    Points every `snappi.api` the lab creates at `location` and rewrites
+    the port locations of the configs it sets according to `ports`.
+    """
+    import snappi
+
+    create = snappi.snappi.api
+
+    def remap(payload):
+        for old, new in ports.items():
+            payload = payload.replace('"location": "%s"' % old, '"location": "%s"' % new)
+            payload = payload.replace('"location":"%s"' % old, '"location":"%s"' % new)
+        return payload
+
+    def api(**kwargs):
+        if location:
+            kwargs["location"] = location
+        a = create(**kwargs)
+        if ports:
+            set_config = a.set_config
+            a.set_config = lambda payload: set_config(
+                remap(payload if isinstance(payload, str) else payload.serialize())
+            )
+        return a
+
+    snappi.api = api
+    snappi.snappi.api = api
+    return remap
+
+
+def child(script, entry, location, ports):
+    remap = redirect(location, ports)
+    name = os.path.splitext(os.path.basename(script))[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, script)
+    m = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(m)
+    # remapped where the payloads are built, so that IncrementalConfig
+    # compares them with the remapped config the controller runs
+    if ports and hasattr(m, "cached_config"):
+        cached_config = m.cached_config
+        m.cached_config = lambda *args, **kwargs: remap(cached_config(*args, **kwargs))
+    elif ports and hasattr(m, "set_config_payload"):
+        set_config_payload = m.set_config_payload
+        m.set_config_payload = lambda api, payload: set_config_payload(api, remap(payload))
+    getattr(m, entry)()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "child":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("command")
+        parser.add_argument("script")
+        parser.add_argument("entry")
+        parser.add_argument("--location", default="")
+        parser.add_argument("--ports", default="{}")
+        args = parser.parse_args()
+        child(args.script, args.entry, args.location, json.loads(args.ports))
+        raise SystemExit(0)
+
+    parser = argparse.ArgumentParser(description="Run lab entry points concurrently over a pool of stacks")
+    parser.add_argument("labs", nargs="*", help="lab directories or script names to run, all by default")
+    parser.add_argument("--pool", help="JSON file listing the stacks")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--timeout-seconds", type=int, default=900)
+    parser.add_argument("--list", action="store_true", help="only list the entry points")
+    args = parser.parse_args()
+
+    tests = discover(args.labs)
+    if args.list:
+        for script, entry, location in tests:
+            print("%-30s%-30s%s" % (os.path.relpath(script, ROOT), entry, location))
+        raise SystemExit(0)
+
+    if args.pool is not None:
+        with open(args.pool) as f:
+            stacks = json.load(f)
+    else:
+        stacks = default_stacks(tests)
+
+    start = time.perf_counter()
+    run_dir, results = run_all(tests, Pool(stacks), args.results_dir, args.timeout_seconds)
+    print_results(results, time.perf_counter() - start)
+    print("%s Logs and results in %s" % (datetime.now(), run_dir))
+    raise SystemExit(0 if all(r["ok"] for r in results) else 1)
@@ -0,0 +1,298 @@
+import argparse
+import glob
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+import run_labs
+
+## Keeps containerlab topologies of the labs deployed between test runs, so
+## tests lease a warm instance instead of paying for a deploy (minutes with
+## SR Linux and the protocol engines' startup-delay) each time.
+##
+## Every instance is the lab's topology deployed under its own name,
+## `<lab>-w<n>`, with the controller's host port mappings dropped so any
+## number of them fit on one host. Once a test releases an instance it is
+## reset: traffic and protocols are stopped and an empty config is set,
+## which also clears the counters. It is then health checked, controller
+## answering and every node running, before the next test gets it. An
+## instance that fails either is evicted and destroyed and redeployed in
+## the background while the others keep serving tests.
+##
+##   python tools/warm_pool.py up lab-03 lab-04 --size 2
+##   python tools/warm_pool.py run
+##   python tools/warm_pool.py check
+##   python tools/warm_pool.py down
+
+STATE_FILE = os.path.join(run_labs.RESULTS_DIR, "warm-pool.json")
+
+
+def instance_stack(lab, index):
+    """
+    Writes the topology of instance `index` of `lab` next to the lab's own
+    and returns its stack for run_labs, with the controller and port
+    locations of the lab's scripts renamed after the instance.
+    """
+    lab_dir = os.path.join(run_labs.ROOT, lab)
+    with open(os.path.join(lab_dir, lab + ".yml")) as f:
+        topology = f.read()
+    # edited as text, a YAML round trip would turn values like `Yes` of the
+    # node env into booleans
+    name = re.search(r"^name:\s*(\S+)", topology, re.M).group(1)
+    instance = "%s-w%d" % (name, index)
+    topology = re.sub(r"^name:.*$", "name: " + instance, topology, count=1, flags=re.M)
+    # host port mappings would clash between instances
+    topology = re.sub(r"^( +)ports:\n(?:\1 +- .*\n)+", "", topology, flags=re.M)
+    path = os.path.join(lab_dir, instance + ".warm.yml")
+    with open(path, "w") as f:
+        f.write(topology)
+
+    # containerlab names the nodes clab-<topology name>-<node>
+    old, new = "clab-%s-" % name, "clab-%s-" % instance
+    location = None
+    ports = {}
+    for script in glob.glob(os.path.join(lab_dir, "*.py")):
+        with open(script) as f:
+            source = f.read()
+        match = run_labs.LOCATION_RE.search(source)
+        if match and location is None:
+            location = match.group(1).replace(old, new)
+        for port in re.findall(r'location="(%s[^"]+)"' % re.escape(old), source):
+            ports[port] = port.replace(old, new)
+    return {
+        "name": instance,
+        "labs": [lab],
+        "location": location,
+        "ports": ports,
+        "topology": path,
+    }
+
+
+def containerlab(stack, *args):
+    return subprocess.run(
+        ["containerlab"] + list(args) + ["-t", stack["topology"]],
+        cwd=os.path.dirname(stack["topology"]),
+        capture_output=True,
+        text=True,
+    )
+
+
+def deploy(stack, timeout_seconds=900):
+    print("%s Deploying %s    ..." % (datetime.now(), stack["name"]))
+    process = containerlab(stack, "deploy", "--reconfigure")
+    if process.returncode != 0:
+        raise Exception("Deploying %s failed: %s" % (stack["name"], process.stderr.strip()))
+    deadline = time.monotonic() + timeout_seconds
+    while True:
+        problem = health(stack)
+        if problem is None:
+            print("%s Deployed %s" % (datetime.now(), stack["name"]))
+            return
+        if time.monotonic() >= deadline:
+            raise Exception("%s not healthy after deploy: %s" % (stack["name"], problem))
+        time.sleep(5)
+
+
+def destroy(stack):
+    print("%s Destroying %s    ..." % (datetime.now(), stack["name"]))
+    containerlab(stack, "destroy", "--cleanup")
+
+
+def health(stack, timeout_seconds=10):
+    """
+    Returns why `stack` is not healthy or None: every node has to be
+    running and the controller has to answer.
+    """
+    process = containerlab(stack, "inspect", "--format", "json")
+    if process.returncode != 0:
+        return "inspect failed: %s" % process.stderr.strip()
+    inspected = json.loads(process.stdout or "{}")
+    # {"containers": [...]} up to containerlab 0.60, {"<lab>": [...]} after
+    nodes = [n for v in inspected.values() if isinstance(v, list) for n in v]
+    if not nodes:
+        return "not deployed"
+    stopped = [n.get("name") for n in nodes if n.get("state") != "running"]
+    if stopped:
+        return "nodes not running: %s" % ", ".join(stopped)
+    try:
+        response = requests.get(
+            stack["location"] + "/capabilities/version", verify=False, timeout=timeout_seconds
+        )
+    except requests.RequestException as e:
+        return "controller not answering: %s" % e
+    if not response.ok:
+        return "controller answered %d" % response.status_code
+    return None
+
+
+def reset(stack, timeout_seconds=30):
+    """
+    Stops traffic and protocols and sets an empty config, leaving the
+    controller without flows, devices or counters like a fresh deploy.
+    Returns why the reset failed or None.
+    """
+    session = requests.Session()
+    for state in [
+        {"choice": "traffic", "traffic": {"choice": "flow_transmit", "flow_transmit": {"state": "stop"}}},
+        {"choice": "protocol", "protocol": {"choice": "all", "all": {"state": "stop"}}},
+    ]:
+        try:
+            # nothing to stop is answered with an error, only an unreachable
+            # controller fails the reset
+            session.post(
+                stack["location"] + "/control/state", json=state, verify=False, timeout=timeout_seconds
+            )
+        except requests.RequestException as e:
+            return "stopping %s failed: %s" % (state["choice"], e)
+    try:
+        response = session.post(stack["location"] + "/config", json={}, verify=False, timeout=timeout_seconds)
+    except requests.RequestException as e:
+        return "empty set_config failed: %s" % e
+    if not response.ok:
+        return "empty set_config answered %d: %s" % (response.status_code, response.text[:200])
+    return None
+
+
+class WarmPool(run_labs.Pool):
+    """
+    run_labs.Pool that resets and health checks a stack before handing it
+    out again, evicting it for a rebuild in the background when either
+    fails. A stack that fails `rebuild_attempts` rebuilds in a row leaves
+    the pool.
+    """
+
+    def __init__(self, stacks, rebuild_attempts=2):
+        super(WarmPool, self).__init__(stacks)
+        self.rebuild_attempts = rebuild_attempts
+        self.rebuilds = []
+
+    def release(self, stack):
+        # runs in the thread of the test that had the stack, so the stack is
+        # not handed out while it is reset
+        problem = reset(stack) or health(stack)
+        if problem is None:
+            super(WarmPool, self).release(stack)
+            return
+        print("%s Evicting %s, %s" % (datetime.now(), stack["name"], problem))
+        t = threading.Thread(target=self._rebuild, args=(stack,))
+        t.start()
+        self.rebuilds.append(t)
+
+    def _rebuild(self, stack):
+        for attempt in range(self.rebuild_attempts):
+            try:
+                destroy(stack)
+                deploy(stack)
+            except Exception as e:
+                print("%s Rebuilding %s failed: %s" % (datetime.now(), stack["name"], e))
+                continue
+            super(WarmPool, self).release(stack)
+            return
+        print("%s Dropping %s from the pool" % (datetime.now(), stack["name"]))
+        with self.cond:
+            self.stacks.remove(stack)
+            self.cond.notify_all()
+
+    def check(self):
+        # recycles every free stack at once, e.g. before a run
+        with self.cond:
+            stacks, self.free = self.free, []
+        with ThreadPoolExecutor(max_workers=max(1, len(stacks))) as pool:
+            list(pool.map(self.release, stacks))
+
+    def join(self):
+        for t in list(self.rebuilds):
+            t.join()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, stacks):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(stacks, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pool of warm lab topologies")
+    parser.add_argument("--state", default=STATE_FILE)
+    sub = parser.add_subparsers(dest="command", required=True)
+    up = sub.add_parser("up", help="deploy instances of labs")
+    up.add_argument("labs", nargs="+")
+    up.add_argument("--size", type=int, default=1, help="instances per lab")
+    sub.add_parser("check", help="reset and health check every instance, rebuild bad ones")
+    run = sub.add_parser("run", help="run lab entry points over the pool")
+    run.add_argument("labs", nargs="*")
+    run.add_argument("--results-dir", default=run_labs.RESULTS_DIR)
+    run.add_argument("--timeout-seconds", type=int, default=900)
+    sub.add_parser("down", help="destroy every instance")
+    args = parser.parse_args()
+
+    stacks = load_state(args.state)
+    if args.command == "up":
+        names = set(s["name"] for s in stacks)
+        new = []
+        for lab in args.labs:
+            index = 1
+            while len([s for s in stacks + new if lab in s["labs"]]) < args.size:
+                stack = instance_stack(lab, index)
+                if stack["name"] not in names:
+                    new.append(stack)
+                index += 1
+        deployed = []
+        lock = threading.Lock()
+
+        def deploy_and_save(stack):
+            # saved as soon as it is done, and also when the deploy failed as
+            # that can leave nodes behind, so that neither a failed deploy
+            # nor an interrupted `up` orphans instances: `check` rebuilds a
+            # broken one and `down` destroys them all
+            try:
+                deploy(stack)
+            finally:
+                with lock:
+                    deployed.append(stack)
+                    save_state(args.state, stacks + deployed)
+
+        # every deploy runs to its end before the first failure is raised,
+        # pool.map would cancel the ones not started yet
+        with ThreadPoolExecutor(max_workers=max(1, len(new))) as pool:
+            futures = [pool.submit(deploy_and_save, stack) for stack in new]
+        for future in futures:
+            future.result()
+    elif args.command == "check":
+        pool = WarmPool(stacks)
+        pool.check()
+        pool.join()
+        print("%s %d of %d instances healthy" % (datetime.now(), len(pool.free), len(stacks)))
+    elif args.command == "run":
+        labs = args.labs or sorted(set(lab for s in stacks for lab in s["labs"]))
+        tests = run_labs.discover(labs)
+        pool = WarmPool(stacks)
+        pool.check()
+        start = time.perf_counter()
+        run_dir, results = run_labs.run_all(tests, pool, args.results_dir, args.timeout_seconds)
+        run_labs.print_results(results, time.perf_counter() - start)
+        print("%s Logs and results in %s" % (datetime.now(), run_dir))
+        # leave the pool warm for the next run
+        pool.join()
+        raise SystemExit(0 if all(r["ok"] for r in results) else 1)
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, len(stacks))) as pool:
+            list(pool.map(destroy, stacks))
+        for s in stacks:
+            if os.path.exists(s["topology"]):
+                os.unlink(s["topology"])
+        save_state(args.state, [])